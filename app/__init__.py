@@ -1,22 +1,46 @@
+import time
+
+_import_started = time.perf_counter()
+
 from flask import Flask, request, current_app
-from docker.errors import DockerException
+from redis.exceptions import RedisError
 from app.extensions import logger, client, csrf, security, db, migrate, mail, rq, babel
 from config import Config
 from redis import Redis
 from app.models import User, Role, WebAuthn
+from app.email import QueuedMailUtil
 from flask_security import (
     SQLAlchemyUserDatastore,
 )
 from rq import Queue
 
+_import_seconds = time.perf_counter() - _import_started
+
 
 def get_locale():
     return request.accept_languages.best_match(current_app.config["LANGUAGES"])
 
 
 def create_app(config_class=Config) -> Flask:
+    """Create the app without touching Docker or the database.
+
+    Schema changes are applied with `flask db upgrade` and the default image
+    is pulled by a background job, so workers boot in well under a second.
+    """
+    timings = {"imports": _import_seconds}
+    started = mark = time.perf_counter()
+
+    def lap(phase):
+        nonlocal mark
+        now = time.perf_counter()
+        timings[phase] = now - mark
+        mark = now
+
     app: Flask = Flask(__name__)
     app.config.from_object(config_class)
+    # FLASK_-prefixed variables override it, e.g. FLASK_RQ_REDIS_URL, including
+    # in RQ workers, whose app is created with the default config
+    app.config.from_prefixed_env()
     app.logger = logger
     app.config["REMEMBER_COOKIE_SAMESITE"] = "strict"
     app.config["SESSION_COOKIE_SAMESITE"] = "strict"
@@ -34,28 +58,18 @@ def create_app(config_class=Config) -> Flask:
     db.init_app(app)
     migrate.init_app(app, db)
 
+    lap("config")
+
     user_datastore = SQLAlchemyUserDatastore(db, User, Role, WebAuthn)
     csrf.init_app(app)
-    security.init_app(app, user_datastore)
+    security.init_app(app, user_datastore, mail_util_cls=QueuedMailUtil)
     mail.init_app(app)
+    client.init_app(app)
     rq.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
     app.redis = Redis.from_url(app.config["RQ_REDIS_URL"])
     app.task_queue = Queue("microblog-tasks", connection=app.redis)
-    with app.app_context():
-        db.create_all()
-        # Pull Ubuntu image at startup with better error handling
-        try:
-            client.images.pull(app.config["DEFAULT_IMAGE"])
-            logger.info(
-                f"Successfully pulled the default image: {app.config['DEFAULT_IMAGE']}"
-            )
-        except DockerException as e:
-            logger.error(
-                f"Failed to pull default image {app.config['DEFAULT_IMAGE']}: {e}"
-            )
-        except Exception as e:
-            logger.error(f"Unexpected error while pulling default image: {e}")
+    lap("extensions")
 
     # Register blueprints after all initializations
     from app.cloudshell import bp as cloudshell_bp
@@ -75,4 +89,24 @@ def create_app(config_class=Config) -> Flask:
 
     app.register_blueprint(errors_bp)
 
+    from app import authcache, metrics, profiling
+
+    authcache.init_app(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+    lap("blueprints")
+
+    from app.cloudshell import images
+
+    with app.app_context():
+        try:
+            images.schedule_prepull()
+        except RedisError as e:
+            logger.warning(f"Could not schedule the image pre-pull: {e}")
+    lap("prepull")
+
+    breakdown = ", ".join(
+        f"{phase} {secs * 1000:.0f}ms" for phase, secs in timings.items()
+    )
+    logger.info(f"App created in {(mark - started) * 1000:.0f}ms ({breakdown})")
     return app
@@ -0,0 +1,271 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Set
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app, g, has_app_context
+from flask_security.utils import get_request_attr, parse_auth_token, set_request_attr
+from flask_security.utils import config_value as cv
+from app import metrics
+from app.extensions import db, logger
+from app.models import Role, User
+
+# Each user is cached as JSON under their fs_uniquifier, along with the value
+# of their version counter when it was read from the database. Invalidating a
+# user bumps the counter, so entries read before the change are ignored, and
+# publishes the new version so every process evicts its own copy.
+USER_KEY = "auth:user:{}"
+VERSION_KEY = "auth:version:{}"
+CHANNEL = "auth:invalidate"
+
+# Columns kept in the cache; the rest, e.g. balance, load when first used
+COLUMNS = ("id", "email", "username", "active", "fs_uniquifier")
+ROLE_COLUMNS = ("id", "name", "description")
+# Changes to these evict the user
+WATCHED = COLUMNS + ("password", "roles")
+
+
+class LocalCache:
+    """A per-process LRU of cached users, evicted over Redis pub/sub.
+
+    A daemon thread listens for invalidations. Until it is subscribed, e.g.
+    after losing its connection, lookups skip this cache and go to Redis.
+    """
+
+    def __init__(self, redis, size: int, ttl: int):
+        self.redis = redis
+        self.size = size
+        self.ttl = ttl
+        # fs_uniquifier -> (expires at, version, user data or None once evicted)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def get(self, uniquifier: str) -> Optional[dict]:
+        self._ensure_running()
+        if not self._subscribed.is_set():
+            return None
+        with self._lock:
+            entry = self._entries.get(uniquifier)
+            if entry is None or entry[2] is None or entry[0] < time.monotonic():
+                return None
+            self._entries.move_to_end(uniquifier)
+            return entry[2]
+
+    def put(self, uniquifier: str, version: int, data: Optional[dict]) -> None:
+        """Cache a user unless a newer version was evicted while it was read."""
+        with self._lock:
+            entry = self._entries.get(uniquifier)
+            if entry is not None and entry[1] > version:
+                return
+            self._entries[uniquifier] = (time.monotonic() + self.ttl, version, data)
+            self._entries.move_to_end(uniquifier)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _ensure_running(self) -> None:
+        # A thread started before a fork does not exist in the child
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._subscribed.clear()
+            self._entries.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="auth-cache", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                self._subscribed.set()
+                for message in pubsub.listen():
+                    uniquifier, version = message["data"].decode().split()
+                    self.put(uniquifier, int(version), None)
+            except Exception as e:
+                logger.error(f"Auth cache invalidation listener failed: {e}")
+            # Invalidations may have been missed while disconnected
+            self._subscribed.clear()
+            self.clear()
+            time.sleep(1)
+
+
+def _dump(user: User) -> dict:
+    data = {column: getattr(user, column) for column in COLUMNS}
+    data["roles"] = [
+        {column: getattr(role, column) for column in ROLE_COLUMNS}
+        for role in user.roles
+    ]
+    return data
+
+
+def _load(data: dict) -> User:
+    """Attach a cached user and their roles to the session without a query."""
+    roles = []
+    for role_data in data["roles"]:
+        role = Role(**role_data)
+        so.make_transient_to_detached(role)
+        roles.append(role)
+    user = User(**{column: data[column] for column in COLUMNS})
+    so.make_transient_to_detached(user)
+    so.attributes.set_committed_value(user, "roles", roles)
+    return db.session.merge(user, load=False)
+
+
+def find_user(uniquifier: str) -> Optional[User]:
+    """Return the user with this fs_uniquifier, from the cache if possible."""
+    local: LocalCache = current_app.extensions["auth_cache"]
+    data = local.get(uniquifier)
+    if data is not None:
+        metrics.AUTH_CACHE_LOOKUPS.labels("local").inc()
+        return _load(data)
+
+    redis = current_app.redis
+    cached, version = redis.mget(
+        USER_KEY.format(uniquifier), VERSION_KEY.format(uniquifier)
+    )
+    version = int(version or 0)
+    if cached is not None:
+        entry = json.loads(cached)
+        if entry["version"] == version:
+            metrics.AUTH_CACHE_LOOKUPS.labels("redis").inc()
+            local.put(uniquifier, version, entry["user"])
+            return _load(entry["user"])
+
+    metrics.AUTH_CACHE_LOOKUPS.labels("miss").inc()
+    user = db.session.scalar(
+        sa.select(User)
+        .where(User.fs_uniquifier == uniquifier)
+        .options(so.selectinload(User.roles))
+    )
+    if user is None:
+        return None
+    data = _dump(user)
+    redis.set(
+        USER_KEY.format(uniquifier),
+        json.dumps({"version": version, "user": data}),
+        ex=current_app.config["AUTH_CACHE_TTL"],
+    )
+    local.put(uniquifier, version, data)
+    return user
+
+
+def invalidate(uniquifiers: Iterable[str]) -> None:
+    """Evict users from Redis and from every process's cache."""
+    uniquifiers = list(uniquifiers)
+    if not uniquifiers:
+        return
+    redis = current_app.redis
+    # Outlives any entry read before the bump
+    expiry = current_app.config["AUTH_CACHE_TTL"] * 2
+    pipe = redis.pipeline()
+    for uniquifier in uniquifiers:
+        pipe.incr(VERSION_KEY.format(uniquifier))
+        pipe.expire(VERSION_KEY.format(uniquifier), expiry)
+        pipe.delete(USER_KEY.format(uniquifier))
+    versions = pipe.execute()[::3]
+    pipe = redis.pipeline()
+    for uniquifier, version in zip(uniquifiers, versions):
+        pipe.publish(CHANNEL, f"{uniquifier} {version}")
+    pipe.execute()
+    local = current_app.extensions.get("auth_cache")
+    if local is not None:
+        for uniquifier, version in zip(uniquifiers, versions):
+            local.put(uniquifier, version, None)
+
+
+def _changed(obj, attributes: Iterable[str]) -> bool:
+    state = sa.inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in attributes)
+
+
+@sa.event.listens_for(db.session, "before_flush")
+def _collect(session, flush_context, instances) -> None:
+    """Note users whose cached identity a flush changes."""
+    stale: Set[str] = session.info.setdefault("auth_cache_stale", set())
+    # Role.users is a query, which must not flush the session again
+    with session.no_autoflush:
+        for obj in session.dirty:
+            if isinstance(obj, User) and _changed(obj, WATCHED):
+                stale.add(obj.fs_uniquifier)
+                # The entry under the old uniquifier too
+                stale.update(sa.inspect(obj).attrs.fs_uniquifier.history.deleted)
+            elif isinstance(obj, Role) and _changed(obj, ROLE_COLUMNS):
+                stale.update(user.fs_uniquifier for user in obj.users)
+        for obj in session.deleted:
+            if isinstance(obj, User):
+                stale.add(obj.fs_uniquifier)
+            elif isinstance(obj, Role):
+                stale.update(user.fs_uniquifier for user in obj.users)
+
+
+@sa.event.listens_for(db.session, "after_commit")
+def _evict(session) -> None:
+    stale = session.info.pop("auth_cache_stale", None)
+    if stale and has_app_context():
+        try:
+            invalidate(stale)
+        except Exception as e:
+            logger.error(f"Could not evict {len(stale)} users from the auth cache: {e}")
+
+
+@sa.event.listens_for(db.session, "after_rollback")
+def _discard(session) -> None:
+    session.info.pop("auth_cache_stale", None)
+
+
+def request_loader(request) -> Optional[User]:
+    """Flask-Security's token request loader, with the user lookup cached."""
+    # Already verified, by Flask-Login or by @auth_token_required
+    if get_request_attr("fs_authn_via") == "token":
+        return g._login_user
+
+    token = request.args.get(
+        cv("TOKEN_AUTHENTICATION_KEY"),
+        request.headers.get(cv("TOKEN_AUTHENTICATION_HEADER")),
+    )
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        if isinstance(data, dict):
+            token = data.get(cv("TOKEN_AUTHENTICATION_KEY"), token)
+
+    try:
+        tdata = parse_auth_token(token)
+        user = find_user(tdata["uid"])
+    except Exception:
+        return None
+
+    if user and user.active and user.verify_auth_token(tdata):
+        set_request_attr("fs_authn_via", "token")
+        if cv("FRESHNESS_ALLOW_AUTH_TOKEN"):
+            set_request_attr("fs_paa", tdata.get("fs_paa", 0))
+        return user
+    return None
+
+
+def init_app(app) -> None:
+    """Cache the users of token-authenticated requests.
+
+    Tokens are still verified on every request; only loading the user and
+    their roles from the database is skipped.
+    """
+    if not app.config["AUTH_CACHE_ENABLED"]:
+        return
+    app.extensions["auth_cache"] = LocalCache(
+        app.redis, app.config["AUTH_CACHE_SIZE"], app.config["AUTH_CACHE_TTL"]
+    )
+    app.login_manager.request_loader(request_loader)
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint("cloudshell", __name__)
 
-from app.cloudshell import routes
+from app.cloudshell import routes, cli
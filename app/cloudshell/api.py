@@ -1,12 +1,23 @@
+import base64
+import json
+import time
+from datetime import datetime
+import sqlalchemy as sa
 from flask_security import (
     http_auth_required,
     auth_token_required,
+    current_user,
 )
-from flask import jsonify, request
-from app.extensions import client, logger, csrf
+from flask import Response, current_app, jsonify, request, stream_with_context
+from app.extensions import client, logger, csrf, db
+from app.models import Recording, Task
 from flask_restx import Resource as DefaultResource
 from flask_restx import Namespace, fields
 from docker.errors import NotFound
+from app.cloudshell import gateway, hibernate, inventory, pool
+from app.cloudshell.helpers import run_bulk
+from app.cloudshell.recording import Player
+from app import metering, progress
 
 api = Namespace("CloudShell", description="CloudShell related operations")
 
@@ -25,69 +36,91 @@ class createShell(Resource):
         body = request.get_json()
         key = body.get("ssh_key")
         try:
-            # Create container with SSH server and mapped port
-            container = client.containers.create(
-                "ubuntu",
-                ports={"22/tcp": None},
-                command="/bin/bash -c 'tail -f /dev/null'",  # Keep container running
-                detach=True,
-            )
-            container.start()
-
-            # Give container time to initialize
-            import time
-
-            time.sleep(2)
-
-            if container.status != "running":
-                raise Exception(f"Container {container.id} failed to start.")
-
-            # Install and configure SSH
-            commands = [
-                "apt-get update",
-                "apt-get install -y openssh-server sudo",
-                "mkdir -p /root/.ssh",  # Ensure .ssh directory exists
-                "ssh-keygen -A",
-                f'echo "root:{container.id}" | chpasswd',
-                "service ssh start",
-            ]
-
-            if key:
-                commands.extend(
-                    [
-                        "chmod 700 /root/.ssh",
-                        f'echo "{key}" > /root/.ssh/authorized_keys',
-                        "chmod 600 /root/.ssh/authorized_keys",
-                    ]
+            task = current_user.launch_task("tasks.create_shell", "Create shell", key)
+            return {"status": "queued", "task_id": task.id}, 202
+        except Exception as e:
+            logger.error(f"Error creating container: {e}")
+            return {"status": "error", "message": str(e)}, 500
+
+
+api.add_resource(createShell, "/create")
+
+
+class taskList(Resource):
+    def get(self):
+        """List the user's tasks, newest first, a page at a time.
+
+        Pass the returned `next` cursor as `before` to get the following page.
+        """
+        complete = {"in_progress": False, "complete": True}.get(
+            request.args.get("status")
+        )
+        page_size = current_app.config["TASK_PAGE_SIZE"]
+        limit = min(max(request.args.get("limit", page_size, type=int), 1), page_size)
+        before = None
+        if request.args.get("before"):
+            try:
+                created_at, task_id = (
+                    base64.urlsafe_b64decode(request.args["before"])
+                    .decode()
+                    .split("|", 1)
                 )
+                before = (datetime.fromisoformat(created_at), task_id)
+            except ValueError:
+                return {"status": "error", "message": "Invalid cursor"}, 400
+
+        tasks = current_user.get_tasks(complete, before, limit)
+        next_cursor = None
+        if len(tasks) == limit:
+            last = tasks[-1]
+            next_cursor = base64.urlsafe_b64encode(
+                f"{last.created_at.isoformat()}|{last.id}".encode()
+            ).decode()
+        return {"tasks": Task.get_statuses(tasks), "next": next_cursor}
 
-            for cmd in commands:
-                result = container.exec_run(
-                    cmd, environment={"DEBIAN_FRONTEND": "noninteractive"}
+
+api.add_resource(taskList, "/tasks")
+
+
+class shellTask(Resource):
+    def get(self, task_id):
+        task = db.session.get(Task, task_id)
+        if task is None or task.user_id != current_user.id:
+            return {"status": "error", "message": "Task not found"}, 404
+        return task.get_status()
+
+
+api.add_resource(shellTask, "/tasks/<string:task_id>")
+
+
+class taskEvents(Resource):
+    def get(self):
+        """Stream progress of the user's tasks, or of the given task_id(s), as SSE."""
+        task_ids = request.args.getlist("task_id")
+        if task_ids:
+            owned = db.session.scalars(
+                sa.select(Task.id).where(
+                    Task.id.in_(task_ids), Task.user_id == current_user.id
                 )
-                if result.exit_code != 0:
-                    raise Exception(
-                        f"Command failed: {cmd} with error: {result.output.decode()}"
-                    )
-
-            port = container.attrs["NetworkSettings"]["Ports"]["22/tcp"][0]["HostPort"]
-
-            return jsonify(
-                {
-                    "status": "success",
-                    "port": port,
-                    "container_id": container.id,
-                    "user": "root",
-                    "password": container.id,
-                }
-            )
+            ).all()
+            if len(owned) != len(set(task_ids)):
+                return {"status": "error", "message": "Task not found"}, 404
 
-        except Exception as e:
-            logger.error(f"Error creating container: {e}")
-            return jsonify({"status": "error", "message": str(e)}), 500
+        def events(user_id):
+            for state in progress.listen(user_id, task_ids):
+                if state is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: progress\ndata: {json.dumps(state)}\n\n"
 
+        return Response(
+            stream_with_context(events(current_user.id)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
-api.add_resource(createShell, "/create")
+
+api.add_resource(taskEvents, "/tasks/events")
 
 
 class deleteShell(Resource):
@@ -99,9 +132,13 @@ class deleteShell(Resource):
                     {"status": "error", "message": "No container ID provided"}
                 ), 400
 
-            container = client.containers.get(container_id)
-            container.stop()
-            container.remove()
+            if inventory.owner(container_id) != current_user.id:
+                raise NotFound("Container not found")
+
+            docker_client = inventory.docker(container_id)
+            docker_client.api.stop(container_id)
+            docker_client.api.remove_container(container_id)
+            inventory.update(container_id, status="removed")
             return jsonify({"status": "success", "message": "Container deleted"})
 
         except NotFound:
@@ -112,3 +149,160 @@ class deleteShell(Resource):
 
 
 api.add_resource(deleteShell, "/delete/<string:container_id>")
+
+
+class shellStatus(Resource):
+    def get(self, container_id):
+        entry = inventory.get(container_id)
+        if entry is None or entry.get("user_id") != str(current_user.id):
+            return {"status": "error", "message": "Container not found"}, 404
+        return {
+            "container_id": container_id,
+            "status": entry.get("status"),
+            **gateway.login(container_id),
+        }
+
+
+api.add_resource(shellStatus, "/status/<string:container_id>")
+
+
+class resumeShell(Resource):
+    def post(self, container_id):
+        if inventory.owner(container_id) != current_user.id:
+            return {"status": "error", "message": "Container not found"}, 404
+        try:
+            hibernate.resume(container_id)
+        except Exception as e:
+            logger.error(f"Error resuming container: {e}")
+            return {"status": "error", "message": str(e)}, 500
+        return {
+            "status": "success",
+            "container_id": container_id,
+            **gateway.login(container_id),
+        }
+
+
+api.add_resource(resumeShell, "/resume/<string:container_id>")
+
+
+class bulkCreate(Resource):
+    def post(self):
+        body = request.get_json() or {}
+        count = body.get("count")
+        if not isinstance(count, int) or not (
+            0 < count <= current_app.config["CLOUDSHELL_BULK_MAX_ITEMS"]
+        ):
+            return {"status": "error", "message": "Invalid count"}, 400
+        task = current_user.launch_task(
+            "tasks.create_shells", "Create shells", count, body.get("ssh_key")
+        )
+        return {"status": "queued", "task_id": task.id}, 202
+
+
+api.add_resource(bulkCreate, "/bulk/create")
+
+
+class bulkAction(Resource):
+    def post(self, action):
+        body = request.get_json() or {}
+        container_ids = body.get("container_ids")
+        if not isinstance(container_ids, list) or not container_ids:
+            return {"status": "error", "message": "No container IDs provided"}, 400
+        if len(container_ids) > current_app.config["CLOUDSHELL_BULK_MAX_ITEMS"]:
+            return {"status": "error", "message": "Too many container IDs"}, 400
+
+        results = run_bulk(action, [str(cid) for cid in container_ids], current_user.id)
+        failed = sum(1 for result in results if result["status"] != "success")
+        return {
+            "status": "success" if not failed else "partial",
+            "succeeded": len(results) - failed,
+            "failed": failed,
+            "results": results,
+        }
+
+
+api.add_resource(bulkAction, "/bulk/<any(start, stop, delete):action>")
+
+
+class recordingList(Resource):
+    def get(self):
+        query = sa.select(Recording).where(Recording.user_id == current_user.id)
+        if request.args.get("container_id"):
+            query = query.where(Recording.container_id == request.args["container_id"])
+        recordings = db.session.scalars(query.order_by(Recording.started_at.desc()))
+        return {"recordings": [recording.to_dict() for recording in recordings]}
+
+
+api.add_resource(recordingList, "/recordings")
+
+
+class recordingEvents(Resource):
+    def get(self, recording_id):
+        recording = db.session.get(Recording, recording_id)
+        if recording is None or recording.user_id != current_user.id:
+            return {"status": "error", "message": "Recording not found"}, 404
+        start = request.args.get("start", 0, type=int)
+        end = request.args.get("end", type=int)
+        limit = current_app.config["CLOUDSHELL_RECORDING_PAGE_SIZE"]
+
+        # Event data is base64 encoded, as output may split UTF-8 sequences
+        events = []
+        next_start = None
+        try:
+            player = Player(recording_id)
+        except FileNotFoundError:
+            return {"status": "error", "message": "Recording file not found"}, 404
+        except ValueError as e:
+            logger.error(f"Could not read recording {recording_id}: {e}")
+            return {"status": "error", "message": "Recording is unreadable"}, 500
+        try:
+            for at, kind, data in player.events(start, end):
+                # Only stop between milliseconds so the next page starts cleanly
+                if len(events) >= limit and at != events[-1][0]:
+                    next_start = at
+                    break
+                events.append([at, kind, base64.b64encode(data).decode()])
+        finally:
+            player.close()
+        return {**recording.to_dict(), "events": events, "next": next_start}
+
+
+api.add_resource(recordingEvents, "/recordings/<string:recording_id>")
+
+
+class usageHistory(Resource):
+    def get(self):
+        """Return the user's balance and metered usage, by default for a day."""
+        until = request.args.get("until", type=float)
+        since = request.args.get("since", (until or time.time()) - 86400, type=float)
+        return {
+            "balance": current_user.balance or 0.0,
+            "usage": metering.history(current_user.id, since, until),
+        }
+
+
+api.add_resource(usageHistory, "/usage")
+
+
+class poolStats(Resource):
+    def get(self):
+        return jsonify(pool.stats())
+
+
+api.add_resource(poolStats, "/pool")
+
+
+class gatewayStats(Resource):
+    def get(self):
+        return gateway.stats()
+
+
+api.add_resource(gatewayStats, "/gateway")
+
+
+class dockerStats(Resource):
+    def get(self):
+        return client.stats()
+
+
+api.add_resource(dockerStats, "/docker")
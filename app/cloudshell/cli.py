@@ -0,0 +1,128 @@
+import click
+from flask import current_app
+from app import email, metering, metrics, profiling, progress
+from app.cloudshell import bp, gateway, hibernate, images, inventory, terminal
+
+
+@bp.cli.command("sync-inventory")
+def sync_inventory():
+    """Keep the container inventory in sync with the Docker daemon."""
+    inventory.sync()
+
+
+@bp.cli.command("reconcile")
+def reconcile():
+    """Reconcile the Container table with the Docker daemon once."""
+    print(inventory.reconcile())
+
+
+@bp.cli.command("hibernate-idle")
+def hibernate_idle():
+    """Hibernate shells that have been idle for too long."""
+    print(f"Hibernated {hibernate.check_idle()} containers")
+
+
+@bp.cli.command("gateway")
+def run_gateway():
+    """Run the SSH gateway that forwards logins to shells."""
+    gateway.Gateway(current_app._get_current_object()).serve()
+
+
+@bp.cli.command("terminal")
+def run_terminal():
+    """Run the WebSocket proxy behind the browser terminal."""
+    terminal.TerminalProxy(current_app._get_current_object()).serve()
+
+
+@bp.cli.command("worker")
+def run_worker():
+    """Run an RQ worker for the task queue.
+
+    The task module is imported before the worker starts, so the process
+    forked for each job already has the app loaded.
+    """
+    import app.tasks  # noqa: F401
+    from rq import Worker
+
+    class TimedWorker(Worker):
+        def handle_job_success(self, job, *args, **kwargs):
+            super().handle_job_success(job, *args, **kwargs)
+            metrics.observe_job(job, "finished")
+
+        def handle_job_failure(self, job, *args, **kwargs):
+            super().handle_job_failure(job, *args, **kwargs)
+            metrics.observe_job(job, "failed")
+
+        def monitor_work_horse(self, job, queue):
+            pid = self.horse_pid
+            try:
+                super().monitor_work_horse(job, queue)
+            finally:
+                # Each job runs in its own forked work-horse, gone by now
+                metrics.mark_dead(pid)
+
+    metrics.serve(current_app.config["METRICS_PORT"])
+    TimedWorker([current_app.task_queue], connection=current_app.redis).work(
+        with_scheduler=True
+    )
+
+
+@bp.cli.command("progress")
+def persist_progress():
+    """Write task phase changes published by workers to the database."""
+    progress.persist(current_app.config["TASK_PROGRESS_FLUSH_INTERVAL"])
+
+
+@bp.cli.command("meter")
+def run_metering():
+    """Meter the containers on this Docker host and debit their owners."""
+    metering.run()
+
+
+@bp.cli.command("mailer")
+def run_mailer():
+    """Send queued mail, keeping the SMTP connection open between messages."""
+    metrics.serve(current_app.config["METRICS_PORT"])
+    email.Mailer().run()
+
+
+@bp.cli.command("profiling")
+@click.argument("state", type=click.Choice(["on", "off"]))
+@click.option("--minutes", default=10, help="Turn profiling off again after this.")
+def toggle_profiling(state, minutes):
+    """Profile every /cloudshell and /api request, or stop doing so."""
+    if state == "on":
+        profiling.enable(minutes * 60)
+        print(f"Profiling requests for {minutes} minutes")
+    else:
+        profiling.disable()
+        print("Profiling off")
+
+
+@bp.cli.command("profiles")
+@click.option("--limit", default=20)
+def list_profiles(limit):
+    """List recent request profiles and where their time went."""
+    for profile in profiling.recent(limit):
+        breakdown = ", ".join(f"{k} {v}ms" for k, v in profile["breakdown_ms"].items())
+        print(
+            f"{profile['id']}  {profile['duration_ms']:>8.1f}ms  {profile['status']}"
+            f"  {profile['method']} {profile['path']}  ({breakdown})"
+        )
+
+
+@bp.cli.command("profile")
+@click.argument("profile_id")
+def show_profile(profile_id):
+    """Print a profile's collapsed stacks, e.g. for flamegraph.pl."""
+    profile = profiling.get(profile_id)
+    if profile is None:
+        raise click.ClickException(f"No profile {profile_id}")
+    print(profile["stacks"])
+
+
+@bp.cli.command("prepull")
+def prepull():
+    """Enqueue the image pre-pull job now, ignoring the interval."""
+    current_app.redis.delete(images.PREPULL_KEY)
+    print("Enqueued" if images.schedule_prepull() else "Pre-pull is disabled")
@@ -0,0 +1,474 @@
+import base64
+import os
+import select
+import socket
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Union
+import paramiko
+import sqlalchemy as sa
+from flask import Flask, current_app
+from app.extensions import logger, db
+from app.models import Container, SSHKey, User
+from app.cloudshell import hibernate, inventory
+from app.cloudshell.recording import INPUT, OUTPUT, Recorder
+
+STATS_KEY = "cloudshell:gateway:stats"
+
+# Shells are addressed by the first characters of their container ID, like
+# `ssh -p 2222 <id>@gateway`
+SHORT_ID_LENGTH = 12
+BUFFER_SIZE = 32768
+
+_keys: Dict[str, paramiko.PKey] = {}
+_keys_lock = threading.Lock()
+
+
+def _load_key(name: str) -> paramiko.PKey:
+    """Load a private key from the instance folder, creating it on first use."""
+    path = os.path.join(current_app.instance_path, current_app.config[name])
+    with _keys_lock:
+        if path not in _keys:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.tmp"
+                paramiko.RSAKey.generate(3072).write_private_key_file(tmp)
+                # Linking fails if another process created the key first
+                try:
+                    os.link(tmp, path)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.unlink(tmp)
+            _keys[path] = paramiko.RSAKey.from_private_key_file(path)
+    return _keys[path]
+
+
+def public_key() -> str:
+    """Return the key the gateway logs into shells with, in authorized_keys format."""
+    key = _load_key("CLOUDSHELL_GATEWAY_CLIENT_KEY")
+    return f"{key.get_name()} {key.get_base64()} ucloudshell-gateway"
+
+
+def login(container_id: str) -> Dict[str, Union[str, int]]:
+    """Return the user name and port to SSH into a shell through the gateway."""
+    return {
+        "user": container_id[:SHORT_ID_LENGTH],
+        "port": current_app.config["CLOUDSHELL_GATEWAY_PORT"],
+    }
+
+
+def parse_host_key(line: str) -> paramiko.PKey:
+    """Parse a public key recorded as "<type> <base64>"."""
+    key_type, key_data = line.split()[:2]
+    return paramiko.PKey.from_type_string(key_type, base64.b64decode(key_data))
+
+
+def resolve(username: str) -> Optional[Container]:
+    """Find the shell addressed by an SSH user name (a container ID prefix)."""
+    if len(username) < SHORT_ID_LENGTH:
+        return None
+    rows = db.session.scalars(
+        sa.select(Container)
+        .where(
+            Container.container_id.startswith(username, autoescape=True),
+            Container.status != "removed",
+        )
+        .limit(2)
+    ).all()
+    return rows[0] if len(rows) == 1 else None
+
+
+def stats() -> Dict[str, Union[int, float]]:
+    """Return session counts, connection reuse and average connect latency."""
+    raw = current_app.redis.hgetall(STATS_KEY)
+    sessions = int(raw.get(b"sessions", 0))
+    reused = int(raw.get(b"reused", 0))
+    connect_seconds = float(raw.get(b"connect_seconds", 0))
+    return {
+        "sessions": sessions,
+        "active": int(raw.get(b"active", 0)),
+        "failures": int(raw.get(b"failures", 0)),
+        "reuse_ratio": reused / sessions if sessions else 0.0,
+        "avg_connect_ms": connect_seconds / sessions * 1000 if sessions else 0.0,
+    }
+
+
+@dataclass
+class Session:
+    """A client's session channel and what it asked to run."""
+
+    pty: Optional[Tuple[str, int, int]] = None
+    request: Optional[Tuple[str, Optional[bytes]]] = None
+    requested: threading.Event = field(default_factory=threading.Event)
+    upstream: Optional[paramiko.Channel] = None
+    recorder: Optional[Recorder] = None
+
+
+class GatewayServer(paramiko.ServerInterface):
+    """Authenticates one client connection against the shell owner's SSH keys.
+
+    Only public keys are accepted. A password alone would skip the second
+    factor the web login asks for.
+    """
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.container_id: Optional[str] = None
+        self.sessions: Dict[int, Session] = {}
+
+    def _owner(self, username: str) -> Optional[Tuple[Container, User]]:
+        shell = resolve(username)
+        if shell is None or shell.user is None or not shell.user.active:
+            return None
+        return shell, shell.user
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        with self.app.app_context():
+            owner = self._owner(username)
+            if owner is None:
+                return paramiko.AUTH_FAILED
+            match = db.session.scalar(
+                sa.select(SSHKey.id).where(
+                    SSHKey.user_id == owner[1].id,
+                    SSHKey.key_data == key.get_base64(),
+                )
+            )
+            if match is None:
+                return paramiko.AUTH_FAILED
+            self.container_id = owner[0].container_id
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != "session":
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        self.sessions[chanid] = Session()
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(
+        self, channel, term, width, height, pixelwidth, pixelheight, modes
+    ):
+        self.sessions[channel.get_id()].pty = (term.decode(), width, height)
+        return True
+
+    def _request(self, channel, kind, arg=None):
+        session = self.sessions[channel.get_id()]
+        if session.request is not None:
+            return False
+        session.request = (kind, arg)
+        session.requested.set()
+        return True
+
+    def check_channel_shell_request(self, channel):
+        return self._request(channel, "shell")
+
+    def check_channel_exec_request(self, channel, command):
+        return self._request(channel, "exec", command)
+
+    def check_channel_subsystem_request(self, channel, name):
+        return self._request(channel, "subsystem", name)
+
+    def check_channel_window_change_request(
+        self, channel, width, height, pixelwidth, pixelheight
+    ):
+        session = self.sessions[channel.get_id()]
+        if session.recorder is not None and session.recorder.resize(height, width):
+            # Flushed in order with the output recorded by the pump thread
+            session.recorder.flush()
+        if session.upstream is not None:
+            session.upstream.resize_pty(width, height)
+        elif session.pty is not None:
+            session.pty = (session.pty[0], width, height)
+        return True
+
+
+class Upstreams:
+    """SSH connections from the gateway to shells, shared between sessions.
+
+    Every session to a shell is a channel on one connection, so only the
+    first session pays for the TCP and SSH handshakes. A connection is
+    closed once it has had no channels for CLOUDSHELL_GATEWAY_LINGER seconds,
+    so it does not keep a hibernating shell awake.
+    """
+
+    def __init__(self, connect_timeout: int, linger: int):
+        self.connect_timeout = connect_timeout
+        self.linger = linger
+        self._lock = threading.Lock()
+        self._transports: Dict[str, List[paramiko.Transport]] = {}
+        self._channels: Dict[paramiko.Transport, int] = {}
+        self._idle_since: Dict[paramiko.Transport, float] = {}
+
+    def _connect(
+        self, address: Tuple[str, int], key: paramiko.PKey, host_key: paramiko.PKey
+    ):
+        sock = socket.create_connection(address, timeout=self.connect_timeout)
+        transport = paramiko.Transport(sock)
+        # Ask for the type of key that was recorded, then require that key
+        transport.get_security_options().key_types = [host_key.get_name()]
+        try:
+            transport.connect(hostkey=host_key, username="root", pkey=key)
+        except Exception:
+            # Also closes the socket
+            transport.close()
+            raise
+        return transport
+
+    def open(
+        self,
+        container_id: str,
+        address: Tuple[str, int],
+        key: paramiko.PKey,
+        host_key: paramiko.PKey,
+    ) -> Tuple[paramiko.Channel, paramiko.Transport, bool]:
+        """Open a session channel to a shell.
+
+        New connections are refused unless the shell presents `host_key`.
+
+        Returns:
+            Tuple[paramiko.Channel, paramiko.Transport, bool]: The channel,
+            the connection it belongs to and whether that connection was reused.
+        """
+        with self._lock:
+            transports = [
+                t for t in self._transports.get(container_id, []) if t.is_active()
+            ]
+            self._transports[container_id] = transports
+            transport = transports[0] if transports else None
+            if transport is not None:
+                # Claim a slot now so the reaper cannot close it under us
+                self._channels[transport] += 1
+                self._idle_since.pop(transport, None)
+
+        if transport is not None:
+            try:
+                return (
+                    transport.open_session(timeout=self.connect_timeout),
+                    transport,
+                    True,
+                )
+            except paramiko.SSHException:
+                # The connection died or hit sshd's MaxSessions
+                self.release(transport)
+
+        transport = self._connect(address, key, host_key)
+        try:
+            channel = transport.open_session(timeout=self.connect_timeout)
+        except Exception:
+            transport.close()
+            raise
+        with self._lock:
+            self._transports.setdefault(container_id, []).insert(0, transport)
+            self._channels[transport] = 1
+        return channel, transport, False
+
+    def release(self, transport: paramiko.Transport) -> None:
+        """Return a channel's slot, starting the linger timer on the last one."""
+        with self._lock:
+            self._channels[transport] -= 1
+            if self._channels[transport] <= 0:
+                self._idle_since[transport] = time.monotonic()
+
+    def reap(self) -> int:
+        """Close connections that were unused for longer than the linger time."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                t
+                for t, since in self._idle_since.items()
+                if now - since > self.linger or not t.is_active()
+            ]
+            for transport in expired:
+                del self._idle_since[transport]
+                del self._channels[transport]
+                for transports in self._transports.values():
+                    if transport in transports:
+                        transports.remove(transport)
+            self._transports = {k: v for k, v in self._transports.items() if v}
+        for transport in expired:
+            transport.close()
+        return len(expired)
+
+
+def _pipe(
+    downstream: paramiko.Channel,
+    upstream: paramiko.Channel,
+    recorder: Optional[Recorder] = None,
+) -> None:
+    """Copy data both ways until the shell side closes."""
+
+    def record(kind: bytes, data: bytes) -> None:
+        if recorder is not None and recorder.record(kind, data):
+            recorder.flush()
+
+    readers = [downstream, upstream]
+    while True:
+        readable, _, _ = select.select(readers, [], [], 1.0)
+        if downstream in readable:
+            data = downstream.recv(BUFFER_SIZE)
+            if data:
+                upstream.sendall(data)
+                record(INPUT, data)
+            else:
+                upstream.shutdown_write()
+                readers.remove(downstream)
+        if upstream in readable:
+            while upstream.recv_stderr_ready():
+                data = upstream.recv_stderr(BUFFER_SIZE)
+                downstream.sendall_stderr(data)
+                record(OUTPUT, data)
+            if upstream.recv_ready() or upstream.eof_received:
+                data = upstream.recv(BUFFER_SIZE)
+                if not data:
+                    return
+                downstream.sendall(data)
+                record(OUTPUT, data)
+        if downstream.closed or upstream.closed:
+            return
+
+
+class Gateway:
+    """Accepts SSH clients on one port and forwards them to their shells."""
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.upstreams = Upstreams(
+            app.config["CLOUDSHELL_GATEWAY_CONNECT_TIMEOUT"],
+            app.config["CLOUDSHELL_GATEWAY_LINGER"],
+        )
+        with app.app_context():
+            self.host_key = _load_key("CLOUDSHELL_GATEWAY_HOST_KEY")
+            self.client_key = _load_key("CLOUDSHELL_GATEWAY_CLIENT_KEY")
+
+    def serve(self) -> None:
+        """Accept connections until interrupted."""
+        address = (
+            self.app.config["CLOUDSHELL_GATEWAY_BIND"],
+            self.app.config["CLOUDSHELL_GATEWAY_PORT"],
+        )
+        listener = socket.create_server(address, backlog=128, reuse_port=True)
+        threading.Thread(target=self._reap_forever, daemon=True).start()
+        logger.info(f"SSH gateway listening on {address[0]}:{address[1]}")
+        while True:
+            sock, peer = listener.accept()
+            threading.Thread(target=self.handle, args=(sock, peer), daemon=True).start()
+
+    def _reap_forever(self) -> None:
+        while True:
+            time.sleep(max(self.upstreams.linger / 2, 1))
+            self.upstreams.reap()
+
+    def handle(self, sock: socket.socket, peer: Tuple[str, int]) -> None:
+        """Run one client connection, forwarding each of its sessions."""
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        server = GatewayServer(self.app)
+        try:
+            transport.start_server(server=server)
+            while transport.is_active():
+                channel = transport.accept(timeout=1)
+                if channel is None:
+                    continue
+                session = server.sessions[channel.get_id()]
+                threading.Thread(
+                    target=self.forward,
+                    args=(channel, session, server.container_id),
+                    daemon=True,
+                ).start()
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            logger.info(f"Gateway connection from {peer[0]} closed: {e}")
+        finally:
+            transport.close()
+
+    def _stat(self, **counters: Union[int, float]) -> None:
+        with self.app.app_context():
+            pipe = current_app.redis.pipeline()
+            for name, value in counters.items():
+                if isinstance(value, float):
+                    pipe.hincrbyfloat(STATS_KEY, name, value)
+                else:
+                    pipe.hincrby(STATS_KEY, name, value)
+            pipe.execute()
+
+    def _address(self, container_id: str) -> Tuple[Tuple[str, int], paramiko.PKey]:
+        """Return a shell's address and the host key it must present."""
+        with self.app.app_context():
+            # Wake the shell up if it was hibernated while idle
+            entry = hibernate.resume(container_id)
+            if entry is None:
+                raise Exception("Container not found")
+            if not entry.get("host_key"):
+                raise Exception("No host key was recorded for the container")
+            if not entry.get("ip"):
+                entry.update(inventory.refresh(container_id))
+            return (entry["ip"], int(entry["port"])), parse_host_key(entry["host_key"])
+
+    def forward(
+        self, channel: paramiko.Channel, session: Session, container_id: str
+    ) -> None:
+        """Connect a client session to its shell and copy data until it ends."""
+        if not session.requested.wait(30):
+            channel.close()
+            return
+
+        started = time.perf_counter()
+        try:
+            address, host_key = self._address(container_id)
+            upstream, transport, reused = self.upstreams.open(
+                container_id, address, self.client_key, host_key
+            )
+        except Exception as e:
+            logger.error(f"Gateway could not reach container {container_id}: {e}")
+            self._stat(failures=1)
+            channel.sendall_stderr(b"Shell is unavailable\r\n")
+            channel.send_exit_status(255)
+            channel.close()
+            return
+
+        try:
+            if session.pty is not None:
+                upstream.get_pty(*session.pty)
+            session.upstream = upstream
+            kind, arg = session.request
+            if kind == "shell":
+                upstream.invoke_shell()
+            elif kind == "exec":
+                upstream.exec_command(arg)
+            else:
+                upstream.invoke_subsystem(arg)
+
+            latency = time.perf_counter() - started
+            logger.info(
+                f"Gateway session to {container_id} ready in {latency * 1000:.1f}ms"
+                f"{' (reused connection)' if reused else ''}"
+            )
+            self._stat(
+                sessions=1, active=1, reused=int(reused), connect_seconds=latency
+            )
+            # Interactive logins are recorded, file transfers and commands are not
+            if kind == "shell" and self.app.config["CLOUDSHELL_RECORDING_ENABLED"]:
+                with self.app.app_context():
+                    session.recorder = Recorder(
+                        container_id, inventory.owner(container_id), "ssh"
+                    )
+                if session.pty is not None:
+                    session.recorder.resize(session.pty[2], session.pty[1])
+            try:
+                _pipe(channel, upstream, session.recorder)
+                if not channel.closed and upstream.status_event.wait(5):
+                    channel.send_exit_status(upstream.recv_exit_status())
+            finally:
+                self._stat(active=-1)
+                if session.recorder is not None:
+                    with self.app.app_context():
+                        session.recorder.close()
+        except (paramiko.SSHException, OSError) as e:
+            logger.info(f"Gateway session to {container_id} ended: {e}")
+        finally:
+            upstream.close()
+            channel.close()
+            self.upstreams.release(transport)
@@ -1,8 +1,27 @@
 from app.extensions import logger, client
 from docker.errors import NotFound
 from docker.models.containers import Container, ExecResult
-from typing import Optional, Union, Dict
-from rq import Retry
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Union, Dict, List
+from flask import current_app
+from app import metrics
+from app.cloudshell import gateway, inventory, readiness, scheduler
+from app.cloudshell.inventory import SHELL_LABEL
+from app.cloudshell.images import shell_image
+
+# sshd's host key, generated on a container's first start so the gateway can
+# tell shells apart, and kept when it is resumed from hibernation
+HOST_KEY_PATH = "/etc/ssh/ssh_host_ed25519_key"
+# sshd runs as part of the container command, the rest is baked into the image
+SHELL_COMMAND = (
+    f"/bin/bash -c \"([ -f {HOST_KEY_PATH} ] || ssh-keygen -q -t ed25519 -N ''"
+    f' -f {HOST_KEY_PATH}) && service ssh start && tail -f /dev/null"'
+)
+# Port sshd listens on inside the shell, reached by the gateway only
+SSH_PORT = 22
+
+# Progress reported for each provisioning phase
+PHASES = {"create": 10, "start": 40, "configure": 70, "ready": 100}
 
 
 def ensure_wireguard_container() -> Union[Container, None]:
@@ -36,75 +55,228 @@ def ensure_wireguard_container() -> Union[Container, None]:
         raise
 
 
-def create(
-    key: Optional[str], interval: int
-) -> Union[Dict[str, Union[str, int]], Retry]:
-    """Create a new container with an SSH server and configure it.
+def run_commands(container: Container, commands: List[str]) -> None:
+    """Run shell commands in a container, stopping at the first failure.
 
     Args:
-        key (Optional[str]): SSH public key for authentication.
+        container (Container): The container to run the commands in.
+        commands (List[str]): Commands to run, in order.
+    """
+    for cmd in commands:
+        # Named by program only, as arguments can hold secrets
+        with metrics.phase(f"exec:{cmd.split()[0]}"):
+            result: ExecResult = container.exec_run(
+                cmd, environment={"DEBIAN_FRONTEND": "noninteractive"}
+            )
+        if result.exit_code != 0:
+            raise Exception(
+                f"Command failed: {cmd} with error: {result.output.decode()}"
+            )
+
+
+def user_commands(password: str, key: Optional[str]) -> List[str]:
+    """Build the per-user commands run when a shell is handed out.
+
+    Args:
+        password (str): Root password for the shell.
+        key (Optional[str]): SSH public key allowed to log in as root.
 
     Returns:
-        Dict[str, Union[str, int]]: Information about the created container.
+        List[str]: Commands setting the password and authorized keys.
     """
-    try:
-        # Create container with SSH server and mapped port
-        container: Container = client.containers.create(
-            "ubuntu",
-            ports={"22/tcp": None},
-            command="/bin/bash -c 'tail -f /dev/null'",  # Keep container running
+    commands = [f'echo "root:{password}" | chpasswd']
+    if key:
+        commands.extend(
+            [
+                "chmod 700 /root/.ssh",
+                f'echo "{key}" > /root/.ssh/authorized_keys',
+                "chmod 600 /root/.ssh/authorized_keys",
+            ]
+        )
+    return commands
+
+
+def host_key(container: Container) -> str:
+    """Read a shell's public host key, as "<type> <base64>", over the Docker API."""
+    result: ExecResult = container.exec_run(f"cat {HOST_KEY_PATH}.pub")
+    if result.exit_code != 0:
+        raise Exception(f"Could not read the host key: {result.output.decode()}")
+    key_type, key_data = result.output.decode().split()[:2]
+    return f"{key_type} {key_data}"
+
+
+def provision_container(
+    on_phase: Optional[Callable[[str], None]] = None,
+) -> Container:
+    """Create and start an unassigned shell container.
+
+    Args:
+        on_phase (Optional[Callable[[str], None]]): Called with each phase name.
+
+    Returns:
+        Container: A running container with an SSH server.
+    """
+    if on_phase:
+        on_phase("create")
+    with metrics.phase("place"):
+        host = scheduler.place()
+    with metrics.phase("create"):
+        # Create container with SSH server, reachable through the gateway only
+        container: Container = client.for_host(host).containers.create(
+            shell_image(host),
+            network=current_app.config["CLOUDSHELL_NETWORK"],
+            command=SHELL_COMMAND,
+            labels={SHELL_LABEL: "1"},
             detach=True,
         )
-        container.start()
-
-        # Give container time to initialize
-        import time
-
-        time.sleep(2)
-
-        if container.status != "running":
-            raise Exception(f"Container {container.id} failed to start.")
-
-        # Install and configure SSH
-        commands = [
-            "apt-get update",
-            "apt-get install -y openssh-server sudo",
-            "mkdir -p /root/.ssh",  # Ensure .ssh directory exists
-            "ssh-keygen -A",
-            f'echo "root:{container.id}" | chpasswd',
-            "service ssh start",
-        ]
-
-        if key:
-            commands.extend(
-                [
-                    "chmod 700 /root/.ssh",
-                    f'echo "{key}" > /root/.ssh/authorized_keys',
-                    "chmod 600 /root/.ssh/authorized_keys",
-                ]
-            )
+    inventory.annotate(container.id, host=host)
+    if on_phase:
+        on_phase("start")
+    # Register before starting so the ready event cannot be missed
+    waiter = readiness.expect(container.id, host)
+    try:
+        with metrics.phase("start"):
+            container.start()
+        with metrics.phase("wait"):
+            waiter.wait(current_app.config["CLOUDSHELL_READY_TIMEOUT"])
+    except Exception:
+        discard_container(container.id or "")
+        raise
 
-        for cmd in commands:
-            result: ExecResult = container.exec_run(
-                cmd, environment={"DEBIAN_FRONTEND": "noninteractive"}
-            )
-            if result.exit_code != 0:
-                raise Exception(
-                    f"Command failed: {cmd} with error: {result.output.decode()}"
-                )
-
-        # Extract the mapped SSH port
-        port = container.attrs["NetworkSettings"]["Ports"]["22/tcp"][0]["HostPort"]
-
-        return {
-            "status": "success",
-            "port": int(port),
-            "container_id": container.id or "",
-            "user": "root",
-            "password": container.id or "",
-        }
+    return container
+
+
+def assign_container(container: Container) -> Dict[str, Union[str, int]]:
+    """Configure a provisioned container for a user.
+
+    Only the SSH gateway's key may log in; users authenticate at the gateway,
+    which checks the shell's host key read here.
+
+    Args:
+        container (Container): A container from `provision_container`.
 
+    Returns:
+        Dict[str, Union[str, int]]: Information about the container, with
+        the user name and port to log in through the gateway.
+    """
+    with metrics.phase("configure"):
+        run_commands(container, user_commands(container.id or "", gateway.public_key()))
+        key = host_key(container)
+
+    container.reload()
+    inventory.annotate(container.id, ip=inventory.address(container.attrs))
+
+    return {
+        "status": "success",
+        "container_id": container.id or "",
+        "host": inventory.host(container.id),
+        "host_key": key,
+        **gateway.login(container.id or ""),
+    }
+
+
+def create_shell(
+    on_phase: Optional[Callable[[str], None]] = None,
+) -> Dict[str, Union[str, int]]:
+    """Hand out a shell, from the warm pool when one is ready.
+
+    Args:
+        on_phase (Optional[Callable[[str], None]]): Called with each phase name.
+
+    Returns:
+        Dict[str, Union[str, int]]: Information about the container.
+    """
+    from app.cloudshell import pool
+
+    with metrics.phase("claim"):
+        container = pool.claim()
+    if container is None:
+        container = provision_container(on_phase)
+    if on_phase:
+        on_phase("configure")
+    try:
+        return assign_container(container)
+    except Exception:
+        discard_container(container.id or "")
+        raise
+
+
+def discard_container(container_id: str) -> None:
+    """Remove a shell that was not handed out, rather than wait for reconcile.
+
+    Reconcile would only remove it as an orphan once its claim and
+    CLOUDSHELL_ORPHAN_GRACE have run out.
+    """
+    from app.cloudshell import pool
+
+    try:
+        inventory.docker(container_id).api.remove_container(container_id, force=True)
+    except NotFound:
+        pass
     except Exception as e:
-        logger.error(f"Error creating container: {e}")
-        return Retry(max=3, interval=interval)
-        return {"status": "error", "message": str(e)}
+        logger.error(f"Error removing container {container_id}: {e}")
+    pool.release(container_id)
+
+
+def delete_container(docker_client, container_id: str) -> None:
+    docker_client.api.stop(container_id)
+    docker_client.api.remove_container(container_id)
+
+
+# Docker call and resulting Container.status for each bulk action
+BULK_ACTIONS = {
+    "start": (lambda docker_client, cid: docker_client.api.start(cid), "running"),
+    "stop": (lambda docker_client, cid: docker_client.api.stop(cid), "exited"),
+    "delete": (delete_container, "removed"),
+}
+
+
+def run_bulk(
+    action: str, container_ids: List[str], user_id: int
+) -> List[Dict[str, str]]:
+    """Apply a lifecycle action to many shells in parallel.
+
+    Args:
+        action (str): One of the keys of BULK_ACTIONS.
+        container_ids (List[str]): The shells to act on.
+        user_id (int): Only shells owned by this user are touched.
+
+    Returns:
+        List[Dict[str, str]]: One result per container, in request order.
+    """
+    container_ids = list(dict.fromkeys(container_ids))
+    shells = inventory.lookup(container_ids)
+    results = {
+        cid: {"container_id": cid, "status": "error", "message": "Container not found"}
+        for cid in container_ids
+        if cid not in shells or shells[cid]["user_id"] != str(user_id)
+    }
+    allowed = [cid for cid in container_ids if cid not in results]
+    func, status = BULK_ACTIONS[action]
+
+    def run(container_id):
+        try:
+            func(client.for_host(shells[container_id]["host"]), container_id)
+            return None
+        except NotFound:
+            return "Container not found"
+        except Exception as e:
+            logger.error(f"Error running {action} on container {container_id}: {e}")
+            return str(e)
+
+    workers = min(current_app.config["CLOUDSHELL_BULK_CONCURRENCY"], len(allowed))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for container_id, error in zip(allowed, executor.map(run, allowed)):
+            if error:
+                results[container_id] = {
+                    "container_id": container_id,
+                    "status": "error",
+                    "message": error,
+                }
+            else:
+                inventory.update(container_id, status=status)
+                results[container_id] = {
+                    "container_id": container_id,
+                    "status": "success",
+                }
+    return [results[cid] for cid in container_ids]
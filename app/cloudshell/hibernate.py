@@ -0,0 +1,99 @@
+import time
+from typing import Dict, Tuple
+import sqlalchemy as sa
+from docker.errors import NotFound
+from flask import current_app
+from app.extensions import logger, db
+from app.models import Container
+from app.cloudshell import inventory, readiness
+
+
+def _counters(container_id: str) -> Tuple[int, int]:
+    """Return the CPU time (ns) and network bytes used by a container so far."""
+    stats = inventory.docker(container_id).api.stats(
+        container_id, stream=False, one_shot=True
+    )
+    cpu = stats["cpu_stats"]["cpu_usage"]["total_usage"]
+    net = sum(
+        network["rx_bytes"] + network["tx_bytes"]
+        for network in (stats.get("networks") or {}).values()
+    )
+    return cpu, net
+
+
+def hibernate(container_id: str) -> None:
+    """Stop an idle shell, keeping its filesystem for a later resume."""
+    # Mark first so the die event does not report the shell as exited
+    inventory.update(container_id, status="hibernated")
+    inventory.docker(container_id).api.stop(container_id)
+    logger.info(f"Hibernated idle container {container_id}")
+
+
+def check_idle() -> int:
+    """Hibernate running shells idle for longer than CLOUDSHELL_IDLE_TIMEOUT.
+
+    A shell is active when it used more than CLOUDSHELL_IDLE_CPU_SECONDS of
+    CPU or any network traffic since the last check, or when someone
+    attached to or exec'd into it.
+
+    Returns:
+        int: The number of shells hibernated.
+    """
+    timeout = current_app.config["CLOUDSHELL_IDLE_TIMEOUT"]
+    if not timeout:
+        return 0
+    cpu_threshold = current_app.config["CLOUDSHELL_IDLE_CPU_SECONDS"] * 1e9
+
+    hibernated = 0
+    running = db.session.scalars(
+        sa.select(Container.container_id).where(Container.status == "running")
+    )
+    for container_id in running:
+        entry = inventory.get(container_id)
+        if entry is None or entry.get("status") != "running":
+            continue
+        try:
+            cpu, net = _counters(container_id)
+        except NotFound:
+            continue
+
+        now = time.time()
+        active_at = float(entry.get("active_at") or now)
+        if cpu - int(entry.get("cpu_usage", 0)) > cpu_threshold or net != int(
+            entry.get("net_bytes", 0)
+        ):
+            active_at = now
+        inventory.annotate(
+            container_id, cpu_usage=cpu, net_bytes=net, active_at=active_at
+        )
+
+        if now - active_at > timeout:
+            try:
+                hibernate(container_id)
+                hibernated += 1
+            except Exception as e:
+                logger.error(f"Error hibernating container {container_id}: {e}")
+    return hibernated
+
+
+def resume(container_id: str) -> Dict[str, str]:
+    """Start a hibernated shell and wait until it accepts SSH connections.
+
+    Args:
+        container_id (str): The shell to resume.
+
+    Returns:
+        Dict[str, str]: The shell's cached state, with the status and network
+        address it came back with, which the gateway forwards logins to.
+    """
+    with current_app.redis.lock(f"cloudshell:resume:{container_id}", timeout=60):
+        entry = inventory.get(container_id)
+        if entry is not None and entry.get("status") == "hibernated":
+            waiter = readiness.expect(container_id, inventory.host(container_id))
+            inventory.docker(container_id).api.start(container_id)
+            waiter.wait(current_app.config["CLOUDSHELL_READY_TIMEOUT"])
+            # Docker may give the shell a new IP address on its network
+            inventory.refresh(container_id)
+            logger.info(f"Resumed hibernated container {container_id}")
+    inventory.touch(container_id)
+    return inventory.get(container_id)
@@ -0,0 +1,145 @@
+import hashlib
+import io
+from typing import List, Optional, Set, Tuple
+from flask import current_app
+from docker.errors import APIError, ImageNotFound
+from app.extensions import logger, client, DEFAULT_HOST
+
+SHELL_IMAGE_REPOSITORY = "ucloudshell-shell"
+PREPULL_KEY = "cloudshell:images:prepull"
+
+# Provisioning steps baked into the shell image instead of run per container
+BUILD_STEPS = [
+    "apt-get update",
+    "apt-get install -y openssh-server sudo",
+    "rm -rf /var/lib/apt/lists/*",
+    "mkdir -p /root/.ssh",  # Ensure .ssh directory exists
+    # Every shell generates its own host key when it starts
+    "rm -f /etc/ssh/ssh_host_*",
+    "echo 'HostKey /etc/ssh/ssh_host_ed25519_key' >> /etc/ssh/sshd_config",
+    # The SSH gateway multiplexes every session to a shell over one connection
+    "echo 'MaxSessions 64' >> /etc/ssh/sshd_config",
+]
+
+# Probes sshd from inside the container. Checks run every 200ms while the
+# container starts and once a minute after that.
+HEALTHCHECK_PROBE = "exec 3<>/dev/tcp/127.0.0.1/22"
+HEALTHCHECK = (
+    "HEALTHCHECK --interval=60s --timeout=1s --retries=3 "
+    "--start-period=30s --start-interval=200ms "
+    f'CMD ["bash", "-c", "{HEALTHCHECK_PROBE}"]'
+)
+
+# Hosts and cache keys of images this process has already seen or built
+_known: Set[Tuple[str, str]] = set()
+
+
+def dockerfile(base: str, steps: List[str]) -> str:
+    """Render the Dockerfile for a shell image.
+
+    Args:
+        base (str): The base image reference.
+        steps (List[str]): Shell commands to run on top of the base image.
+
+    Returns:
+        str: The Dockerfile contents.
+    """
+    return "\n".join(
+        [
+            f"FROM {base}",
+            "ENV DEBIAN_FRONTEND=noninteractive",
+            "RUN " + " && ".join(steps),
+            HEALTHCHECK,
+            "ENTRYPOINT []",
+        ]
+    )
+
+
+def cache_key(base_digest: str, contents: str) -> str:
+    """Hash the base image digest and Dockerfile into a cache key."""
+    return hashlib.sha256(f"{base_digest}\0{contents}".encode()).hexdigest()
+
+
+def shell_image(host: str = DEFAULT_HOST) -> str:
+    """Return the tag of the shell image on a host, building it if needed.
+
+    The image is rebuilt only when the base image digest or the Dockerfile
+    (build steps and healthcheck) change; otherwise the locally tagged image
+    is reused.
+
+    Returns:
+        str: The tag of the built shell image.
+    """
+    base = current_app.config["DEFAULT_IMAGE"]
+    docker_client = client.for_host(host)
+    try:
+        base_image = docker_client.images.get(base)
+    except ImageNotFound:
+        base_image = client.for_host(host, "pull").images.pull(base)
+
+    contents = dockerfile(base, BUILD_STEPS)
+    key = cache_key(base_image.id, contents)
+    tag = f"{SHELL_IMAGE_REPOSITORY}:{key[:16]}"
+    if (host, key) in _known:
+        return tag
+
+    # Only one worker builds a given image, the others wait for it
+    with current_app.redis.lock(f"cloudshell:image-build:{host}:{key}", timeout=900):
+        try:
+            docker_client.images.get(tag)
+        except ImageNotFound:
+            logger.info(f"Building shell image {tag} from {base} on {host}")
+            client.for_host(host, "build").images.build(
+                fileobj=io.BytesIO(contents.encode()),
+                tag=tag,
+                rm=True,
+                labels={"ucloudshell.base-digest": base_image.id},
+            )
+            logger.info(f"Successfully built shell image {tag}")
+
+    _known.add((host, key))
+    return tag
+
+
+def remote_digest(reference: str, host: str = DEFAULT_HOST) -> Optional[str]:
+    """Ask the registry for the current digest of an image, without pulling it."""
+    try:
+        distribution = client.for_host(host).api.inspect_distribution(reference)
+    except APIError as e:
+        logger.warning(f"Could not check the registry digest of {reference}: {e}")
+        return None
+    return distribution["Descriptor"]["digest"]
+
+
+def prepull(reference: str, host: str = DEFAULT_HOST) -> bool:
+    """Pull an image unless the local copy already matches the registry.
+
+    Returns:
+        bool: True if the image was pulled.
+    """
+    try:
+        local = client.for_host(host).images.get(reference)
+    except ImageNotFound:
+        local = None
+    if local is not None:
+        digest = remote_digest(reference, host)
+        repo_digests = local.attrs.get("RepoDigests") or []
+        if digest is None or any(d.endswith(f"@{digest}") for d in repo_digests):
+            return False
+
+    logger.info(f"Pulling {reference} on {host}")
+    client.for_host(host, "pull").images.pull(reference)
+    return True
+
+
+def schedule_prepull() -> bool:
+    """Enqueue the image pre-pull job at most once per CLOUDSHELL_IMAGE_PREPULL_INTERVAL.
+
+    Returns:
+        bool: True if a job was enqueued.
+    """
+    interval = current_app.config["CLOUDSHELL_IMAGE_PREPULL_INTERVAL"]
+    if not interval or not current_app.redis.set(PREPULL_KEY, 1, nx=True, ex=interval):
+        return False
+    current_app.task_queue.enqueue("app.tasks.prepull_images")
+    return True
@@ -0,0 +1,365 @@
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Union
+import sqlalchemy as sa
+from flask import current_app
+from app.extensions import logger, client, db, DEFAULT_HOST
+from app.models import Container
+
+# Label set on every shell container so events and listings can be filtered
+SHELL_LABEL = "ucloudshell.shell"
+DIRTY_KEY = "cloudshell:inventory:dirty"
+
+# Container.status for each Docker event, matching Docker's state names
+EVENT_STATUS = {
+    "start": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "oom": "exited",
+    "destroy": "removed",
+}
+
+
+def _key(container_id: str) -> str:
+    return f"cloudshell:inventory:{container_id}"
+
+
+def get(container_id: str) -> Optional[Dict[str, str]]:
+    """Return the cached state of a shell without touching the Docker daemon.
+
+    Falls back to the Container table when the cache has no owner for it.
+
+    Args:
+        container_id (str): The full container ID.
+
+    Returns:
+        Optional[Dict[str, str]]: The status, port, ip, host, host_key and
+        user_id fields, or None for containers that are not shells.
+    """
+    redis = current_app.redis
+    entry = {
+        k.decode(): v.decode() for k, v in redis.hgetall(_key(container_id)).items()
+    }
+    if entry.get("user_id"):
+        return entry
+
+    row = db.session.scalar(
+        sa.select(Container).where(Container.container_id == container_id)
+    )
+    if row is None:
+        return None
+    entry = {
+        "status": row.status,
+        "port": str(row.port),
+        "host": row.host or DEFAULT_HOST,
+        "host_key": row.host_key or "",
+        **entry,
+    }
+    entry["user_id"] = str(row.user_id)
+    redis.hset(_key(container_id), mapping=entry)
+    return entry
+
+
+def owner(container_id: str) -> Optional[int]:
+    """Return the ID of the user owning a shell, if any."""
+    entry = get(container_id)
+    if entry is None or not entry.get("user_id"):
+        return None
+    return int(entry["user_id"])
+
+
+def host(container_id: str) -> str:
+    """Return the name of the Docker host a container runs on."""
+    cached = current_app.redis.hget(_key(container_id), "host")
+    if cached:
+        return cached.decode()
+    entry = get(container_id)
+    return entry.get("host", DEFAULT_HOST) if entry else DEFAULT_HOST
+
+
+def docker(container_id: str):
+    """Return the Docker client for the host a container runs on."""
+    return client.for_host(host(container_id))
+
+
+def lookup(container_ids: List[str]) -> Dict[str, Dict[str, str]]:
+    """Return the owner and host of many shells in one round trip and query.
+
+    Returns:
+        Dict[str, Dict[str, str]]: user_id and host for each known shell.
+    """
+    pipe = current_app.redis.pipeline()
+    for container_id in container_ids:
+        pipe.hmget(_key(container_id), "user_id", "host")
+    result = {
+        container_id: {
+            "user_id": user_id.decode(),
+            "host": cached_host.decode() if cached_host else DEFAULT_HOST,
+        }
+        for container_id, (user_id, cached_host) in zip(container_ids, pipe.execute())
+        if user_id
+    }
+
+    missing = [cid for cid in container_ids if cid not in result]
+    if missing:
+        rows = db.session.execute(
+            sa.select(Container.container_id, Container.user_id, Container.host).where(
+                Container.container_id.in_(missing)
+            )
+        )
+        for container_id, user_id, row_host in rows:
+            result[container_id] = {
+                "user_id": str(user_id),
+                "host": row_host or DEFAULT_HOST,
+            }
+    return result
+
+
+def record(
+    container_id: str,
+    user_id: int,
+    port: int,
+    host: str = DEFAULT_HOST,
+    host_key: str = "",
+    status: str = "running",
+):
+    """Cache a newly assigned shell."""
+    current_app.redis.hset(
+        _key(container_id),
+        mapping={
+            "user_id": user_id,
+            "port": port,
+            "host": host,
+            "host_key": host_key,
+            "status": status,
+        },
+    )
+
+
+def update(container_id: str, **fields: Union[str, int]) -> None:
+    """Update cached fields and queue them for the next batched DB write."""
+    pipe = current_app.redis.pipeline()
+    pipe.hset(_key(container_id), mapping=fields)
+    pipe.sadd(DIRTY_KEY, container_id)
+    pipe.execute()
+
+
+def annotate(container_id: str, **fields: Union[str, int, float]) -> None:
+    """Set cache-only fields that are never written to the Container table."""
+    current_app.redis.hset(_key(container_id), mapping=fields)
+
+
+def touch(container_id: str) -> None:
+    """Record user activity on a shell."""
+    annotate(container_id, active_at=time.time())
+
+
+def _docker_status(container_id: str, status: str) -> str:
+    # Docker only sees a stopped container; keep our hibernated marker
+    if status == "exited":
+        cached = current_app.redis.hget(_key(container_id), "status")
+        if cached == b"hibernated":
+            return "hibernated"
+    return status
+
+
+def address(attrs: dict) -> str:
+    """Return a container's IP address on CLOUDSHELL_NETWORK."""
+    network = current_app.config["CLOUDSHELL_NETWORK"]
+    settings = attrs["NetworkSettings"]
+    if network:
+        return (settings.get("Networks") or {}).get(network, {}).get("IPAddress", "")
+    return settings["IPAddress"]
+
+
+def refresh(container_id: str) -> Dict[str, str]:
+    """Inspect a container and update its cached status and IP."""
+    attrs = docker(container_id).api.inspect_container(container_id)
+    fields = {
+        "status": _docker_status(container_id, attrs["State"]["Status"]),
+        "ip": address(attrs),
+    }
+    update(container_id, **fields)
+    return fields
+
+
+def handle_event(event: dict, host: str = DEFAULT_HOST) -> None:
+    """Apply a Docker container event from a host to the cache."""
+    from app.cloudshell.images import HEALTHCHECK_PROBE
+
+    action = event.get("Action") or event.get("status", "")
+    actor = event.get("Actor", {})
+    if SHELL_LABEL not in actor.get("Attributes", {}):
+        return
+    container_id = actor.get("ID") or event["id"]
+    if action == "attach" or (
+        action.startswith("exec_start") and HEALTHCHECK_PROBE not in action
+    ):
+        touch(container_id)
+        return
+
+    status = EVENT_STATUS.get(action)
+    if status is None:
+        return
+    if action == "start":
+        # Docker may hand out a new IP address on every start
+        annotate(container_id, host=host)
+        refresh(container_id)
+    else:
+        update(container_id, status=_docker_status(container_id, status))
+
+
+def flush(batch_size: int = 1000) -> int:
+    """Write queued status/port changes to the Container table in one batch.
+
+    Returns:
+        int: The number of containers written.
+    """
+    redis = current_app.redis
+    container_ids = [cid.decode() for cid in redis.spop(DIRTY_KEY, batch_size)]
+    if not container_ids:
+        return 0
+
+    pipe = redis.pipeline()
+    for container_id in container_ids:
+        pipe.hmget(_key(container_id), "status", "port")
+    now = datetime.now(timezone.utc)
+    rows = [
+        {
+            "b_container_id": container_id,
+            "b_status": status.decode(),
+            "b_port": int(port) if port else None,
+            "b_updated_at": now,
+        }
+        for container_id, (status, port) in zip(container_ids, pipe.execute())
+        if status is not None
+    ]
+    if not rows:
+        return 0
+
+    table = Container.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.container_id == sa.bindparam("b_container_id"))
+        .values(
+            status=sa.bindparam("b_status"),
+            port=sa.func.coalesce(sa.bindparam("b_port"), table.c.port),
+            updated_at=sa.bindparam("b_updated_at"),
+        ),
+        rows,
+    )
+    db.session.commit()
+    return len(rows)
+
+
+def reconcile() -> Dict[str, int]:
+    """Compare every Docker host with the Container table and fix any drift.
+
+    Shells missing from their host are marked removed. Labelled containers
+    that belong to nobody, are not waiting in the warm pool and were not just
+    claimed from it are removed once they are older than
+    CLOUDSHELL_ORPHAN_GRACE seconds. Hosts that
+    cannot be reached are skipped.
+
+    Returns:
+        Dict[str, int]: Counts of synced, missing and orphaned containers.
+    """
+    from app.cloudshell import pool, scheduler
+
+    redis = current_app.redis
+    pooled = {cid.decode() for cid in redis.lrange(pool.READY_KEY, 0, -1)}
+    pooled |= pool.claimed()
+    owned = {
+        container_id: row_host or DEFAULT_HOST
+        for container_id, row_host in db.session.execute(
+            sa.select(Container.container_id, Container.host).where(
+                Container.status != "removed"
+            )
+        )
+    }
+    grace = current_app.config["CLOUDSHELL_ORPHAN_GRACE"]
+
+    seen = set()
+    listed = set()
+    orphans = 0
+    for name in scheduler.hosts():
+        docker_client = client.for_host(name)
+        try:
+            containers = docker_client.api.containers(
+                all=True, filters={"label": SHELL_LABEL}
+            )
+        except Exception as e:
+            logger.error(f"Could not list containers on {name}: {e}")
+            continue
+        listed.add(name)
+        for attrs in containers:
+            container_id = attrs["Id"]
+            seen.add(container_id)
+            if container_id in owned:
+                update(
+                    container_id, status=_docker_status(container_id, attrs["State"])
+                )
+            elif container_id not in pooled and time.time() - attrs["Created"] > grace:
+                logger.warning(f"Removing orphaned container {container_id} on {name}")
+                docker_client.api.remove_container(container_id, force=True)
+                orphans += 1
+
+    missing = [
+        container_id
+        for container_id, row_host in owned.items()
+        if row_host in listed and container_id not in seen
+    ]
+    for container_id in missing:
+        update(container_id, status="removed")
+    flush()
+    return {
+        "synced": len(owned.keys() & seen),
+        "missing": len(missing),
+        "orphans": orphans,
+    }
+
+
+def sync() -> None:
+    """Keep the inventory in sync with Docker until interrupted."""
+    from app.cloudshell import hibernate, images, readiness, scheduler
+    from app.quickcode import batch
+
+    app = current_app._get_current_object()
+
+    def subscriber(name):
+        def on_event(event):
+            with app.app_context():
+                handle_event(event, name)
+
+        return on_event
+
+    for name in scheduler.hosts():
+        readiness.watcher(name).subscribe(subscriber(name))
+
+    def reconcile_inventory():
+        logger.info(f"Reconciled container inventory: {reconcile()}")
+
+    # (config key of the interval, step, what the step does for the log)
+    steps = [
+        ("CLOUDSHELL_RECONCILE_INTERVAL", reconcile_inventory, "reconciling"),
+        ("CLOUDSHELL_IDLE_CHECK_INTERVAL", hibernate.check_idle, "hibernating"),
+        # Restarts batch items whose worker died or that were dropped
+        ("QUICKCODE_BATCH_DISPATCH_INTERVAL", batch.dispatch, "dispatching"),
+        # Picks up new base image versions without restarting anything
+        (None, images.schedule_prepull, "scheduling the image pre-pull"),
+        (None, flush, "flushing"),
+    ]
+    ran_at = [0.0] * len(steps)
+    while True:
+        for i, (interval, step, doing) in enumerate(steps):
+            if interval and time.monotonic() - ran_at[i] <= app.config[interval]:
+                continue
+            # One failing step must not stop the others, or the loop
+            try:
+                step()
+            except Exception as e:
+                logger.error(f"Error {doing} in the inventory sync: {e}")
+                db.session.rollback()
+            ran_at[i] = time.monotonic()
+        time.sleep(app.config["CLOUDSHELL_INVENTORY_FLUSH_INTERVAL"])
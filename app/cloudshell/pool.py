@@ -0,0 +1,144 @@
+import time
+from typing import Dict, Optional, Set, Union
+from flask import current_app
+from docker.errors import NotFound
+from docker.models.containers import Container
+from app.extensions import logger
+from app.cloudshell import inventory
+
+# Redis keys shared by every web and RQ worker
+READY_KEY = "cloudshell:pool:ready"
+STATS_KEY = "cloudshell:pool:stats"
+REFILL_LOCK_KEY = "cloudshell:pool:refill-lock"
+REFILL_PENDING_KEY = "cloudshell:pool:refill-pending"
+# Containers handed out by claim whose Container row may not be committed yet,
+# so reconcile does not take them for orphans. IDs are moved here from the
+# ready list atomically and timestamped just after.
+CLAIMED_KEY = "cloudshell:pool:claimed"
+CLAIMED_AT_KEY = "cloudshell:pool:claimed-at"
+# Seconds a claim protects a container, longer than configuring it takes
+CLAIM_TTL = 600
+
+
+def size() -> int:
+    """Return the number of ready, unassigned shells."""
+    return current_app.redis.llen(READY_KEY)
+
+
+def claim() -> Optional[Container]:
+    """Take a provisioned container out of the warm pool.
+
+    The pop is atomic in Redis, so a container is never handed to two users.
+
+    Returns:
+        Optional[Container]: A ready container, or None when the pool is empty.
+    """
+    redis = current_app.redis
+    started = time.perf_counter()
+    container = None
+    while container is None:
+        container_id = redis.lmove(READY_KEY, CLAIMED_KEY, "LEFT", "RIGHT")
+        if container_id is None:
+            break
+        container_id = container_id.decode()
+        redis.hset(CLAIMED_AT_KEY, container_id, time.time())
+        try:
+            container = inventory.docker(container_id).containers.get(container_id)
+        except NotFound:
+            logger.warning(f"Pooled container {container_id} disappeared")
+            release(container_id)
+
+    pipe = redis.pipeline()
+    pipe.hincrby(STATS_KEY, "hits" if container is not None else "misses", 1)
+    pipe.hincrbyfloat(STATS_KEY, "claim_seconds", time.perf_counter() - started)
+    pipe.execute()
+
+    request_refill()
+    return container
+
+
+def release(container_id: str) -> None:
+    """Forget a claim, once the container is recorded or removed."""
+    pipe = current_app.redis.pipeline()
+    pipe.lrem(CLAIMED_KEY, 0, container_id)
+    pipe.hdel(CLAIMED_AT_KEY, container_id)
+    pipe.execute()
+
+
+def claimed() -> Set[str]:
+    """Return the containers claimed in the last CLAIM_TTL seconds.
+
+    Older claims, e.g. by a worker that died, are forgotten.
+    """
+    redis = current_app.redis
+    container_ids = [cid.decode() for cid in redis.lrange(CLAIMED_KEY, 0, -1)]
+    if not container_ids:
+        return set()
+    now = time.time()
+    recent = set()
+    for container_id, claimed_at in zip(
+        container_ids, redis.hmget(CLAIMED_AT_KEY, container_ids)
+    ):
+        if claimed_at is None:
+            # Claimed a moment ago, or by a worker that died before noting when
+            redis.hsetnx(CLAIMED_AT_KEY, container_id, now)
+            recent.add(container_id)
+        elif now - float(claimed_at) < CLAIM_TTL:
+            recent.add(container_id)
+        else:
+            release(container_id)
+    return recent
+
+
+def request_refill() -> None:
+    """Enqueue a refill job once the pool drops to the low watermark."""
+    redis = current_app.redis
+    if size() > current_app.config["CLOUDSHELL_POOL_LOW_WATERMARK"]:
+        return
+    # Only one refill job is queued at a time
+    if redis.set(REFILL_PENDING_KEY, 1, nx=True, ex=600):
+        current_app.task_queue.enqueue("app.tasks.refill_shell_pool")
+
+
+def refill() -> int:
+    """Provision containers until the pool reaches the high watermark.
+
+    Returns:
+        int: The number of containers added to the pool.
+    """
+    from app.cloudshell.helpers import provision_container
+
+    redis = current_app.redis
+    high = current_app.config["CLOUDSHELL_POOL_SIZE"]
+    lock = redis.lock(REFILL_LOCK_KEY, timeout=600)
+    if not lock.acquire(blocking=False):
+        return 0
+    added = 0
+    try:
+        while size() < high:
+            container = provision_container()
+            redis.rpush(READY_KEY, container.id)
+            added += 1
+        logger.info(f"Added {added} containers to the shell pool")
+    except Exception as e:
+        logger.error(f"Error refilling shell pool: {e}")
+    finally:
+        redis.delete(REFILL_PENDING_KEY)
+        lock.release()
+    return added
+
+
+def stats() -> Dict[str, Union[int, float]]:
+    """Return pool size, hit/miss counts and average claim latency."""
+    raw = current_app.redis.hgetall(STATS_KEY)
+    hits = int(raw.get(b"hits", 0))
+    misses = int(raw.get(b"misses", 0))
+    claims = hits + misses
+    claim_seconds = float(raw.get(b"claim_seconds", 0))
+    return {
+        "size": size(),
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / claims if claims else 0.0,
+        "avg_claim_ms": claim_seconds / claims * 1000 if claims else 0.0,
+    }
@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from app.extensions import logger, client, DEFAULT_HOST
+
+# Events that mean a container will never become ready
+FAILED_EVENTS = {"die", "oom", "destroy", "health_status: unhealthy"}
+
+
+class ContainerNotReady(Exception):
+    pass
+
+
+class Waiter:
+    """A pending wait for one container to become ready."""
+
+    def __init__(self, container_id: str, healthy: bool, watcher: "Watcher"):
+        self.container_id = container_id
+        self.healthy = healthy
+        self.watcher = watcher
+        self.error: Optional[str] = None
+        self._event = threading.Event()
+
+    def resolve(self, error: Optional[str] = None) -> None:
+        self.error = error
+        self._event.set()
+
+    def wait(self, timeout: float) -> None:
+        """Block until the container is ready.
+
+        Args:
+            timeout (float): Seconds to wait before giving up.
+
+        Raises:
+            ContainerNotReady: If the container failed or timed out.
+        """
+        ready = self._event.wait(timeout)
+        self.watcher.discard(self)
+        if not ready:
+            raise ContainerNotReady(
+                f"Container {self.container_id} was not ready after {timeout}s"
+            )
+        if self.error:
+            raise ContainerNotReady(self.error)
+
+
+class Watcher:
+    """Multiplexes readiness waiters over a single Docker events stream.
+
+    The stream is opened lazily, once per process and Docker host, by a
+    daemon thread.
+    """
+
+    def __init__(self, host: str = DEFAULT_HOST):
+        self.host = host
+        self._waiters: Dict[str, List[Waiter]] = {}
+        self._subscribers: List[Callable[[dict], None]] = []
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def expect(self, container_id: str, healthy: bool = True) -> Waiter:
+        """Register interest in a container before starting it.
+
+        Args:
+            container_id (str): The container to wait for.
+            healthy (bool): Wait for a healthy healthcheck instead of start.
+
+        Returns:
+            Waiter: Call `wait` on it once the container is started.
+        """
+        waiter = Waiter(container_id, healthy, self)
+        with self._lock:
+            self._waiters.setdefault(container_id, []).append(waiter)
+            self._ensure_running()
+        # Events are only seen once the stream is open
+        self._connected.wait(10)
+        return waiter
+
+    def subscribe(self, callback: Callable[[dict], None]) -> None:
+        """Call `callback` from the events thread for every container event."""
+        with self._lock:
+            self._subscribers.append(callback)
+            self._ensure_running()
+
+    def discard(self, waiter: Waiter) -> None:
+        with self._lock:
+            waiters = self._waiters.get(waiter.container_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._waiters.pop(waiter.container_id, None)
+
+    def _ensure_running(self) -> None:
+        # A thread started before a fork does not exist in the child
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._connected.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"docker-events-{self.host}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        since = None
+        while True:
+            try:
+                stream = client.for_host(self.host).events(
+                    decode=True,
+                    since=since,
+                    filters={
+                        "type": "container",
+                        "event": [
+                            "start",
+                            "die",
+                            "oom",
+                            "destroy",
+                            "health_status",
+                            "pause",
+                            "unpause",
+                            "attach",
+                            "exec_start",
+                        ],
+                    },
+                )
+                self._connected.set()
+                for event in stream:
+                    # Resume from the last event seen after a reconnect
+                    since = event.get("time", since)
+                    self._dispatch(event)
+            except Exception as e:
+                logger.error(f"Docker event stream for {self.host} failed: {e}")
+            self._connected.clear()
+            time.sleep(1)
+
+    def _dispatch(self, event: dict) -> None:
+        action = event.get("Action") or event.get("status", "")
+        container_id = event.get("Actor", {}).get("ID") or event.get("id")
+        with self._lock:
+            waiters = list(self._waiters.get(container_id, []))
+            subscribers = list(self._subscribers)
+        for waiter in waiters:
+            if action in FAILED_EVENTS:
+                exit_code = event.get("Actor", {}).get("Attributes", {}).get("exitCode")
+                waiter.resolve(
+                    f"Container {container_id} failed to start ({action}, "
+                    f"exit code {exit_code})."
+                )
+            elif action == "health_status: healthy" or (
+                action == "start" and not waiter.healthy
+            ):
+                waiter.resolve()
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Error handling Docker event {action}: {e}")
+
+
+_watchers: Dict[str, Watcher] = {}
+_watchers_lock = threading.Lock()
+
+
+def watcher(host: str = DEFAULT_HOST) -> Watcher:
+    """Return the events watcher for a Docker host."""
+    with _watchers_lock:
+        if host not in _watchers:
+            _watchers[host] = Watcher(host)
+        return _watchers[host]
+
+
+def expect(container_id: str, host: str = DEFAULT_HOST, healthy: bool = True) -> Waiter:
+    """Register interest in a container on a host before starting it."""
+    return watcher(host).expect(container_id, healthy)
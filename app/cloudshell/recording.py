@@ -0,0 +1,252 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple
+from uuid import uuid4
+from flask import current_app
+from app.extensions import db
+from app.models import Recording
+
+# A recording is a data file of independently compressed blocks and an
+# index file with one fixed-size entry per block, so playback can binary
+# search the index and decompress only the blocks it needs.
+#
+#   data file:  MAGIC, started_at (ms since the epoch)
+#               then per block: base_ms, compressed length, zlib payload
+#   index file: per block: base_ms, offset of the block in the data file,
+#               compressed length
+#
+# A block payload is a run of events: delay since the previous event in ms
+# (varint), kind (one byte), data length (varint), data.
+MAGIC = b"UCR1"
+FILE_HEADER = struct.Struct("<4sQ")
+BLOCK_HEADER = struct.Struct("<QI")
+INDEX_ENTRY = struct.Struct("<QQI")
+
+OUTPUT = b"o"
+INPUT = b"i"
+RESIZE = b"r"
+
+Event = Tuple[int, str, bytes]
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _paths(recording_id: str) -> Tuple[str, str]:
+    directory = os.path.join(
+        current_app.instance_path, current_app.config["CLOUDSHELL_RECORDING_DIR"]
+    )
+    base = os.path.join(directory, recording_id)
+    return f"{base}.ucr", f"{base}.idx"
+
+
+class Recorder:
+    """Appends the events of one terminal session to a recording.
+
+    `record` only buffers in memory, so it is cheap enough to call on every
+    frame of a live session. Once a block is due (full, or older than the
+    keyframe interval) the caller takes it with `take` and compresses and
+    writes it with `write`, which may run on another thread as long as blocks
+    are written in the order they were taken. Callers recording from several
+    threads use `flush` instead, which does both in order.
+    """
+
+    def __init__(self, container_id: str, user_id: int, source: str):
+        config = current_app.config
+        self.block_bytes = config["CLOUDSHELL_RECORDING_BLOCK_BYTES"]
+        self.keyframe_ms = config["CLOUDSHELL_RECORDING_KEYFRAME_SECONDS"] * 1000
+        self.record_input = config["CLOUDSHELL_RECORDING_INPUT"]
+
+        self.recording_id = str(uuid4())
+        db.session.add(
+            Recording(
+                id=self.recording_id,
+                container_id=container_id,
+                user_id=user_id,
+                source=source,
+            )
+        )
+        db.session.commit()
+
+        data_path, index_path = _paths(self.recording_id)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        self.started = time.monotonic()
+        self._data = open(data_path, "ab")
+        self._index = open(index_path, "ab")
+        self._data.write(FILE_HEADER.pack(MAGIC, int(time.time() * 1000)))
+        # Flushed now so the recording can be played before its first block
+        self._data.flush()
+        self._offset = FILE_HEADER.size
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        # record may be called from several threads, e.g. on window changes
+        self._buffer_lock = threading.Lock()
+        self._buffer = bytearray()
+        self._base_ms: Optional[int] = None
+        self._last_ms = 0
+
+    def record(self, kind: bytes, data: bytes) -> bool:
+        """Buffer an event, returning True when a block should be written."""
+        if kind == INPUT and not self.record_input:
+            return False
+        now_ms = int((time.monotonic() - self.started) * 1000)
+        with self._buffer_lock:
+            if self._base_ms is None:
+                self._base_ms = self._last_ms = now_ms
+            self._buffer += _varint(now_ms - self._last_ms)
+            self._buffer += kind
+            self._buffer += _varint(len(data))
+            self._buffer += data
+            self._last_ms = now_ms
+            return (
+                len(self._buffer) >= self.block_bytes
+                or now_ms - self._base_ms >= self.keyframe_ms
+            )
+
+    def resize(self, rows: int, cols: int) -> bool:
+        return self.record(RESIZE, f"{cols}x{rows}".encode())
+
+    def take(self) -> Optional[Tuple[int, bytes]]:
+        """Detach the buffered block, if any, for `write`."""
+        with self._buffer_lock:
+            if self._base_ms is None:
+                return None
+            block = (self._base_ms, bytes(self._buffer))
+            self._buffer = bytearray()
+            self._base_ms = None
+            return block
+
+    def write(self, block: Optional[Tuple[int, bytes]]) -> None:
+        """Compress and append a block taken with `take`."""
+        if block is None:
+            return
+        base_ms, payload = block
+        compressed = zlib.compress(payload)
+        with self._lock:
+            self._data.write(BLOCK_HEADER.pack(base_ms, len(compressed)))
+            self._data.write(compressed)
+            self._data.flush()
+            self._index.write(INDEX_ENTRY.pack(base_ms, self._offset, len(compressed)))
+            self._index.flush()
+            self._offset += BLOCK_HEADER.size + len(compressed)
+
+    def flush(self) -> None:
+        """Take and write the buffered block before any taken after it."""
+        with self._flush_lock:
+            self.write(self.take())
+
+    def close(self) -> None:
+        """Write the last block and store the recording's length and size."""
+        self.flush()
+        with self._lock:
+            self._data.close()
+            self._index.close()
+        recording = db.session.get(Recording, self.recording_id)
+        recording.ended_at = datetime.now(timezone.utc)
+        recording.duration_ms = self._last_ms
+        recording.size = self._offset
+        db.session.commit()
+
+
+class Player:
+    """Reads events from a recording through memory maps."""
+
+    def __init__(self, recording_id: str):
+        data_path, index_path = _paths(recording_id)
+        self._data: Optional[mmap.mmap] = None
+        self.started_at: Optional[int] = None
+        self._blocks: List[Tuple[int, int, int]] = []
+        self._times: List[int] = []
+        # Created but not written yet, e.g. by an older recorder: no events
+        if os.path.getsize(data_path) < FILE_HEADER.size:
+            return
+        with open(data_path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.started_at = FILE_HEADER.unpack_from(self._data, 0)
+        if magic != MAGIC:
+            self._data.close()
+            raise ValueError(f"{data_path} is not a session recording")
+        self._blocks = self._read_index(index_path)
+        self._times = [block[0] for block in self._blocks]
+
+    def _read_index(self, index_path: str) -> List[Tuple[int, int, int]]:
+        blocks = []
+        if os.path.getsize(index_path):
+            with open(index_path, "rb") as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            blocks = [
+                INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)
+                for i in range(len(index) // INDEX_ENTRY.size)
+            ]
+            index.close()
+        # Pick up blocks written after the last index entry, e.g. after a crash
+        offset = FILE_HEADER.size
+        if blocks:
+            offset = blocks[-1][1] + BLOCK_HEADER.size + blocks[-1][2]
+        while offset + BLOCK_HEADER.size <= len(self._data):
+            base_ms, length = BLOCK_HEADER.unpack_from(self._data, offset)
+            if offset + BLOCK_HEADER.size + length > len(self._data):
+                break
+            blocks.append((base_ms, offset, length))
+            offset += BLOCK_HEADER.size + length
+        return blocks
+
+    def _decode(self, block: Tuple[int, int, int]) -> Iterator[Event]:
+        base_ms, offset, length = block
+        start = offset + BLOCK_HEADER.size
+        payload = zlib.decompress(self._data[start : start + length])
+        at, pos = base_ms, 0
+        while pos < len(payload):
+            delay, pos = _read_varint(payload, pos)
+            kind = payload[pos : pos + 1].decode()
+            size, pos = _read_varint(payload, pos + 1)
+            at += delay
+            yield at, kind, payload[pos : pos + size]
+            pos += size
+
+    def events(
+        self, start_ms: int = 0, end_ms: Optional[int] = None
+    ) -> Iterator[Event]:
+        """Yield (ms since start, kind, data) for events in [start_ms, end_ms).
+
+        Only the blocks overlapping the range are decompressed.
+        """
+        # The last block starting before start_ms may run past it, and any
+        # number of blocks can start in the same millisecond
+        first = max(bisect.bisect_left(self._times, start_ms) - 1, 0)
+        for block in self._blocks[first:]:
+            if end_ms is not None and block[0] >= end_ms:
+                return
+            for event in self._decode(block):
+                if end_ms is not None and event[0] >= end_ms:
+                    return
+                if event[0] >= start_ms:
+                    yield event
+
+    def close(self) -> None:
+        if self._data is not None:
+            self._data.close()
@@ -1,20 +1,22 @@
 from app.cloudshell import bp, api
 from flask import render_template, request, jsonify, url_for, redirect, current_app
-from app.extensions import client, logger
+from app.extensions import logger
 from flask_security import (
     auth_required,
     http_auth_required,
     auth_token_required,
+    current_user,
 )
 from docker.errors import NotFound
 import socket
 import subprocess
+from app.cloudshell import inventory, terminal
 from app.cloudshell.forms import ContainerForm
-from app.cloudshell.helpers import ensure_wireguard_container, create
+from app.cloudshell.helpers import ensure_wireguard_container
 
 
 @bp.route("/", methods=["GET", "POST"])
-@auth_required
+@auth_required()
 def index():
     """Display the homepage with basic information and navigation links."""
     form = ContainerForm()
@@ -44,26 +46,33 @@ def index():
     return render_template("cloudshell/index.html", form=form)
 
 
-@bp.route("/shell/<int:container_id>")
-@auth_required
+@bp.route("/shell/<container_id>")
+@auth_required()
 def shell(container_id):
+    if inventory.owner(container_id) != current_user.id:
+        return render_template("errors/404.html"), 404
+    terminal_url = current_app.config["CLOUDSHELL_TERMINAL_URL"] or (
+        current_app.config["CLOUDSHELL_PREFIX"] + "/terminal"
+    )
     return render_template(
         "cloudshell/shell.html",
         container_id=container_id,
-        docker_host=current_app.config["DOCKER_HOST"],
+        terminal_url=terminal_url,
+        ticket=terminal.issue_ticket(current_user.id, container_id),
     )
 
 
-@auth_required
 @bp.route("/create", methods=["POST"])
+@auth_required()
 def create():
-    job = create()
-    container_info = job
-    return container_info
+    task = current_user.launch_task(
+        "tasks.create_shell", "Create shell", request.form.get("ssh_key") or None
+    )
+    return jsonify({"status": "queued", "task_id": task.id}), 202
 
 
 @bp.route("/stop/<container_id>", methods=["POST"])
-@auth_required
+@auth_required()
 def stop(container_id):
     try:
         if not container_id:
@@ -71,8 +80,11 @@ def stop(container_id):
                 {"status": "error", "message": "No container ID provided"}
             ), 400
 
-        container = client.containers.get(container_id)
-        container.stop()
+        if inventory.owner(container_id) != current_user.id:
+            raise NotFound("Container not found")
+
+        inventory.docker(container_id).api.stop(container_id)
+        inventory.update(container_id, status="exited")
         return jsonify({"status": "success", "message": "Container stopped"})
 
     except NotFound:
@@ -83,7 +95,7 @@ def stop(container_id):
 
 
 @bp.route("/start/<container_id>", methods=["POST"])
-@auth_required
+@auth_required()
 def start(container_id):
     try:
         if not container_id:
@@ -91,8 +103,11 @@ def start(container_id):
                 {"status": "error", "message": "No container ID provided"}
             ), 400
 
-        container = client.containers.get(container_id)
-        container.start()
+        if inventory.owner(container_id) != current_user.id:
+            raise NotFound("Container not found")
+
+        inventory.docker(container_id).api.start(container_id)
+        inventory.update(container_id, status="running")
         return jsonify({"status": "success", "message": "Container started"})
 
     except NotFound:
@@ -102,15 +117,17 @@ def start(container_id):
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
-@auth_required
 @bp.route("/setup_wireguard/<string:container_id>", methods=["POST"])
+@auth_required()
 def setup_wireguard(container_id):
     try:
         # Ensure WireGuard container is running
         wg_container = ensure_wireguard_container()
 
-        container = client.containers.get(container_id)
-        container_ip = container.attrs["NetworkSettings"]["IPAddress"]
+        entry = inventory.get(container_id)
+        if entry is None or entry.get("user_id") != str(current_user.id):
+            raise NotFound("Container not found")
+        container_ip = entry.get("ip") or inventory.refresh(container_id)["ip"]
 
         # Get the host machine's IP address
         host_ip = socket.gethostbyname(socket.gethostname())
@@ -0,0 +1,98 @@
+from typing import Callable, Dict, List, Optional
+from flask import current_app
+from app.extensions import logger, client, DEFAULT_HOST
+
+# Placement policies take the load of every available host and return the
+# name of the host to place a new shell on
+Policy = Callable[[Dict[str, Dict[str, int]]], str]
+POLICIES: Dict[str, Policy] = {}
+
+
+def policy(name: str) -> Callable[[Policy], Policy]:
+    """Register a placement policy under a name for CLOUDSHELL_PLACEMENT_POLICY."""
+
+    def decorator(func: Policy) -> Policy:
+        POLICIES[name] = func
+        return func
+
+    return decorator
+
+
+def _usage(load: Dict[str, int]) -> float:
+    return load["running"] / load["capacity"]
+
+
+@policy("least-loaded")
+def least_loaded(loads: Dict[str, Dict[str, int]]) -> str:
+    """Spread shells evenly over all hosts."""
+    return min(loads, key=lambda host: _usage(loads[host]))
+
+
+@policy("bin-packing")
+def bin_packing(loads: Dict[str, Dict[str, int]]) -> str:
+    """Fill the busiest host first so idle hosts can be scaled down."""
+    return max(loads, key=lambda host: _usage(loads[host]))
+
+
+def hosts() -> List[str]:
+    """Return the names of all Docker endpoints shells may be placed on."""
+    return list(current_app.config["DOCKER_ENDPOINTS"]) or [DEFAULT_HOST]
+
+
+def _key(host: str) -> str:
+    return f"cloudshell:hosts:{host}"
+
+
+def load(host: str) -> Optional[Dict[str, int]]:
+    """Return the running shells, CPUs, memory and shell capacity of a host.
+
+    Daemon info is cached in Redis for CLOUDSHELL_HOST_STATS_TTL seconds.
+
+    Returns:
+        Optional[Dict[str, int]]: The host's load, or None if unreachable.
+    """
+    redis = current_app.redis
+    cached = redis.hgetall(_key(host))
+    if cached:
+        return {k.decode(): int(v) for k, v in cached.items()}
+
+    try:
+        info = client.for_host(host).api.info()
+    except Exception as e:
+        logger.error(f"Docker host {host} is unavailable: {e}")
+        return None
+    shell_memory = current_app.config["CLOUDSHELL_SHELL_MEMORY_MB"] * 1024 * 1024
+    shells_per_cpu = current_app.config["CLOUDSHELL_SHELLS_PER_CPU"]
+    stats = {
+        "running": info["ContainersRunning"],
+        "cpus": info["NCPU"],
+        "memory": info["MemTotal"],
+        "capacity": max(
+            1, min(info["MemTotal"] // shell_memory, info["NCPU"] * shells_per_cpu)
+        ),
+    }
+    pipe = redis.pipeline()
+    pipe.hset(_key(host), mapping=stats)
+    pipe.expire(_key(host), current_app.config["CLOUDSHELL_HOST_STATS_TTL"])
+    pipe.execute()
+    return stats
+
+
+def place() -> str:
+    """Pick the host for a new shell using CLOUDSHELL_PLACEMENT_POLICY.
+
+    Returns:
+        str: The name of the chosen Docker endpoint.
+    """
+    loads = {}
+    for host in hosts():
+        host_load = load(host)
+        if host_load is not None and host_load["running"] < host_load["capacity"]:
+            loads[host] = host_load
+    if not loads:
+        raise Exception("No Docker host has capacity for a new shell")
+
+    host = POLICIES[current_app.config["CLOUDSHELL_PLACEMENT_POLICY"]](loads)
+    # Count the shell now so concurrent placements see it before the next refresh
+    current_app.redis.hincrby(_key(host), "running", 1)
+    return host
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+from flask import Flask, current_app
+from app.extensions import logger
+from app.cloudshell import hibernate, inventory
+from app.cloudshell.recording import INPUT, OUTPUT, Recorder
+
+# websockets is only needed by the proxy process, not by web workers
+if TYPE_CHECKING:
+    from websockets.asyncio.server import ServerConnection
+
+# One-time tickets handed to the browser by the shell page
+TICKET_KEY = "cloudshell:terminal:ticket:{}"
+TICKET_TTL = 30
+
+SHELL_COMMAND = ["/bin/bash", "-l"]
+# Seconds between activity updates for a shell while someone types in it
+TOUCH_INTERVAL = 60
+
+
+def issue_ticket(user_id: int, container_id: str) -> str:
+    """Create a short-lived ticket allowing one terminal connection to a shell."""
+    ticket = secrets.token_urlsafe(32)
+    current_app.redis.set(
+        TICKET_KEY.format(ticket), f"{user_id}:{container_id}", ex=TICKET_TTL
+    )
+    return ticket
+
+
+def redeem_ticket(ticket: str) -> Optional[Tuple[int, str]]:
+    """Consume a ticket, returning the user and shell it was issued for."""
+    value = current_app.redis.getdel(TICKET_KEY.format(ticket))
+    if value is None:
+        return None
+    user_id, container_id = value.decode().split(":", 1)
+    return int(user_id), container_id
+
+
+class TerminalProxy:
+    """Bridges browser WebSockets to interactive shells in containers.
+
+    Output is read from Docker into frames of up to
+    CLOUDSHELL_TERMINAL_FRAME_BYTES, waiting at most
+    CLOUDSHELL_TERMINAL_FLUSH_MS for more output before a frame is sent.
+    Nothing more is read from a container while its client's send buffer
+    is above CLOUDSHELL_TERMINAL_WRITE_LIMIT, so a slow client stalls the
+    process in the shell instead of growing server memory.
+    """
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.frame_bytes = app.config["CLOUDSHELL_TERMINAL_FRAME_BYTES"]
+        self.flush_interval = app.config["CLOUDSHELL_TERMINAL_FLUSH_MS"] / 1000
+        self.record = app.config["CLOUDSHELL_RECORDING_ENABLED"]
+        # One thread writes every recording, in the order blocks are taken
+        self.recording_writer = ThreadPoolExecutor(max_workers=1)
+
+    def _call(self, func, *args):
+        """Run blocking Docker and Redis calls off the event loop."""
+
+        def run():
+            with self.app.app_context():
+                return func(*args)
+
+        return asyncio.get_running_loop().run_in_executor(None, run)
+
+    @staticmethod
+    def _exec(container_id: str):
+        # Wake the shell up if it was hibernated while idle
+        hibernate.resume(container_id)
+        api = inventory.docker(container_id).api
+        exec_id = api.exec_create(
+            container_id,
+            SHELL_COMMAND,
+            stdin=True,
+            tty=True,
+            environment={"TERM": "xterm-256color"},
+        )["Id"]
+        return exec_id, api.exec_start(exec_id, tty=True, socket=True)
+
+    @staticmethod
+    def _resize(container_id: str, exec_id: str, rows: int, cols: int) -> None:
+        inventory.docker(container_id).api.exec_resize(exec_id, height=rows, width=cols)
+
+    async def handle(self, websocket: "ServerConnection") -> None:
+        """Authenticate a connection and run its terminal until either side closes."""
+        query = parse_qs(urlsplit(websocket.request.path).query)
+        owner = await self._call(redeem_ticket, query.get("ticket", [""])[0])
+        if owner is None:
+            await websocket.close(1008, "Invalid ticket")
+            return
+        user_id, container_id = owner
+
+        try:
+            exec_id, sock = await self._call(self._exec, container_id)
+        except Exception as e:
+            logger.error(f"Error opening terminal to {container_id}: {e}")
+            await websocket.close(1011, "Shell is unavailable")
+            return
+
+        recorder = None
+        if self.record:
+            recorder = await self._call(Recorder, container_id, user_id, "web")
+        reader, writer = await asyncio.open_connection(
+            sock=getattr(sock, "_sock", sock), limit=self.frame_bytes
+        )
+        tasks = [
+            asyncio.create_task(self._send_output(reader, websocket, recorder)),
+            asyncio.create_task(
+                self._receive_input(websocket, writer, container_id, exec_id, recorder)
+            ),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            await websocket.close()
+            if recorder is not None:
+                # Waits for the blocks queued before it on the writer thread
+                await self._write_block(recorder)
+                await self._call(recorder.close)
+
+    def _write_block(self, recorder: Recorder) -> asyncio.Future:
+        """Compress and write the recorder's pending block off the event loop."""
+        return asyncio.get_running_loop().run_in_executor(
+            self.recording_writer, recorder.write, recorder.take()
+        )
+
+    async def _send_output(
+        self,
+        reader: asyncio.StreamReader,
+        websocket: "ServerConnection",
+        recorder: Optional[Recorder],
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await reader.read(self.frame_bytes)
+            if not chunk:
+                return
+            frame = bytearray(chunk)
+            # Coalesce the small writes of interactive programs into one frame
+            deadline = loop.time() + self.flush_interval
+            while len(frame) < self.frame_bytes:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    chunk = await asyncio.wait_for(
+                        reader.read(self.frame_bytes - len(frame)), timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if not chunk:
+                    break
+                frame += chunk
+            frame = bytes(frame)
+            if recorder is not None and recorder.record(OUTPUT, frame):
+                self._write_block(recorder)
+            # Blocks while the client's send buffer is full
+            await websocket.send(frame)
+
+    async def _receive_input(
+        self,
+        websocket: "ServerConnection",
+        writer: asyncio.StreamWriter,
+        container_id: str,
+        exec_id: str,
+        recorder: Optional[Recorder],
+    ) -> None:
+        from websockets.exceptions import ConnectionClosed
+
+        touched_at = 0.0
+        try:
+            async for message in websocket:
+                # Text messages are JSON control messages, binary ones are input
+                if isinstance(message, str):
+                    try:
+                        control = json.loads(message)
+                        if control.get("type") == "resize":
+                            rows, cols = int(control["rows"]), int(control["cols"])
+                            await self._call(
+                                self._resize, container_id, exec_id, rows, cols
+                            )
+                            if recorder is not None and recorder.resize(rows, cols):
+                                self._write_block(recorder)
+                    except (ValueError, KeyError, TypeError):
+                        pass
+                    continue
+
+                writer.write(message)
+                if recorder is not None and recorder.record(INPUT, message):
+                    self._write_block(recorder)
+                await writer.drain()
+                if time.monotonic() - touched_at > TOUCH_INTERVAL:
+                    touched_at = time.monotonic()
+                    self._call(inventory.touch, container_id)
+        except ConnectionClosed:
+            pass
+
+    async def _serve(self) -> None:
+        from websockets.asyncio.server import serve
+
+        config = self.app.config
+        async with serve(
+            self.handle,
+            config["CLOUDSHELL_TERMINAL_BIND"],
+            config["CLOUDSHELL_TERMINAL_PORT"],
+            compression="deflate",
+            max_size=config["CLOUDSHELL_TERMINAL_FRAME_BYTES"] * 4,
+            write_limit=config["CLOUDSHELL_TERMINAL_WRITE_LIMIT"],
+        ) as server:
+            logger.info(
+                f"Terminal proxy listening on {config['CLOUDSHELL_TERMINAL_BIND']}:"
+                f"{config['CLOUDSHELL_TERMINAL_PORT']}"
+            )
+            await server.serve_forever()
+
+    def serve(self) -> None:
+        """Accept terminal connections until interrupted."""
+        asyncio.run(self._serve())
@@ -1,26 +1,250 @@
-from threading import Thread
+import base64
+import json
+import smtplib
+import time
+import uuid
+from typing import List, Optional
 from flask import current_app
-from flask_mail import Message
-from app.extensions import mail
+from flask_mail import Connection, Message
+from flask_security import MailUtil
+from app import metrics
+from app.extensions import logger, mail
 
+# Messages are queued as JSON in the outbox and sent by `flask cloudshell
+# mailer`. Messages that failed wait in the retry set, scored by when they
+# are due, and are moved to the failed list after MAIL_MAX_ATTEMPTS. The
+# mailer moves the messages it is sending to the processing list and only
+# removes them once sent, retried or failed, so those it was sending when it
+# died are sent when it starts again. One mailer runs per Redis.
+OUTBOX_KEY = "mail:outbox"
+PROCESSING_KEY = "mail:processing"
+RETRY_KEY = "mail:retry"
+FAILED_KEY = "mail:failed"
+FAILED_KEPT = 1000
+# Seconds the mailer waits for mail before checking for due retries
+POLL_TIMEOUT = 1
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+
+def queue(subject, sender, recipients, text_body, html_body, attachments=None) -> str:
+    """Add a message to the outbox.
+
+    Returns:
+        str: The ID of the queued message.
+    """
+    message = {
+        "id": uuid.uuid4().hex,
+        "subject": str(subject),
+        "sender": sender if isinstance(sender, str) else list(sender),
+        "recipients": list(recipients),
+        "body": text_body,
+        "html": html_body,
+        "attachments": [
+            [filename, content_type, base64.b64encode(data).decode()]
+            for filename, content_type, data in attachments or []
+        ],
+        "queued_at": time.time(),
+        "attempts": 0,
+    }
+    current_app.redis.rpush(OUTBOX_KEY, json.dumps(message))
+    return message["id"]
+
+
+def _message(data: dict) -> Message:
+    sender = data["sender"]
+    msg = Message(
+        data["subject"],
+        sender=sender if isinstance(sender, str) else tuple(sender),
+        recipients=data["recipients"],
+    )
+    msg.body = data["body"]
+    msg.html = data["html"]
+    for filename, content_type, content in data["attachments"]:
+        msg.attach(filename, content_type, base64.b64decode(content))
+    return msg
 
 
 def send_email(
     subject, sender, recipients, text_body, html_body, attachments=None, sync=False
 ):
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    if attachments:
-        for attachment in attachments:
-            msg.attach(*attachment)
     if sync:
+        msg = Message(subject, sender=sender, recipients=recipients)
+        msg.body = text_body
+        msg.html = html_body
+        if attachments:
+            for attachment in attachments:
+                msg.attach(*attachment)
         mail.send(msg)
     else:
-        Thread(
-            target=send_async_email, args=(current_app._get_current_object(), msg)
-        ).start()
+        queue(subject, sender, recipients, text_body, html_body, attachments)
+
+
+class QueuedMailUtil(MailUtil):
+    """Sends Flask-Security's mail (confirmations, resets) through the outbox."""
+
+    def send_mail(self, template, subject, recipient, sender, body, html, **kwargs):
+        if isinstance(sender, tuple) and len(sender) == 2:
+            sender = (str(sender[0]), str(sender[1]))
+        else:
+            sender = str(sender)
+        queue(subject, sender, [recipient], body, html)
+
+
+class Mailer:
+    """Delivers queued mail over one SMTP connection, kept open between batches.
+
+    The connection is closed after MAIL_IDLE_TIMEOUT seconds without mail and
+    reopened once if the server drops it. Flask-Mail reconnects by itself
+    after MAIL_MAX_EMAILS messages, if that is set.
+    """
+
+    def __init__(self):
+        self.connection: Optional[Connection] = None
+        self.used_at = 0.0
+
+    def connect(self) -> Connection:
+        if self.connection is None:
+            connection = mail.connect()
+            # What entering the connection's context would do, but kept open
+            connection.host = (
+                None if connection.mail.suppress else connection.configure_host()
+            )
+            self.connection = connection
+        return self.connection
+
+    def close(self) -> None:
+        if self.connection is not None and self.connection.host is not None:
+            try:
+                self.connection.host.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        self.connection = None
+
+    def send(self, msg: Message) -> None:
+        try:
+            self.connect().send(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # The server closed an idle connection
+            self.close()
+            self.connect().send(msg)
+
+    def deliver(self, batch: List[bytes]) -> None:
+        """Send a batch of messages, scheduling retries for those that fail.
+
+        Args:
+            batch (List[bytes]): Messages as taken from the processing list,
+                each removed from it once handled.
+        """
+        for raw in batch:
+            data = json.loads(raw)
+            started = time.monotonic()
+            try:
+                self.send(_message(data))
+            except smtplib.SMTPRecipientsRefused as e:
+                # Permanent, retrying would not help
+                self.fail(data, str(e.recipients), raw)
+                continue
+            except smtplib.SMTPResponseException as e:
+                # The connection is still usable after the server's reply
+                if e.smtp_code >= 500:
+                    self.fail(data, str(e), raw)
+                else:
+                    self.retry(data, e, raw)
+                continue
+            except (smtplib.SMTPException, OSError) as e:
+                self.close()
+                self.retry(data, e, raw)
+                continue
+            # Sent twice rather than lost if the mailer dies before this
+            current_app.redis.lrem(PROCESSING_KEY, 1, raw)
+            metrics.MAIL_SEND_SECONDS.observe(time.monotonic() - started)
+            metrics.MAIL_DELIVERY_SECONDS.observe(time.time() - data["queued_at"])
+            metrics.MAIL_MESSAGES.labels("sent").inc()
+        self.used_at = time.monotonic()
+
+    def retry(self, data: dict, error: Exception, raw: Optional[bytes] = None) -> None:
+        """Retry a message later, with exponential backoff, or give up on it.
+
+        Args:
+            raw (Optional[bytes]): The message as taken from the processing
+                list, removed from it in the same transaction.
+        """
+        config = current_app.config
+        data["attempts"] += 1
+        if data["attempts"] >= config["MAIL_MAX_ATTEMPTS"]:
+            self.fail(data, str(error), raw)
+            return
+        delay = config["MAIL_RETRY_BACKOFF"] * 2 ** (data["attempts"] - 1)
+        logger.warning(
+            f"Error sending mail {data['id']}, retrying in {delay}s: {error}"
+        )
+        pipe = current_app.redis.pipeline()
+        pipe.zadd(RETRY_KEY, {json.dumps(data): time.time() + delay})
+        if raw is not None:
+            pipe.lrem(PROCESSING_KEY, 1, raw)
+        pipe.execute()
+        metrics.MAIL_MESSAGES.labels("retried").inc()
+
+    def fail(self, data: dict, error: str, raw: Optional[bytes] = None) -> None:
+        logger.error(f"Giving up on mail {data['id']} to {data['recipients']}: {error}")
+        data["error"] = error
+        pipe = current_app.redis.pipeline()
+        pipe.lpush(FAILED_KEY, json.dumps(data))
+        pipe.ltrim(FAILED_KEY, 0, FAILED_KEPT - 1)
+        if raw is not None:
+            pipe.lrem(PROCESSING_KEY, 1, raw)
+        pipe.execute()
+        metrics.MAIL_MESSAGES.labels("failed").inc()
+
+    def recover(self) -> int:
+        """Put messages a previous mailer was sending back at the outbox's head."""
+        redis = current_app.redis
+        moved = 0
+        while redis.lmove(PROCESSING_KEY, OUTBOX_KEY, "RIGHT", "LEFT") is not None:
+            moved += 1
+        if moved:
+            logger.warning(
+                f"Requeued {moved} messages left unsent by a previous mailer"
+            )
+        return moved
+
+    def requeue_due(self) -> int:
+        """Move retries that are due back to the outbox."""
+        redis = current_app.redis
+        moved = 0
+        for member in redis.zrangebyscore(RETRY_KEY, 0, time.time()):
+            # Only the mailer that removes a retry requeues it
+            if redis.zrem(RETRY_KEY, member):
+                redis.rpush(OUTBOX_KEY, member)
+                moved += 1
+        return moved
+
+    def next_batch(self) -> List[bytes]:
+        """Move up to MAIL_BATCH_SIZE messages from the outbox to processing."""
+        redis = current_app.redis
+        first = redis.blmove(OUTBOX_KEY, PROCESSING_KEY, POLL_TIMEOUT, "LEFT", "RIGHT")
+        if first is None:
+            return []
+        pipe = redis.pipeline(transaction=False)
+        for _ in range(current_app.config["MAIL_BATCH_SIZE"] - 1):
+            pipe.lmove(OUTBOX_KEY, PROCESSING_KEY, "LEFT", "RIGHT")
+        rest = pipe.execute()
+        return [first, *(raw for raw in rest if raw is not None)]
+
+    def run(self) -> None:
+        """Deliver queued mail until interrupted."""
+        idle_timeout = current_app.config["MAIL_IDLE_TIMEOUT"]
+        logger.info("Delivering queued mail")
+        self.recover()
+        try:
+            while True:
+                self.requeue_due()
+                batch = self.next_batch()
+                if batch:
+                    self.deliver(batch)
+                elif (
+                    self.connection is not None
+                    and time.monotonic() - self.used_at > idle_timeout
+                ):
+                    self.close()
+        finally:
+            self.close()
@@ -1,14 +1,19 @@
 import logging
-import docker
-from docker.errors import DockerException
+import os
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+import click
 from flask_wtf.csrf import CSRFProtect
 from flask_security import Security
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_mail import Mail
 from flask_restx import Api
 from flask_rq2 import RQ
 from flask_babel import Babel, lazy_gettext as _l
+from app import metrics
+
+if TYPE_CHECKING:
+    import docker
 
 # CSRF protection for wtforms
 csrf = CSRFProtect()
@@ -16,7 +21,6 @@ csrf = CSRFProtect()
 security = Security()
 # db
 db: SQLAlchemy = SQLAlchemy()
-migrate = Migrate()
 # Mail
 mail = Mail()
 # API w/ Flask-RESTful
@@ -30,9 +34,164 @@ babel: Babel = Babel()
 logging.basicConfig(level=logging.INFO)
 logger: logging.Logger = logging.getLogger(__name__)
 
-# Create Docker client
-try:
-    client: docker.DockerClient = docker.from_env()
-except DockerException as e:
-    logger.error(f"Failed to connect to Docker: {e}")
-    raise
+# Name of the Docker endpoint configured through the environment
+DEFAULT_HOST = "default"
+
+
+class LazyMigrate:
+    """Adds `flask db` without importing Flask-Migrate and Alembic until it runs.
+
+    Only the migration commands need them, not the web or RQ workers.
+    """
+
+    def init_app(self, app, db) -> None:
+        app.cli.add_command(_MigrateCommands(app, db), name="db")
+
+
+class _MigrateCommands(click.Group):
+    def __init__(self, app, db):
+        super().__init__("db", help="Perform database migrations.")
+        self.app = app
+        self.db = db
+
+    def _load(self) -> click.Group:
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as commands
+
+        if "migrate" not in self.app.extensions:
+            Migrate(self.app, self.db)
+        return commands
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # The real group parses the arguments and runs the subcommand
+        return self._load().make_context(info_name, args, parent, **extra)
+
+    def list_commands(self, ctx):
+        return self._load().list_commands(ctx)
+
+    def get_command(self, ctx, cmd_name):
+        return self._load().get_command(ctx, cmd_name)
+
+
+migrate = LazyMigrate()
+
+
+class DockerClientManager:
+    """Lazily creates Docker clients per process, after any fork.
+
+    Attribute access is forwarded to the default client, so it can be used
+    like a ``docker.DockerClient``. Operations that need a different timeout
+    (image builds and pulls) use ``for_operation``, and shells placed on
+    another daemon from DOCKER_ENDPOINTS use ``for_host``.
+    """
+
+    def __init__(self):
+        self.pool_size = 32
+        self.timeouts: Dict[str, int] = {"default": 30}
+        self.retries = 3
+        self.version: Optional[str] = None
+        self.endpoints: Dict[str, str] = {}
+        self._clients: Dict[Tuple[str, int], "docker.DockerClient"] = {}
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        self.pool_size = app.config["DOCKER_POOL_SIZE"]
+        self.timeouts = {"default": 30, **app.config["DOCKER_TIMEOUTS"]}
+        self.retries = app.config["DOCKER_RETRIES"]
+        self.version = app.config["DOCKER_API_VERSION"]
+        self.endpoints = app.config["DOCKER_ENDPOINTS"]
+        with self._lock:
+            self._clients = {}
+
+    def for_host(
+        self, host: Optional[str], operation: str = "default"
+    ) -> "docker.DockerClient":
+        """Return this process's client for a named Docker endpoint."""
+        return self.for_operation(operation, host)
+
+    def for_operation(
+        self, operation: str = "default", host: Optional[str] = None
+    ) -> "docker.DockerClient":
+        """Return this process's client for an operation's timeout class."""
+        pid = os.getpid()
+        if self._pid != pid:
+            # Sockets inherited from the parent must not be shared
+            with self._lock:
+                if self._pid != pid:
+                    self._clients = {}
+                    self._pid = pid
+        key = (
+            host or DEFAULT_HOST,
+            self.timeouts.get(operation, self.timeouts["default"]),
+        )
+        docker_client = self._clients.get(key)
+        if docker_client is None:
+            with self._lock:
+                docker_client = self._clients.get(key)
+                if docker_client is None:
+                    docker_client = self._create(*key)
+                    self._clients[key] = docker_client
+        return docker_client
+
+    def _create(self, host: str, timeout: int) -> "docker.DockerClient":
+        # Imported with the first client, not by every process loading the app
+        import docker
+        from docker.errors import DockerException
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        options = dict(
+            version=self.version, timeout=timeout, max_pool_size=self.pool_size
+        )
+        try:
+            if host in self.endpoints:
+                docker_client = docker.DockerClient(
+                    base_url=self.endpoints[host], **options
+                )
+            else:
+                # The default host comes from DOCKER_HOST and friends
+                docker_client = docker.from_env(**options)
+        except DockerException as e:
+            logger.error(f"Failed to connect to Docker host {host}: {e}")
+            raise
+        # Retry connection errors on idempotent requests only; urllib3's
+        # default allowed methods exclude POST (create, start, stop, exec)
+        retry = Retry(
+            total=self.retries, status=0, backoff_factor=0.1, raise_on_status=False
+        )
+        for prefix, adapter in list(docker_client.api.adapters.items()):
+            if type(adapter) is HTTPAdapter:
+                # Plain TCP daemons use requests' default 10 connection pool
+                docker_client.api.mount(
+                    prefix,
+                    HTTPAdapter(pool_maxsize=self.pool_size, max_retries=retry),
+                )
+            else:
+                adapter.max_retries = retry
+        metrics.instrument_docker(docker_client, host)
+        return docker_client
+
+    def stats(self) -> Dict[str, int]:
+        """Return connection pool utilization for this process."""
+        stats = {"clients": len(self._clients), "max_size": 0, "in_use": 0}
+        stats.update(connections=0, requests=0)
+        for docker_client in list(self._clients.values()):
+            for adapter in set(docker_client.api.adapters.values()):
+                pools = getattr(adapter, "pools", None)
+                if pools is None:
+                    pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    stats["max_size"] += pool.pool.maxsize
+                    stats["in_use"] += pool.pool.maxsize - pool.pool.qsize()
+                    stats["connections"] += pool.num_connections
+                    stats["requests"] += pool.num_requests
+        return stats
+
+    def __getattr__(self, name):
+        return getattr(self.for_operation(), name)
+
+
+# Docker client, created on first use in each process
+client = DockerClientManager()
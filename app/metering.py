@@ -0,0 +1,268 @@
+import glob
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+import sqlalchemy as sa
+from flask import current_app
+from redis.exceptions import ResponseError
+from app.extensions import db, logger
+from app.models import User
+
+# Owners of metered containers that are not shells, e.g. QuickCode runs.
+# Shell owners come from the container inventory.
+OWNERS_KEY = "metering:owners"
+# Usage per user and bucket, and the buckets each user has, for history
+USAGE_KEY = "metering:usage:{}:{}"
+BUCKETS_KEY = "metering:buckets:{}"
+# Cost not yet debited from each user's balance
+UNBILLED_KEY = "metering:unbilled"
+BILLING_KEY = "metering:billing"
+BILLING_LOCK_KEY = "metering:billing:lock"
+
+FIELDS = ("cpu_seconds", "memory_gb_seconds", "network_bytes")
+# Container cgroups with the systemd and cgroupfs cgroup drivers
+CGROUP_PATTERNS = ("system.slice/docker-*.scope", "docker/*")
+CONTAINER_ID = re.compile(r"(?:docker-)?([0-9a-f]{64})(?:\.scope)?$")
+
+Usage = Dict[str, float]
+
+
+def register(container_id: str, user_id: int) -> None:
+    """Bill a container that is not a shell to a user."""
+    current_app.redis.hset(OWNERS_KEY, container_id, user_id)
+
+
+def unregister(container_id: str) -> None:
+    current_app.redis.hdel(OWNERS_KEY, container_id)
+
+
+def _read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def _network_bytes(pid: str) -> int:
+    """Sum the bytes received and sent on a process's non-loopback interfaces."""
+    total = 0
+    # The first two lines are headers
+    for line in _read(f"/proc/{pid}/net/dev").splitlines()[2:]:
+        interface, counters = line.split(":", 1)
+        if interface.strip() == "lo":
+            continue
+        fields = counters.split()
+        total += int(fields[0]) + int(fields[8])
+    return total
+
+
+class Collector:
+    """Samples the cgroup v2 counters of every container on this host.
+
+    Each sample reads a few small files per container, instead of making one
+    stats request to the Docker daemon per container, so one collector keeps
+    up with thousands of containers. It must run on the Docker host, with
+    the host's /sys/fs/cgroup and /proc visible. Containers that live for
+    less than one METERING_INTERVAL are never sampled twice and go unbilled.
+    """
+
+    def __init__(self, root: str = "/sys/fs/cgroup"):
+        self.root = root
+        # container ID -> (monotonic time, CPU microseconds, network bytes)
+        self._previous: Dict[str, Tuple[float, int, int]] = {}
+
+    def cgroups(self) -> Dict[str, str]:
+        """Map the ID of each running container to its cgroup directory."""
+        found = {}
+        for pattern in CGROUP_PATTERNS:
+            for path in glob.glob(os.path.join(self.root, pattern)):
+                match = CONTAINER_ID.match(os.path.basename(path))
+                if match:
+                    found[match.group(1)] = path
+        return found
+
+    def sample(self) -> Dict[str, Usage]:
+        """Return each container's usage since the previous sample.
+
+        Containers are only reported from their second sample on, as the
+        first one sets the baseline for the cumulative counters.
+        """
+        now = time.monotonic()
+        current = {}
+        usage = {}
+        for container_id, path in self.cgroups().items():
+            try:
+                cpu_stat = _read(os.path.join(path, "cpu.stat")).split()
+                cpu = int(cpu_stat[cpu_stat.index("usage_usec") + 1])
+                memory = int(_read(os.path.join(path, "memory.current")))
+                pids = _read(os.path.join(path, "cgroup.procs")).split()
+                network = _network_bytes(pids[0]) if pids else 0
+            except (OSError, ValueError, IndexError):
+                # The container exited while it was being read
+                continue
+            current[container_id] = (now, cpu, network)
+            previous = self._previous.get(container_id)
+            if previous is None:
+                continue
+            elapsed = now - previous[0]
+            usage[container_id] = {
+                "cpu_seconds": max(cpu - previous[1], 0) / 1e6,
+                "memory_gb_seconds": memory / 2**30 * elapsed,
+                # Counters restart with the process, e.g. after a resume
+                "network_bytes": max(network - previous[2], 0),
+            }
+        self._previous = current
+        return usage
+
+
+def cost(usage: Usage) -> float:
+    config = current_app.config
+    return (
+        usage["cpu_seconds"] * config["METERING_PRICE_CPU_SECOND"]
+        + usage["memory_gb_seconds"] * config["METERING_PRICE_GB_SECOND"]
+        + usage["network_bytes"] / 2**30 * config["METERING_PRICE_NETWORK_GB"]
+    )
+
+
+def owners(container_ids: List[str]) -> Dict[str, str]:
+    """Return the user each container is billed to, if any."""
+    from app.cloudshell import inventory
+
+    if not container_ids:
+        return {}
+    values = current_app.redis.hmget(OWNERS_KEY, container_ids)
+    found = {cid: v.decode() for cid, v in zip(container_ids, values) if v}
+    shells = inventory.lookup([cid for cid in container_ids if cid not in found])
+    found.update({cid: entry["user_id"] for cid, entry in shells.items()})
+    return found
+
+
+def record(usage: Dict[str, Usage], at: Optional[float] = None) -> int:
+    """Add container usage to its owners' buckets and unbilled cost.
+
+    Returns:
+        int: The number of users charged.
+    """
+    config = current_app.config
+    at = at or time.time()
+    bucket = (
+        int(at // config["METERING_BUCKET_SECONDS"]) * config["METERING_BUCKET_SECONDS"]
+    )
+    retention = config["METERING_RETENTION"]
+
+    totals: Dict[str, Usage] = {}
+    for container_id, user_id in owners(list(usage)).items():
+        total = totals.setdefault(user_id, dict.fromkeys(FIELDS, 0.0))
+        for field in FIELDS:
+            total[field] += usage[container_id][field]
+
+    pipe = current_app.redis.pipeline(transaction=False)
+    for user_id, total in totals.items():
+        key = USAGE_KEY.format(user_id, bucket)
+        for field in FIELDS:
+            pipe.hincrbyfloat(key, field, total[field])
+        pipe.expire(key, retention)
+        pipe.zadd(BUCKETS_KEY.format(user_id), {bucket: bucket})
+        pipe.zremrangebyscore(BUCKETS_KEY.format(user_id), 0, at - retention)
+        pipe.hincrbyfloat(UNBILLED_KEY, user_id, cost(total))
+    pipe.execute()
+    return len(totals)
+
+
+def bill() -> int:
+    """Debit unbilled usage from balances in one transaction.
+
+    The unbilled costs are moved aside first, so usage recorded meanwhile
+    waits for the next run, and are put back if the transaction fails.
+
+    Returns:
+        int: The number of users debited.
+    """
+    redis = current_app.redis
+    # Collectors on every host bill, but only one at a time
+    with redis.lock(BILLING_LOCK_KEY, timeout=60):
+        # Left over by a run that failed part way
+        if not redis.exists(BILLING_KEY):
+            try:
+                redis.rename(UNBILLED_KEY, BILLING_KEY)
+            except ResponseError:
+                # Nothing was recorded since the last run
+                return 0
+        return _debit()
+
+
+def _debit() -> int:
+    redis = current_app.redis
+    costs = {
+        int(user_id): float(amount)
+        for user_id, amount in redis.hgetall(BILLING_KEY).items()
+    }
+    rows = [
+        {"user": user_id, "cost": amount} for user_id, amount in costs.items() if amount
+    ]
+    if rows:
+        users = User.__table__
+        try:
+            db.session.execute(
+                sa.update(users)
+                .where(users.c.id == sa.bindparam("user"))
+                .values(
+                    balance=sa.func.coalesce(users.c.balance, 0.0)
+                    - sa.bindparam("cost")
+                ),
+                rows,
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            pipe = redis.pipeline()
+            for user_id, amount in costs.items():
+                pipe.hincrbyfloat(UNBILLED_KEY, user_id, amount)
+            pipe.delete(BILLING_KEY)
+            pipe.execute()
+            raise
+    redis.delete(BILLING_KEY)
+    return len(rows)
+
+
+def history(
+    user_id: int, since: float, until: Optional[float] = None
+) -> List[Dict[str, float]]:
+    """Return a user's usage per bucket between two timestamps."""
+    redis = current_app.redis
+    buckets = [
+        int(b)
+        for b in redis.zrangebyscore(
+            BUCKETS_KEY.format(user_id), since, until if until else "+inf"
+        )
+    ]
+    pipe = redis.pipeline(transaction=False)
+    for bucket in buckets:
+        pipe.hgetall(USAGE_KEY.format(user_id, bucket))
+    entries = []
+    for bucket, usage in zip(buckets, pipe.execute()):
+        if not usage:
+            continue
+        entry = {field: float(usage.get(field.encode(), 0)) for field in FIELDS}
+        entries.append({"at": bucket, **entry, "cost": cost(entry)})
+    return entries
+
+
+def run() -> None:
+    """Sample this host's containers and bill their owners until interrupted."""
+    config = current_app.config
+    collector = Collector(config["METERING_CGROUP_ROOT"])
+    billed_at = time.monotonic()
+    logger.info(f"Metering containers in {collector.root}")
+    while True:
+        started = time.monotonic()
+        try:
+            record(collector.sample())
+        except Exception as e:
+            logger.error(f"Error recording container usage: {e}")
+        if time.monotonic() - billed_at > config["METERING_BILLING_INTERVAL"]:
+            try:
+                logger.info(f"Billed {bill()} users")
+            except Exception as e:
+                logger.error(f"Error billing usage: {e}")
+            billed_at = time.monotonic()
+        time.sleep(max(config["METERING_INTERVAL"] - (time.monotonic() - started), 0))
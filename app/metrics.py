@@ -0,0 +1,268 @@
+import hmac
+import os
+import re
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    start_http_server,
+)
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# With PROMETHEUS_MULTIPROC_DIR set, every process (gunicorn and RQ workers,
+# and the forked job processes) writes its samples to memory-mapped files
+# there, and a scrape adds them up, so any worker can answer /metrics.
+# Processes that exit are marked dead so their live gauges stop counting.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+if MULTIPROCESS:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+# Buckets in seconds, from a cached Redis hit to a slow image pull
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+DOCKER_SECONDS = Histogram(
+    "ucloudshell_docker_api_seconds",
+    "Docker Engine API calls, until the response headers arrive",
+    ["operation", "host"],
+    buckets=BUCKETS,
+)
+DOCKER_ERRORS = Counter(
+    "ucloudshell_docker_api_errors",
+    "Docker Engine API calls answered with an error status",
+    ["operation", "host"],
+)
+PHASE_SECONDS = Histogram(
+    "ucloudshell_shell_phase_seconds",
+    "Phases of handing out a shell, including each provisioning command",
+    ["phase"],
+    buckets=BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "ucloudshell_http_request_seconds",
+    "HTTP request latency by endpoint",
+    ["endpoint", "method", "status"],
+    buckets=BUCKETS,
+)
+JOB_SECONDS = Histogram(
+    "ucloudshell_job_seconds",
+    "RQ job run time by function",
+    ["function", "status"],
+    buckets=BUCKETS,
+)
+MAIL_SEND_SECONDS = Histogram(
+    "ucloudshell_mail_send_seconds",
+    "SMTP time to send one message",
+    buckets=BUCKETS,
+)
+MAIL_DELIVERY_SECONDS = Histogram(
+    "ucloudshell_mail_delivery_seconds",
+    "Time from queueing a message to sending it, including retries",
+    buckets=BUCKETS,
+)
+MAIL_MESSAGES = Counter(
+    "ucloudshell_mail_messages",
+    "Queued messages by outcome: sent, retried or failed",
+    ["outcome"],
+)
+AUTH_CACHE_LOOKUPS = Counter(
+    "ucloudshell_auth_cache_lookups",
+    "Users of token-authenticated requests by where they were found: local, "
+    "redis or miss",
+    ["result"],
+)
+
+# Path segments after the resource that are IDs or names, not actions
+_API_VERSION = re.compile(r"^/v[0-9.]+")
+_ACTIONS = {
+    "json",
+    "create",
+    "start",
+    "stop",
+    "restart",
+    "kill",
+    "wait",
+    "attach",
+    "logs",
+    "stats",
+    "exec",
+    "resize",
+    "top",
+    "pause",
+    "unpause",
+    "push",
+    "tag",
+    "build",
+    "prune",
+    "events",
+    "info",
+    "version",
+    "_ping",
+}
+
+
+def docker_operation(method: str, path: str) -> str:
+    """Name the operation of a Docker API request, e.g. containers.start."""
+    segments = _API_VERSION.sub("", path).strip("/").split("/")
+    action = segments[-1] if segments[-1] in _ACTIONS else method.lower()
+    if len(segments) == 1:
+        return segments[0]
+    return f"{segments[0]}.{action}"
+
+
+def instrument_docker(docker_client, host: str) -> None:
+    """Time every request a Docker client makes."""
+
+    def observe(response, *args, **kwargs):
+        operation = docker_operation(
+            response.request.method, response.request.path_url.split("?")[0]
+        )
+        DOCKER_SECONDS.labels(operation, host).observe(response.elapsed.total_seconds())
+        if response.status_code >= 400:
+            DOCKER_ERRORS.labels(operation, host).inc()
+
+    docker_client.api.hooks["response"].append(observe)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time a phase of handing out a shell."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+def observe_job(job, status: str) -> None:
+    if job.started_at and job.ended_at:
+        JOB_SECONDS.labels(job.func_name, status).observe(
+            (job.ended_at - job.started_at).total_seconds()
+        )
+
+
+class StateCollector:
+    """Reports queue depths and container counts when scraped.
+
+    These are read from Redis and the database at scrape time rather than
+    tracked by every process, so they stay right across restarts.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def describe(self):
+        # Keeps registration from collecting, which needs Redis and the DB
+        return []
+
+    def collect(self):
+        import sqlalchemy as sa
+        from rq.registry import StartedJobRegistry
+        from app.extensions import db
+        from app.models import Container
+
+        with self.app.app_context():
+            queue = self.app.task_queue
+            depth = GaugeMetricFamily(
+                "ucloudshell_queue_jobs", "RQ jobs by state", labels=["queue", "state"]
+            )
+            depth.add_metric([queue.name, "queued"], queue.count)
+            depth.add_metric(
+                [queue.name, "started"],
+                StartedJobRegistry(queue=queue).count,
+            )
+            depth.add_metric([queue.name, "failed"], queue.failed_job_registry.count)
+            yield depth
+
+            from app import email
+
+            redis = self.app.redis
+            outbox = GaugeMetricFamily(
+                "ucloudshell_mail_queue_messages",
+                "Queued mail by state",
+                labels=["state"],
+            )
+            outbox.add_metric(["queued"], redis.llen(email.OUTBOX_KEY))
+            outbox.add_metric(["sending"], redis.llen(email.PROCESSING_KEY))
+            outbox.add_metric(["retrying"], redis.zcard(email.RETRY_KEY))
+            outbox.add_metric(["failed"], redis.llen(email.FAILED_KEY))
+            yield outbox
+
+            containers = GaugeMetricFamily(
+                "ucloudshell_containers",
+                "Shell containers by status",
+                labels=["status"],
+            )
+            rows = db.session.execute(
+                sa.select(Container.status, sa.func.count()).group_by(Container.status)
+            )
+            for status, count in rows:
+                containers.add_metric([status or "unknown"], count)
+            yield containers
+
+
+def registry() -> CollectorRegistry:
+    """Return the registry holding this process's, or all processes', samples."""
+    if MULTIPROCESS:
+        scrape_registry = CollectorRegistry()
+        MultiProcessCollector(scrape_registry)
+        return scrape_registry
+    return REGISTRY
+
+
+def mark_dead(pid: int) -> None:
+    """Drop the live gauge samples of a process that has exited."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
+
+
+def may_scrape(request, token: Optional[str]) -> bool:
+    """Allow scrapes with the bearer token, or from this host without one."""
+    if token:
+        given = request.headers.get("Authorization", "")
+        return hmac.compare_digest(given.encode(), f"Bearer {token}".encode())
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+
+def init_app(app) -> None:
+    """Time requests and serve /metrics to scrapers with METRICS_TOKEN."""
+    from flask import Response, abort, g, request
+
+    scrape_registry = registry()
+    state_registry = CollectorRegistry()
+    state_registry.register(StateCollector(app))
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            REQUEST_SECONDS.labels(
+                request.endpoint or "unmatched", request.method, response.status_code
+            ).observe(time.perf_counter() - started)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        if not may_scrape(request, app.config["METRICS_TOKEN"]):
+            abort(403)
+        return Response(
+            generate_latest(scrape_registry) + generate_latest(state_registry),
+            mimetype=CONTENT_TYPE_LATEST,
+        )
+
+
+def serve(port: Optional[int]) -> None:
+    """Serve metrics from a process that is not a web worker, e.g. RQ workers."""
+    if port:
+        start_http_server(port, registry=registry())
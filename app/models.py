@@ -1,4 +1,5 @@
 from typing import Optional
+from uuid import uuid4
 import redis
 import rq
 from datetime import datetime, timezone
@@ -53,20 +54,77 @@ class User(db.Model, UserMixin):
     # Relationships
     containers = db.relationship("Container", back_populates="user")
     tasks = db.relationship("Task", back_populates="user")
+    ssh_keys = db.relationship("SSHKey", back_populates="user")
+    recordings = db.relationship("Recording", back_populates="user")
 
     #  Task Functions
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue(f"app.{name}", self.id, *args, **kwargs)
-        task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
+        # Commit the task before enqueueing so the worker can always find it
+        task = Task(id=str(uuid4()), name=name, description=description, user=self)
         db.session.add(task)
+        db.session.commit()
+        current_app.task_queue.enqueue(
+            f"app.{name}",
+            self.id,
+            *args,
+            job_id=task.id,
+            meta={"user_id": self.id},
+            **kwargs,
+        )
         return task
 
+    def add_ssh_key(self, key):
+        """Save an OpenSSH public key line for logging in through the gateway."""
+        parts = key.split()
+        if len(parts) < 2:
+            raise ValueError("Invalid SSH public key")
+        key_type, key_data = parts[:2]
+        exists = db.session.scalar(
+            sa.select(SSHKey.id).where(
+                SSHKey.user_id == self.id, SSHKey.key_data == key_data
+            )
+        )
+        if exists is None:
+            db.session.add(
+                SSHKey(
+                    user=self,
+                    key_type=key_type,
+                    key_data=key_data,
+                    comment=" ".join(parts[2:]) or None,
+                )
+            )
+
+    def get_tasks(self, complete=None, before=None, limit=50):
+        """Return a page of tasks, newest first.
+
+        Args:
+            complete (Optional[bool]): Only return complete or incomplete tasks.
+            before (Optional[Tuple[datetime, str]]): The (created_at, id) of the
+                last task on the previous page.
+            limit (int): The page size.
+        """
+        query = sa.select(Task).where(Task.user_id == self.id)
+        if complete is not None:
+            query = query.where(Task.complete.is_(complete))
+        if before is not None:
+            created_at, task_id = before
+            query = query.where(
+                sa.or_(
+                    Task.created_at < created_at,
+                    sa.and_(Task.created_at == created_at, Task.id < task_id),
+                )
+            )
+        query = query.order_by(Task.created_at.desc(), Task.id.desc()).limit(limit)
+        return db.session.scalars(query).all()
+
     def get_tasks_in_progress(self):
-        query = self.tasks.select().where(Task.complete is False)
+        query = sa.select(Task).where(Task.user_id == self.id, Task.complete.is_(False))
         return db.session.scalars(query)
 
     def get_task_in_progress(self, name):
-        query = self.tasks.select().where(Task.name == name, Task.complete is False)
+        query = sa.select(Task).where(
+            Task.user_id == self.id, Task.name == name, Task.complete.is_(False)
+        )
         return db.session.scalar(query)
 
 
@@ -83,11 +141,54 @@ class Container(db.Model):
     created_at = db.Column(sa.DateTime, default=sa.func.now())
     updated_at = db.Column(sa.DateTime, default=sa.func.now(), onupdate=sa.func.now())
     status = db.Column(sa.String(255), default="running")
+    # Port sshd listens on at the container's address on CLOUDSHELL_NETWORK
     port = db.Column(sa.Integer, nullable=False)
+    # Name of the Docker endpoint the container was placed on
+    host = db.Column(sa.String(255))
+    # sshd's public host key, read over the Docker API when the shell is
+    # handed out and checked by the SSH gateway on every connection
+    host_key = db.Column(sa.Text)
 
     user = db.relationship("User", back_populates="containers")
 
 
+class SSHKey(db.Model):
+    id = db.Column(sa.Integer, primary_key=True)
+    user_id = db.Column(sa.Integer, sa.ForeignKey("user.id"), index=True)
+    key_type = db.Column(sa.String(64), nullable=False)
+    # Base64 key blob, compared against the key offered by SSH clients
+    key_data = db.Column(sa.Text, nullable=False)
+    comment = db.Column(sa.String(255))
+    created_at = db.Column(sa.DateTime, default=sa.func.now())
+
+    user = db.relationship("User", back_populates="ssh_keys")
+
+
+class Recording(db.Model):
+    id = db.Column(sa.String(36), primary_key=True)
+    container_id = db.Column(sa.String(255), index=True, nullable=False)
+    user_id = db.Column(sa.Integer, sa.ForeignKey("user.id"), index=True)
+    # "web" for the browser terminal, "ssh" for the SSH gateway
+    source = db.Column(sa.String(16), nullable=False)
+    started_at = db.Column(sa.DateTime, default=sa.func.now())
+    ended_at = db.Column(sa.DateTime)
+    duration_ms = db.Column(sa.Integer)
+    size = db.Column(sa.Integer)
+
+    user = db.relationship("User", back_populates="recordings")
+
+    def to_dict(self):
+        return {
+            "recording_id": self.id,
+            "container_id": self.container_id,
+            "source": self.source,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "ended_at": self.ended_at.isoformat() if self.ended_at else None,
+            "duration_ms": self.duration_ms,
+            "size": self.size,
+        }
+
+
 class Task(db.Model):
     id: so.Mapped[str] = so.mapped_column(sa.String(36), primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
@@ -98,9 +199,27 @@ class Task(db.Model):
     complete: so.Mapped[bool] = so.mapped_column(
         sa.Boolean, default=False, nullable=False
     )
+    # Last phase transition, written in batches by app.progress
+    phase: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), nullable=True)
+    progress: so.Mapped[int] = so.mapped_column(
+        sa.Integer, default=0, server_default="0", nullable=False
+    )
+    # Set in Python, keyset pagination needs sub-second, consistent values
+    created_at: so.Mapped[datetime] = so.mapped_column(
+        sa.DateTime,
+        default=lambda: datetime.now(timezone.utc),
+        server_default=sa.func.now(),
+        nullable=False,
+    )
 
     user: so.Mapped["User"] = so.relationship("User", back_populates="tasks")
 
+    # Listings filter by user and completion and page newest first
+    __table_args__ = (
+        sa.Index("ix_task_user_id_complete", "user_id", "complete", "created_at"),
+        sa.Index("ix_task_user_id_created_at", "user_id", "created_at"),
+    )
+
     def get_rq_job(self):
         try:
             rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
@@ -109,5 +228,80 @@ class Task(db.Model):
         return rq_job
 
     def get_progress(self):
+        from app import progress
+
+        state = progress.get(self.id)
+        if state is not None:
+            return state["progress"]
         job = self.get_rq_job()
         return job.meta.get("progress", 0) if job is not None else 100
+
+    def _status(self, job, state, result=True):
+        if job is None:
+            return {
+                "task_id": self.id,
+                "status": "unknown",
+                "phase": self.phase,
+                "progress": 100,
+            }
+        # The published state is more recent than the meta saved on the job
+        state = state or {
+            "phase": job.meta.get("phase"),
+            "progress": job.meta.get("progress", 0),
+        }
+        job_status = job.get_status(refresh=False)
+        status = {
+            "task_id": self.id,
+            "status": job_status,
+            "phase": state["phase"],
+            "progress": state["progress"],
+        }
+        if job_status == rq.job.JobStatus.FINISHED and result:
+            status["result"] = job.return_value()
+        elif job_status == rq.job.JobStatus.FAILED:
+            status["error"] = job.meta.get("error")
+        return status
+
+    def get_status(self):
+        from app import progress
+
+        return self._status(self.get_rq_job(), progress.get(self.id))
+
+    @staticmethod
+    def get_statuses(tasks):
+        """Summarise a page of tasks with two pipelined Redis calls.
+
+        Results are left out, as fetching one is a round trip per task.
+        Completed tasks are described from the database alone.
+        """
+        from app import progress
+
+        running = [task.id for task in tasks if not task.complete]
+        jobs, states = {}, {}
+        if running:
+            try:
+                fetched = rq.job.Job.fetch_many(running, connection=current_app.redis)
+                jobs = {job.id: job for job in fetched if job is not None}
+                states = progress.get_many(running)
+            except redis.exceptions.RedisError:
+                pass
+        statuses = []
+        for task in tasks:
+            if task.complete:
+                status = {
+                    "task_id": task.id,
+                    "status": "failed" if task.phase == "failed" else "finished",
+                    "phase": task.phase,
+                    "progress": 100,
+                }
+            else:
+                status = task._status(
+                    jobs.get(task.id), states.get(task.id), result=False
+                )
+            status.update(
+                name=task.name,
+                description=task.description,
+                created_at=task.created_at.isoformat() if task.created_at else None,
+            )
+            statuses.append(status)
+        return statuses
@@ -0,0 +1,241 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from flask import current_app, g, request
+from app.extensions import logger
+
+# Recent profiles by time, and each profile as JSON
+PROFILES_KEY = "profiling:profiles"
+PROFILE_KEY = "profiling:profile:{}"
+# Set while every request is profiled, with the TTL given when enabled
+TOGGLE_KEY = "profiling:enabled"
+HEADER = "X-Profile"
+# Seconds each process trusts its last read of TOGGLE_KEY
+TOGGLE_CHECK_INTERVAL = 5
+MAX_DEPTH = 128
+
+# Time is attributed to the innermost of these libraries on the stack
+CATEGORIES = ("docker", "sqlalchemy", "redis")
+
+Stack = Tuple[str, ...]
+
+
+def _stack(frame) -> Stack:
+    """Return a frame's call stack, outermost call first."""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_qualname}")
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+def _category(stack: Stack) -> str:
+    for name in reversed(stack):
+        package = name.split(".", 1)[0].split(":", 1)[0]
+        if package in CATEGORIES:
+            return package
+    return "python"
+
+
+class Sampler:
+    """Samples the stacks of registered threads from one background thread.
+
+    Each sample is one `sys._current_frames()` call, so profiling many
+    concurrent requests costs little more than profiling one. The thread
+    only runs once a request has been registered.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._samples: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def start(self, thread_id: int) -> None:
+        with self._lock:
+            self._samples[thread_id] = Counter()
+            # A thread started before a fork does not exist in the child
+            if not (self._thread and self._thread.is_alive()) or (
+                self._pid != os.getpid()
+            ):
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name="profiler", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self, thread_id: int) -> Counter:
+        with self._lock:
+            return self._samples.pop(thread_id, Counter())
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                samples = dict(self._samples)
+            if not samples:
+                continue
+            frames = sys._current_frames()
+            for thread_id, counter in samples.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    counter[_stack(frame)] += 1
+
+
+def enable(seconds: int) -> None:
+    """Profile every request under PROFILING_PATHS for a while."""
+    current_app.redis.set(TOGGLE_KEY, 1, ex=seconds)
+
+
+def disable() -> None:
+    current_app.redis.delete(TOGGLE_KEY)
+
+
+def save(profile: dict, samples: Counter) -> str:
+    """Store a profile with its collapsed stacks and time breakdown.
+
+    The breakdown splits the request's duration between Docker, SQLAlchemy,
+    Redis and the rest in proportion to the samples taken in each.
+
+    Returns:
+        str: The ID of the profile.
+    """
+    config = current_app.config
+    total = sum(samples.values())
+    stacks: Counter = Counter()
+    breakdown: Counter = Counter()
+    for stack, count in samples.items():
+        stacks[";".join(stack)] += count
+        breakdown[_category(stack)] += count
+    profile = {
+        "id": uuid.uuid4().hex,
+        "at": time.time(),
+        "samples": total,
+        "interval_ms": config["PROFILING_INTERVAL_MS"],
+        **profile,
+        "breakdown_ms": {
+            category: round(count / total * profile["duration_ms"])
+            for category, count in breakdown.most_common()
+        },
+        # One "outer;...;inner count" line per stack, as read by flamegraph.pl
+        # and speedscope
+        "stacks": "\n".join(f"{s} {c}" for s, c in stacks.most_common()),
+    }
+    pipe = current_app.redis.pipeline()
+    pipe.set(
+        PROFILE_KEY.format(profile["id"]),
+        json.dumps(profile),
+        ex=config["PROFILING_RETENTION"],
+    )
+    pipe.zadd(PROFILES_KEY, {profile["id"]: profile["at"]})
+    pipe.zremrangebyrank(PROFILES_KEY, 0, -config["PROFILING_MAX_PROFILES"] - 1)
+    pipe.execute()
+    return profile["id"]
+
+
+def get(profile_id: str) -> Optional[dict]:
+    data = current_app.redis.get(PROFILE_KEY.format(profile_id))
+    return json.loads(data) if data else None
+
+
+def recent(limit: int = 20) -> List[dict]:
+    """Return the latest profiles, newest first, without their stacks."""
+    redis = current_app.redis
+    ids = redis.zrevrange(PROFILES_KEY, 0, limit - 1)
+    if not ids:
+        return []
+    profiles = []
+    for data in redis.mget([PROFILE_KEY.format(i.decode()) for i in ids]):
+        if data:
+            profile = json.loads(data)
+            profile.pop("stacks")
+            profiles.append(profile)
+    return profiles
+
+
+def init_app(app) -> None:
+    """Profile requests that ask for it, while enabled, or that are slow.
+
+    With PROFILING_ENABLED off no hooks are installed. Otherwise requests
+    that are not profiled only pay for a header lookup and, every few
+    seconds, a read of TOGGLE_KEY.
+    """
+    if not app.config["PROFILING_ENABLED"]:
+        return
+    sampler = Sampler(app.config["PROFILING_INTERVAL_MS"] / 1000)
+    paths = tuple(app.config["PROFILING_PATHS"])
+    token = app.config["PROFILING_TOKEN"]
+    slow_ms = app.config["PROFILING_SLOW_MS"]
+    toggle = {"enabled": False, "checked_at": 0.0}
+
+    def toggled() -> bool:
+        now = time.monotonic()
+        if now - toggle["checked_at"] > TOGGLE_CHECK_INTERVAL:
+            toggle["checked_at"] = now
+            try:
+                toggle["enabled"] = bool(app.redis.exists(TOGGLE_KEY))
+            except Exception as e:
+                logger.warning(f"Could not check whether profiling is on: {e}")
+        return toggle["enabled"]
+
+    def trigger() -> Optional[str]:
+        if token and request.headers.get(HEADER) == token:
+            return "header"
+        if toggled():
+            return "toggle"
+        if slow_ms:
+            return "slow"
+        return None
+
+    def finish(status: int) -> Optional[str]:
+        reason, started = g.pop("profile")
+        samples = sampler.stop(threading.get_ident())
+        duration_ms = (time.perf_counter() - started) * 1000
+        if not samples or (reason == "slow" and duration_ms < slow_ms):
+            return None
+        try:
+            return save(
+                {
+                    "trigger": reason,
+                    "method": request.method,
+                    "path": request.path,
+                    "endpoint": request.endpoint,
+                    "status": status,
+                    "duration_ms": round(duration_ms, 1),
+                },
+                samples,
+            )
+        except Exception as e:
+            logger.warning(f"Could not save the profile of {request.path}: {e}")
+            return None
+
+    @app.before_request
+    def start_profile():
+        if not request.path.startswith(paths):
+            return
+        reason = trigger()
+        if reason:
+            g.profile = (reason, time.perf_counter())
+            sampler.start(threading.get_ident())
+
+    @app.after_request
+    def finish_profile(response):
+        # Streamed responses are profiled until their headers are sent
+        if "profile" in g:
+            profile_id = finish(response.status_code)
+            if profile_id:
+                response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    @app.teardown_request
+    def abandon_profile(error):
+        # Requests that raised skip after_request
+        if "profile" in g:
+            finish(500)
@@ -0,0 +1,165 @@
+import json
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional
+import sqlalchemy as sa
+from flask import current_app
+from app.extensions import db, logger
+from app.models import Task
+
+# Workers publish every progress update on their user's channel and keep the
+# latest state of each task in a hash. Tasks whose phase changed are added
+# to a dirty set, which the persister drains into the Task table in batches.
+CHANNEL = "tasks:progress:{}"
+STATE_KEY = "tasks:state:{}"
+DIRTY_KEY = "tasks:dirty"
+# Seconds the latest state of a task is kept once it stops changing
+STATE_TTL = 86400
+
+
+def publish(
+    task_id: str,
+    user_id: int,
+    progress: int,
+    phase: Optional[str] = None,
+    transition: bool = False,
+) -> None:
+    """Publish a task's progress in one round trip to Redis.
+
+    Args:
+        task_id (str): The task, which is also the RQ job ID.
+        user_id (int): The user the task belongs to.
+        progress (int): Percentage complete, 100 once the task is done.
+        phase (Optional[str]): The step the task is in.
+        transition (bool): Whether the phase changed or the task completed,
+            so the new state needs to reach the database.
+    """
+    state = {"task_id": task_id, "progress": progress, "phase": phase or ""}
+    pipe = current_app.redis.pipeline(transaction=False)
+    pipe.hset(STATE_KEY.format(task_id), mapping={**state, "user_id": user_id})
+    pipe.expire(STATE_KEY.format(task_id), STATE_TTL)
+    if transition:
+        pipe.sadd(DIRTY_KEY, task_id)
+    pipe.publish(CHANNEL.format(user_id), json.dumps(state))
+    pipe.execute()
+
+
+def get(task_id: str) -> Optional[Dict[str, Any]]:
+    """Return the latest published state of a task."""
+    state = current_app.redis.hgetall(STATE_KEY.format(task_id))
+    if not state:
+        return None
+    return {
+        "task_id": task_id,
+        "progress": int(state[b"progress"]),
+        "phase": state[b"phase"].decode() or None,
+    }
+
+
+def get_many(task_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Return the latest published state of several tasks in one round trip."""
+    task_ids = list(task_ids)
+    pipe = current_app.redis.pipeline(transaction=False)
+    for task_id in task_ids:
+        pipe.hgetall(STATE_KEY.format(task_id))
+    return {
+        task_id: {
+            "task_id": task_id,
+            "progress": int(state[b"progress"]),
+            "phase": state[b"phase"].decode() or None,
+        }
+        for task_id, state in zip(task_ids, pipe.execute())
+        if state
+    }
+
+
+def flush(batch_size: int = 500) -> int:
+    """Write the state of tasks that changed phase to the Task table.
+
+    Returns:
+        int: The number of tasks updated.
+    """
+    redis = current_app.redis
+    updated = 0
+    while True:
+        task_ids = [t.decode() for t in redis.spop(DIRTY_KEY, batch_size) or []]
+        if not task_ids:
+            return updated
+        pipe = redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(STATE_KEY.format(task_id))
+        rows = []
+        for task_id, state in zip(task_ids, pipe.execute()):
+            if not state:
+                continue
+            progress = int(state[b"progress"])
+            rows.append(
+                {
+                    "id": task_id,
+                    "progress": progress,
+                    "phase": state[b"phase"].decode() or None,
+                    "complete": progress >= 100,
+                }
+            )
+        if rows:
+            db.session.execute(sa.update(Task), rows)
+            db.session.commit()
+            updated += len(rows)
+
+
+def persist(interval: float = 1.0) -> None:
+    """Persist task state transitions until interrupted.
+
+    The dirty set holds each task once however many times it changed, so a
+    burst of updates from many workers costs one transaction per interval.
+    """
+    logger.info("Persisting task progress")
+    while True:
+        started = time.monotonic()
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Error persisting task progress: {e}")
+            db.session.rollback()
+        time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+def listen(
+    user_id: int, task_ids: Iterable[str] = (), heartbeat: float = 15.0
+) -> Iterator[Optional[Dict[str, Any]]]:
+    """Yield progress updates for a user's tasks as they are published.
+
+    The current state of the given tasks is yielded first. None is yielded
+    when nothing was published for `heartbeat` seconds, so the caller can
+    keep its connection alive. If task IDs are given, the stream ends when
+    all of them are done.
+    """
+    task_ids = set(task_ids)
+    pending = set(task_ids)
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    # Subscribe before reading the current state so no update is missed
+    pubsub.subscribe(CHANNEL.format(user_id))
+    try:
+        for task_id in list(pending):
+            state = get(task_id)
+            if state is not None:
+                yield state
+                if state["progress"] >= 100:
+                    pending.discard(task_id)
+        if task_ids and not pending:
+            return
+        while True:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield None
+                continue
+            state = json.loads(message["data"])
+            state["phase"] = state["phase"] or None
+            if task_ids and state["task_id"] not in task_ids:
+                continue
+            yield state
+            if state["progress"] >= 100:
+                pending.discard(state["task_id"])
+                if task_ids and not pending:
+                    return
+    finally:
+        pubsub.close()
@@ -1,6 +1,9 @@
+import json
 from flask_security.decorators import auth_token_required, current_user
-from flask import jsonify, request
-from app.extensions import csrf
+from flask import Response, current_app, jsonify, request, stream_with_context
+from app.extensions import csrf, db, logger
+from app.models import Task
+from app.quickcode import batch, helpers
 from flask_restx import Resource as DefaultResource, Namespace
 
 
@@ -11,6 +14,18 @@ class Resource(DefaultResource):
     method_decorators = [auth_token_required, csrf.exempt]
 
 
+def _events(image, command, stdin, cache, user_id):
+    """Format a run as Server-Sent Events."""
+    try:
+        for event, data in helpers.stream(image, command, stdin, cache, user_id):
+            if event != "exit":
+                data = {"data": data.decode(errors="replace")}
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    except Exception as e:
+        logger.error(f"Error running QuickCode container: {str(e)}")
+        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+
 @api.route("/run")
 @csrf.exempt
 class RunCode(Resource):
@@ -28,5 +43,98 @@ class RunCode(Resource):
 
         image = request.args.get("image")
         command = request.args.get("run_command")
+        error = helpers.check_image(image)
+        if error:
+            return {"error": error}, 403
+        body = request.get_json(silent=True) or {}
+        stdin = body.get("input")
+        if stdin is not None and (
+            not isinstance(stdin, str)
+            or len(stdin) > current_app.config["QUICKCODE_MAX_INPUT_BYTES"]
+        ):
+            return {"error": "Invalid input"}, 400
+        cache = request.args.get("cache", "").lower() in ("1", "true", "yes")
+
+        # Stream output as it is produced, or queue the run and keep its tail
+        if request.args.get("stream") or "text/event-stream" in request.headers.get(
+            "Accept", ""
+        ):
+            return Response(
+                stream_with_context(
+                    _events(image, command, stdin, cache, current_user.id)
+                ),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        if cache:
+            # Answer repeat runs straight away instead of queueing them
+            result = helpers.cached_result(helpers.result_key(image, command, stdin))
+            if result is not None:
+                return {"status": "finished", "result": result}
+
+        task = current_user.launch_task(
+            "tasks.run_code", "Run code", image, command, stdin, cache
+        )
+        return {"status": "queued", "task_id": task.id}, 202
+
+
+@api.route("/tasks/<string:task_id>")
+class RunStatus(Resource):
+    def get(self, task_id):
+        task = db.session.get(Task, task_id)
+        if task is None or task.user_id != current_user.id:
+            return {"error": "Task not found"}, 404
+        return task.get_status()
+
+
+@api.route("/batch")
+class RunBatch(Resource):
+    def post(self):
+        body = request.get_json(silent=True) or {}
+        jobs = body.get("jobs")
+        if not isinstance(jobs, list) or not jobs:
+            return {"error": "No jobs provided"}, 400
+        if len(jobs) > current_app.config["QUICKCODE_BATCH_MAX_ITEMS"]:
+            return {"error": "Too many jobs"}, 400
+        max_input = current_app.config["QUICKCODE_MAX_INPUT_BYTES"]
+        if not all(
+            isinstance(job, dict)
+            and isinstance(job.get("image"), str)
+            and isinstance(job.get("run_command"), str)
+            and isinstance(job.get("input") or "", str)
+            and len(job.get("input") or "") <= max_input
+            for job in jobs
+        ):
+            return {"error": "Every job needs an image and a run_command"}, 400
+
+        batch_id = batch.submit(
+            current_user.id,
+            [
+                {
+                    "image": job["image"],
+                    "command": job["run_command"],
+                    "input": job.get("input"),
+                    "cache": bool(job.get("cache", False)),
+                }
+                for job in jobs
+            ],
+        )
+        return {"status": "queued", "batch_id": batch_id, "total": len(jobs)}, 202
+
+
+@api.route("/batch/<string:batch_id>")
+class BatchStatus(Resource):
+    def get(self, batch_id):
+        if batch.owner(batch_id) != current_user.id:
+            return {"error": "Batch not found"}, 404
+        offset = max(request.args.get("offset", 0, type=int), 0)
+        return batch.status(
+            batch_id, offset, current_app.config["QUICKCODE_BATCH_PAGE_SIZE"]
+        )
+
 
-        current_user.launch_task("quickcode.helpers.run_code")
+@api.route("/cache")
+class CacheStats(Resource):
+    def get(self):
+        return helpers.cache_stats()
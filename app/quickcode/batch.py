@@ -0,0 +1,248 @@
+import json
+import time
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+from flask import current_app
+from app.extensions import logger
+from app.quickcode.helpers import check_image
+
+# A batch is a hash of its owner and size plus a hash of item states keyed
+# by index. Items wait in one list per user until the scheduler starts them.
+BATCH_KEY = "quickcode:batch:{}"
+ITEMS_KEY = "quickcode:batch:{}:items"
+PENDING_KEY = "quickcode:pending:{}"
+# Users with pending items, least recently served first
+USERS_KEY = "quickcode:users"
+# Started items scored by lease expiry, globally and per user, so slots held
+# by a worker that died are reclaimed once the lease runs out. A slot is
+# leased for the time a job may wait in the task queue, then renewed for the
+# run itself when a worker picks the job up.
+RUNNING_KEY = "quickcode:running"
+USER_RUNNING_KEY = "quickcode:running:{}"
+DISPATCH_LOCK_KEY = "quickcode:dispatch"
+
+
+def _ttl() -> int:
+    return current_app.config["QUICKCODE_BATCH_TTL"]
+
+
+def _lease() -> int:
+    config = current_app.config
+    return config["QUICKCODE_TIMEOUT"] + config["DOCKER_TIMEOUTS"]["pull"]
+
+
+def _queue_timeout() -> int:
+    return current_app.config["QUICKCODE_BATCH_QUEUE_TIMEOUT"]
+
+
+def _reclaim(now: float) -> None:
+    """Free expired slots, putting items that never started back in line."""
+    redis = current_app.redis
+    for item_id in redis.zrangebyscore(RUNNING_KEY, 0, now):
+        item_id = item_id.decode()
+        batch_id, index = item_id.rsplit(":", 1)
+        item, user_id = get_item(batch_id, int(index)), owner(batch_id)
+        redis.zrem(RUNNING_KEY, item_id)
+        if item is None or user_id is None:
+            continue
+        redis.zrem(USER_RUNNING_KEY.format(user_id), item_id)
+        if item["status"] == "pending":
+            # The job was dropped from the task queue, or its worker died
+            pipe = redis.pipeline()
+            pipe.lpush(PENDING_KEY.format(user_id), item_id)
+            pipe.lrem(USERS_KEY, 0, user_id)
+            pipe.lpush(USERS_KEY, user_id)
+            pipe.execute()
+        elif item["status"] == "running":
+            logger.warning(f"Lost QuickCode batch item {item_id}")
+            update_item(
+                batch_id,
+                int(index),
+                status="failed",
+                finished_at=time.time(),
+                error="The worker running this item stopped",
+            )
+
+
+def submit(user_id: int, jobs: List[Dict[str, Any]]) -> str:
+    """Queue (image, command) jobs for a user and start as many as allowed.
+
+    Args:
+        user_id (int): The user submitting the jobs.
+        jobs (List[Dict[str, Any]]): Items with an "image" and a "command",
+            and optionally an "input" and whether to "cache" the result.
+            Items with images that may not be run are rejected straight away.
+
+    Returns:
+        str: The batch ID.
+    """
+    redis = current_app.redis
+    batch_id = str(uuid4())
+    items = {}
+    queued = []
+    for index, job in enumerate(jobs):
+        item = {
+            "index": index,
+            "image": job["image"],
+            "command": job["command"],
+            "input": job.get("input"),
+            "cache": job.get("cache", False),
+        }
+        error = check_image(job["image"])
+        if error:
+            item.update(status="rejected", error=error)
+        else:
+            item["status"] = "pending"
+            queued.append(f"{batch_id}:{index}")
+        items[index] = json.dumps(item)
+
+    pipe = redis.pipeline()
+    pipe.hset(
+        BATCH_KEY.format(batch_id),
+        mapping={"user_id": user_id, "total": len(jobs), "created_at": time.time()},
+    )
+    pipe.hset(ITEMS_KEY.format(batch_id), mapping=items)
+    pipe.expire(BATCH_KEY.format(batch_id), _ttl())
+    pipe.expire(ITEMS_KEY.format(batch_id), _ttl())
+    if queued:
+        pipe.rpush(PENDING_KEY.format(user_id), *queued)
+        pipe.lrem(USERS_KEY, 0, user_id)
+        pipe.rpush(USERS_KEY, user_id)
+    pipe.execute()
+    dispatch()
+    return batch_id
+
+
+def dispatch() -> int:
+    """Start pending items while there are free slots.
+
+    Each free slot goes to the user with the fewest items running, ties going
+    to the one served least recently, so a user with hundreds of queued items
+    cannot hold more than their share of the QUICKCODE_MAX_CONCURRENCY slots,
+    nor ever more than QUICKCODE_MAX_CONCURRENCY_PER_USER.
+
+    Besides on submit and when an item finishes, this runs periodically from
+    the inventory sync loop, so items are restarted after a worker dies.
+
+    Returns:
+        int: The number of items started.
+    """
+    redis = current_app.redis
+    config = current_app.config
+    now = time.time()
+    started = []
+    with redis.lock(DISPATCH_LOCK_KEY, timeout=30):
+        _reclaim(now)
+        running = redis.zcard(RUNNING_KEY)
+        while running < config["QUICKCODE_MAX_CONCURRENCY"]:
+            users = [u.decode() for u in redis.lrange(USERS_KEY, 0, -1)]
+            pipe = redis.pipeline()
+            for user_id in users:
+                pipe.zremrangebyscore(USER_RUNNING_KEY.format(user_id), 0, now)
+                pipe.zcard(USER_RUNNING_KEY.format(user_id))
+            counts = pipe.execute()[1::2]
+            eligible = [
+                (count, turn, user_id)
+                for turn, (user_id, count) in enumerate(zip(users, counts))
+                if count < config["QUICKCODE_MAX_CONCURRENCY_PER_USER"]
+            ]
+            if not eligible:
+                break
+            _, _, user_id = min(eligible)
+            user_running = USER_RUNNING_KEY.format(user_id)
+            item_id = redis.lpop(PENDING_KEY.format(user_id))
+            redis.lrem(USERS_KEY, 0, user_id)
+            if item_id is None:
+                continue
+            item_id = item_id.decode()
+            pipe = redis.pipeline()
+            # Back of the line until the other users have had a turn
+            pipe.rpush(USERS_KEY, user_id)
+            expires = now + _queue_timeout()
+            pipe.zadd(RUNNING_KEY, {item_id: expires})
+            pipe.zadd(user_running, {item_id: expires})
+            pipe.execute()
+            running += 1
+            started.append(item_id)
+
+    for item_id in started:
+        batch_id, index = item_id.rsplit(":", 1)
+        # Dropped if not started before its slot could be reclaimed
+        current_app.task_queue.enqueue(
+            "app.tasks.run_batch_item",
+            batch_id,
+            int(index),
+            job_timeout=_lease(),
+            ttl=_queue_timeout(),
+        )
+    return len(started)
+
+
+def start(batch_id: str, index: int, user_id: int) -> bool:
+    """Renew an item's slot for its run, when a worker picks it up.
+
+    Returns:
+        bool: False if the slot was reclaimed and the item must not run.
+    """
+    redis = current_app.redis
+    item_id = f"{batch_id}:{index}"
+    if redis.zscore(RUNNING_KEY, item_id) is None:
+        return False
+    expires = time.time() + _lease()
+    pipe = redis.pipeline()
+    pipe.zadd(RUNNING_KEY, {item_id: expires}, xx=True)
+    pipe.zadd(USER_RUNNING_KEY.format(user_id), {item_id: expires}, xx=True)
+    pipe.execute()
+    return True
+
+
+def get_item(batch_id: str, index: int) -> Optional[Dict[str, Any]]:
+    item = current_app.redis.hget(ITEMS_KEY.format(batch_id), index)
+    return json.loads(item) if item is not None else None
+
+
+def update_item(batch_id: str, index: int, **fields) -> None:
+    item = get_item(batch_id, index)
+    if item is None:
+        return
+    item.update(fields)
+    current_app.redis.hset(ITEMS_KEY.format(batch_id), index, json.dumps(item))
+
+
+def finish(batch_id: str, index: int, user_id: int) -> None:
+    """Free an item's slot and start whatever can run next."""
+    item_id = f"{batch_id}:{index}"
+    pipe = current_app.redis.pipeline()
+    pipe.zrem(RUNNING_KEY, item_id)
+    pipe.zrem(USER_RUNNING_KEY.format(user_id), item_id)
+    pipe.execute()
+    try:
+        dispatch()
+    except Exception as e:
+        logger.error(f"Error dispatching QuickCode batch items: {e}")
+
+
+def owner(batch_id: str) -> Optional[int]:
+    user_id = current_app.redis.hget(BATCH_KEY.format(batch_id), "user_id")
+    return int(user_id) if user_id is not None else None
+
+
+def status(batch_id: str, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+    """Summarise a batch, with the state of a page of its items."""
+    redis = current_app.redis
+    batch = redis.hgetall(BATCH_KEY.format(batch_id))
+    total = int(batch[b"total"])
+    items = [json.loads(item) for item in redis.hvals(ITEMS_KEY.format(batch_id))]
+    counts: Dict[str, int] = {}
+    for item in items:
+        counts[item["status"]] = counts.get(item["status"], 0) + 1
+    items.sort(key=lambda item: item["index"])
+    done = sum(counts.get(s, 0) for s in ("finished", "failed", "rejected"))
+    return {
+        "batch_id": batch_id,
+        "status": "finished" if done == total else "running",
+        "total": total,
+        "counts": counts,
+        "items": items[offset : offset + limit],
+        "next": offset + limit if offset + limit < total else None,
+    }
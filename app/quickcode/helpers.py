@@ -1,26 +1,301 @@
-from flask import current_app, jsonify
+import hashlib
+import json
+import shlex
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, Optional, Tuple
+from flask import current_app
+from docker.errors import APIError, ImageNotFound, NotFound
 from app.extensions import client, logger
+from app import metering
+from app.quickcode import images
 
+# Results of identical runs, keyed by a hash of image ID, command and input
+RESULT_KEY = "quickcode:results:{}"
+RESULT_LRU_KEY = "quickcode:results:lru"
+RESULT_SIZES_KEY = "quickcode:results:sizes"
+RESULT_STATS_KEY = "quickcode:results:stats"
 
-def run(image, command):
-    # Validate image against blacklist/whitelist
+
+class OutputBuffer:
+    """Keeps the last `limit` bytes written to stdout and stderr."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+        self._chunks: deque = deque()
+
+    def append(self, stream: str, data: bytes) -> None:
+        if len(data) > self.limit:
+            data = data[-self.limit :]
+            self.truncated = True
+        self._chunks.append((stream, data))
+        self.size += len(data)
+        while self.size > self.limit:
+            self.truncated = True
+            old_stream, old = self._chunks.popleft()
+            excess = self.size - self.limit
+            if len(old) > excess:
+                # Keep the newest part of a partly evicted chunk
+                self._chunks.appendleft((old_stream, old[excess:]))
+                self.size -= excess
+            else:
+                self.size -= len(old)
+
+    def text(self, stream: str) -> str:
+        return b"".join(d for s, d in self._chunks if s == stream).decode(
+            errors="replace"
+        )
+
+
+def check_image(image: str) -> Optional[str]:
+    """Return why an image may not be run, or None if it is allowed."""
     if image in current_app.config.get("QUICKCODE_IMAGE_BLACKLIST", []):
-        return jsonify({"error": "This image is not allowed"}), 403
+        return "This image is not allowed"
 
     if current_app.config.get(
         "QUICKCODE_IMAGE_WHITELIST_ENABLE", False
     ) and image not in current_app.config.get("QUICKCODE_IMAGE_WHITELIST", []):
-        return jsonify({"error": "This image is not allowed"}), 403
+        return "This image is not allowed"
+    return None
+
+
+def _execute(
+    image: str, command: str, stdin: Optional[str] = None, user_id: Optional[int] = None
+) -> Iterator[Tuple[str, Any]]:
+    config = current_app.config
+    max_output = config["QUICKCODE_MAX_OUTPUT_BYTES"]
+    # Containers created with stdin open are also created with StdinOnce
+    container = client.containers.create(
+        image, shlex.split(command), stdin_open=stdin is not None
+    )
+    if user_id is not None:
+        metering.register(container.id, user_id)
+    stopped = {"reason": None}
+
+    def kill(reason: str) -> None:
+        if stopped["reason"] is None:
+            stopped["reason"] = reason
+        try:
+            container.kill()
+        except (APIError, NotFound):
+            pass
+
+    timer = threading.Timer(config["QUICKCODE_TIMEOUT"], kill, ("timeout",))
+    timer.daemon = True
     try:
-        client.images.pull(image)  # Pull the image
-    except Exception as e:
-        logger.error(f"Error pull QuickCode container: {str(e)}")
-        return jsonify({"error": "Failed to run Code", "details": str(e)}), 500
+        # Attaching with logs=True also returns anything written before it
+        output = client.api.attach(
+            container.id, stdout=True, stderr=True, stream=True, logs=True, demux=True
+        )
+        if stdin is not None:
+            input_socket = client.api.attach_socket(
+                container.id, params={"stdin": 1, "stream": 1}
+            )
+        started = time.monotonic()
+        container.start()
+        timer.start()
+        if stdin is not None:
+            # Closing the only stdin attachment sends EOF, as StdinOnce is set
+            raw = getattr(input_socket, "_sock", input_socket)
+            raw.sendall(stdin.encode())
+            raw.close()
+        written = 0
+        for stdout, stderr in output:
+            for name, data in (("stdout", stdout), ("stderr", stderr)):
+                if not data or stopped["reason"] == "output_limit":
+                    continue
+                if written + len(data) > max_output:
+                    data = data[: max_output - written]
+                    kill("output_limit")
+                written += len(data)
+                if data:
+                    yield name, data
+        exit_code = container.wait()["StatusCode"]
+        duration_ms = int((time.monotonic() - started) * 1000)
+    finally:
+        timer.cancel()
+        try:
+            container.remove(force=True)
+        except (APIError, NotFound) as e:
+            logger.warning(f"Error removing QuickCode container: {e}")
+        if user_id is not None:
+            metering.unregister(container.id)
+    yield (
+        "exit",
+        {
+            "exit_code": exit_code,
+            "reason": stopped["reason"] or "exited",
+            "duration_ms": duration_ms,
+        },
+    )
+
+
+def result_key(image: str, command: str, stdin: Optional[str] = None) -> Optional[str]:
+    """Return the result cache key for a run, or None if the image is not local.
+
+    Runs are keyed by the local image ID, which is a digest of the image's
+    content, so a new image behind the same tag never returns an old result.
+    """
     try:
-        # Create and start the container safely
-        container = client.containers.run(image, command.split())
+        image_id = client.images.get(image).id
+    except ImageNotFound:
+        return None
+    digest = hashlib.sha256()
+    for part in (image_id, command, stdin or ""):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return RESULT_KEY.format(digest.hexdigest())
+
+
+def cached_result(key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Look up a cached result, counting hits towards the cache stats."""
+    if key is None:
+        return None
+    redis = current_app.redis
+    value = redis.get(key)
+    if value is None:
+        return None
+    pipe = redis.pipeline()
+    pipe.hincrby(RESULT_STATS_KEY, "hits", 1)
+    pipe.hincrby(RESULT_STATS_KEY, "bytes_saved", len(value))
+    pipe.zadd(RESULT_LRU_KEY, {key: time.time()})
+    pipe.execute()
+    return {**json.loads(value), "cached": True}
+
+
+def store_result(key: Optional[str], result: Dict[str, Any]) -> None:
+    """Cache a result, evicting least recently used ones over the budget.
+
+    Only runs that exited on their own with their whole output retained are
+    cached, as anything else would not be returned by running them again.
+    """
+    if key is None or result["reason"] != "exited" or result.get("truncated"):
+        return
+    redis = current_app.redis
+    config = current_app.config
+    value = json.dumps(result)
+    pipe = redis.pipeline()
+    pipe.set(key, value, ex=config["QUICKCODE_RESULT_CACHE_TTL"])
+    pipe.zadd(RESULT_LRU_KEY, {key: time.time()})
+    pipe.hset(RESULT_SIZES_KEY, key, len(value))
+    pipe.execute()
+
+    sizes = {k.decode(): int(v) for k, v in redis.hgetall(RESULT_SIZES_KEY).items()}
+    total = sum(sizes.values())
+    budget = config["QUICKCODE_RESULT_CACHE_MAX_BYTES"]
+    # Expired results are still accounted for until they are evicted, which
+    # happens early as they are among the least recently used
+    for old in redis.zrange(RESULT_LRU_KEY, 0, -1):
+        if total <= budget:
+            break
+        old = old.decode()
+        pipe = redis.pipeline()
+        pipe.delete(old)
+        pipe.zrem(RESULT_LRU_KEY, old)
+        pipe.hdel(RESULT_SIZES_KEY, old)
+        pipe.execute()
+        total -= sizes.get(old, 0)
+
+
+def cache_stats() -> Dict[str, Any]:
+    """Report the result cache's hit ratio, size and bytes served from it."""
+    redis = current_app.redis
+    stats = {k.decode(): int(v) for k, v in redis.hgetall(RESULT_STATS_KEY).items()}
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+        "bytes_saved": stats.get("bytes_saved", 0),
+        "entries": redis.zcard(RESULT_LRU_KEY),
+        "bytes": sum(int(v) for v in redis.hvals(RESULT_SIZES_KEY)),
+    }
+
+
+def stream(
+    image: str,
+    command: str,
+    stdin: Optional[str] = None,
+    cache: bool = False,
+    user_id: Optional[int] = None,
+) -> Iterator[Tuple[str, Any]]:
+    """Run a command in a new container, yielding its output as it is produced.
+
+    Yields ("stdout", bytes) and ("stderr", bytes) events, then a final
+    ("exit", dict) event with the exit code. The container is killed once it
+    has run for QUICKCODE_TIMEOUT seconds or written QUICKCODE_MAX_OUTPUT_BYTES,
+    and is always removed, including when the consumer stops early.
+
+    With `cache`, a result stored by an identical earlier run is replayed
+    without starting a container, stdout first and then stderr.
+
+    Args:
+        image (str): The image to run the command in.
+        command (str): The command line to run.
+        stdin (Optional[str]): Input written to the command's stdin.
+        cache (bool): Whether to use and fill the result cache.
+        user_id (Optional[int]): The user the container's usage is billed to.
+    """
+    # Only contacts the registry when the image is missing or may be stale
+    images.ensure(image)
+    key = result_key(image, command, stdin) if cache else None
+    result = cached_result(key)
+    if result is not None:
+        for name in ("stdout", "stderr"):
+            if result[name]:
+                yield name, result[name].encode()
+        yield (
+            "exit",
+            {
+                "exit_code": result["exit_code"],
+                "reason": result["reason"],
+                "duration_ms": result["duration_ms"],
+                "cached": True,
+            },
+        )
+        return
+
+    if key is not None:
+        current_app.redis.hincrby(RESULT_STATS_KEY, "misses", 1)
+    buffer = OutputBuffer(current_app.config["QUICKCODE_RETAINED_OUTPUT_BYTES"])
+    for event, data in _execute(image, command, stdin, user_id):
+        if event == "exit":
+            if key is not None:
+                store_result(key, _result(data, buffer))
+        else:
+            buffer.append(event, data)
+        yield event, data
+
+
+def _result(status: Dict[str, Any], buffer: OutputBuffer) -> Dict[str, Any]:
+    return {
+        **status,
+        "stdout": buffer.text("stdout"),
+        "stderr": buffer.text("stderr"),
+        "truncated": buffer.truncated,
+    }
+
+
+def run(
+    image: str,
+    command: str,
+    stdin: Optional[str] = None,
+    cache: bool = False,
+    user_id: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Run a command to completion, keeping only the end of its output.
 
-        return jsonify({"message": "Code Ran", "result": container}), 200
-    except Exception as e:
-        logger.error(f"Error running QuickCode container: {str(e)}")
-        return jsonify({"error": "Failed to run Code", "details": str(e)}), 500
+    Returns:
+        Dict[str, Any]: The exit code, why the command stopped, how long it
+        ran, and the last QUICKCODE_RETAINED_OUTPUT_BYTES of stdout and stderr.
+    """
+    buffer = OutputBuffer(current_app.config["QUICKCODE_RETAINED_OUTPUT_BYTES"])
+    for event, data in stream(image, command, stdin, cache, user_id):
+        if event == "exit":
+            result = data
+        else:
+            buffer.append(event, data)
+    return _result(result, buffer)
@@ -0,0 +1,91 @@
+import time
+from flask import current_app
+from docker.errors import APIError, ImageNotFound, NotFound
+from app.extensions import client, logger
+from app.cloudshell.images import remote_digest
+
+# Redis keys shared by every web and RQ worker
+CHECKED_KEY = "quickcode:images:checked:{}"
+PULL_LOCK_KEY = "quickcode:images:pull:{}"
+LRU_KEY = "quickcode:images:lru"
+
+
+def _is_current(reference: str) -> bool:
+    """Return True if the local image is present and matches the registry."""
+    try:
+        local = client.images.get(reference)
+    except ImageNotFound:
+        return False
+    if current_app.redis.exists(CHECKED_KEY.format(reference)):
+        return True
+    digest = remote_digest(reference)
+    repo_digests = local.attrs.get("RepoDigests") or []
+    # Keep using the local copy when the registry cannot be reached
+    return digest is None or any(d.endswith(f"@{digest}") for d in repo_digests)
+
+
+def ensure(reference: str) -> None:
+    """Make sure an image is available locally, pulling it at most once.
+
+    The registry is only asked for the image's digest once every
+    QUICKCODE_IMAGE_DIGEST_TTL seconds. Concurrent pulls of the same
+    reference, from any worker, wait for a single pull instead of starting
+    their own.
+
+    Args:
+        reference (str): The image to run.
+    """
+    redis = current_app.redis
+    checked_key = CHECKED_KEY.format(reference)
+    ttl = current_app.config["QUICKCODE_IMAGE_DIGEST_TTL"]
+    if not _is_current(reference):
+        timeout = current_app.config["DOCKER_TIMEOUTS"]["pull"]
+        with redis.lock(PULL_LOCK_KEY.format(reference), timeout=timeout):
+            # Another worker may have pulled it while we waited for the lock
+            if not _is_current(reference):
+                logger.info(f"Pulling QuickCode image {reference}")
+                client.for_operation("pull").images.pull(reference)
+                redis.set(checked_key, 1, ex=ttl)
+                redis.zadd(LRU_KEY, {reference: time.time()})
+                evict()
+    redis.set(checked_key, 1, ex=ttl, nx=True)
+    redis.zadd(LRU_KEY, {reference: time.time()})
+
+
+def evict() -> int:
+    """Remove least recently used QuickCode images over the disk budget.
+
+    Images are sized individually, so layers shared between images are
+    counted once per image and the budget errs on the side of evicting.
+
+    Returns:
+        int: The number of images removed.
+    """
+    redis = current_app.redis
+    budget = current_app.config["QUICKCODE_IMAGE_DISK_BUDGET_MB"] * 1024 * 1024
+    sizes = {}
+    for reference in redis.zrange(LRU_KEY, 0, -1):
+        reference = reference.decode()
+        try:
+            sizes[reference] = client.images.get(reference).attrs["Size"]
+        except ImageNotFound:
+            redis.zrem(LRU_KEY, reference)
+
+    removed = 0
+    total = sum(sizes.values())
+    # Oldest first, never the most recently used image
+    for reference in list(sizes)[:-1]:
+        if total <= budget:
+            break
+        try:
+            client.images.remove(reference)
+        except (APIError, NotFound) as e:
+            # Still used by a running container
+            logger.warning(f"Could not evict QuickCode image {reference}: {e}")
+            continue
+        logger.info(f"Evicted QuickCode image {reference}")
+        redis.zrem(LRU_KEY, reference)
+        redis.delete(CHECKED_KEY.format(reference))
+        total -= sizes[reference]
+        removed += 1
+    return removed
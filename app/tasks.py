@@ -1,26 +1,196 @@
 import json
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sqlalchemy as sa
 from flask import render_template
 from rq import get_current_job
 from app import create_app, db
-from app.models import User, Task
+from app.extensions import logger
+from app.models import User, Container
 from app.email import send_email
+from app.progress import publish as publish_progress
+from app.cloudshell import inventory, pool
+from app.cloudshell.helpers import (
+    PHASES,
+    SSH_PORT,
+    create_shell as create_container,
+    discard_container,
+)
 
 app = create_app()
 app.app_context().push()
 
 
-def _set_task_progress(progress):
+def _set_task_progress(progress, phase=None):
     job = get_current_job()
     if job:
+        transition = progress >= 100 or (
+            phase is not None and phase != job.meta.get("phase")
+        )
         job.meta["progress"] = progress
-        job.save_meta()
-        task = db.session.get(Task, job.get_id())
-        task.user.add_notification(
-            "task_progress", {"task_id": job.get_id(), "progress": progress}
+        if phase:
+            job.meta["phase"] = phase
+        # Every tick is published, but only transitions reach RQ and the DB
+        if transition:
+            job.save_meta()
+        if "user_id" in job.meta:
+            publish_progress(
+                job.get_id(),
+                job.meta["user_id"],
+                progress,
+                job.meta.get("phase"),
+                transition,
+            )
+
+
+def _save_key(user_id, key):
+    # Keys are checked by the SSH gateway rather than copied into shells
+    if key:
+        db.session.get(User, user_id).add_ssh_key(key)
+        db.session.commit()
+
+
+def _own(user_id, info):
+    """Give a new shell to a user, removing it if that cannot be recorded."""
+    try:
+        db.session.add(
+            Container(
+                container_id=info["container_id"],
+                user_id=user_id,
+                port=SSH_PORT,
+                host=info["host"],
+                host_key=info["host_key"],
+                status="running",
+            )
         )
-        if progress >= 100:
-            task.complete = True
         db.session.commit()
+    except Exception:
+        db.session.rollback()
+        discard_container(info["container_id"])
+        raise
+    # Owned now, so reconcile no longer needs the claim to keep it
+    pool.release(info["container_id"])
+    inventory.record(
+        info["container_id"], user_id, SSH_PORT, info["host"], info["host_key"]
+    )
+
+
+def create_shell(user_id, key=None):
+    try:
+        _save_key(user_id, key)
+        info = create_container(
+            on_phase=lambda phase: _set_task_progress(PHASES[phase], phase)
+        )
+        _own(user_id, info)
+        _set_task_progress(100, "ready")
+        return info
+    except Exception as e:
+        logger.error(f"Error creating container: {e}")
+        job = get_current_job()
+        if job:
+            job.meta["error"] = str(e)
+        _set_task_progress(100, "failed")
+        raise
+
+
+def prepull_images():
+    from app.cloudshell import images, scheduler
+
+    for host in scheduler.hosts():
+        try:
+            images.prepull(app.config["DEFAULT_IMAGE"], host)
+            # Build the shell image now rather than for the first shell
+            images.shell_image(host)
+        except Exception as e:
+            logger.error(f"Error pre-pulling images on {host}: {e}")
+
+
+def refill_shell_pool():
+    from app.cloudshell import pool
+
+    pool.refill()
+
+
+def create_shells(user_id, count, key=None):
+    _save_key(user_id, key)
+
+    def create_one():
+        with app.app_context():
+            return create_container()
+
+    results = []
+    with ThreadPoolExecutor(
+        max_workers=app.config["CLOUDSHELL_BULK_CONCURRENCY"]
+    ) as executor:
+        futures = [executor.submit(create_one) for _ in range(count)]
+        for future in as_completed(futures):
+            try:
+                info = future.result()
+                _own(user_id, info)
+                results.append(info)
+            except Exception as e:
+                logger.error(f"Error creating container: {e}")
+                results.append({"status": "error", "message": str(e)})
+            _set_task_progress(min(99, len(results) * 100 // count), "create")
+
+    errors = [result["message"] for result in results if result["status"] == "error"]
+    if errors:
+        job = get_current_job()
+        if job:
+            job.meta["error"] = f"{len(errors)} of {count} shells failed: {errors[0]}"
+        if len(errors) == len(results):
+            _set_task_progress(100, "failed")
+            raise Exception(f"Could not create any of {count} shells: {errors[0]}")
+        _set_task_progress(100, "partial")
+        return results
+    _set_task_progress(100, "ready")
+    return results
+
+
+def run_code(user_id, image, command, stdin=None, cache=False):
+    from app.quickcode import helpers
+
+    try:
+        _set_task_progress(0, "running")
+        result = helpers.run(image, command, stdin, cache, user_id)
+        _set_task_progress(100, "finished")
+        return result
+    except Exception as e:
+        logger.error(f"Error running QuickCode container: {e}")
+        job = get_current_job()
+        if job:
+            job.meta["error"] = str(e)
+        _set_task_progress(100, "failed")
+        raise
+
+
+def run_batch_item(batch_id, index):
+    from app.quickcode import batch, helpers
+
+    item = batch.get_item(batch_id, index)
+    user_id = batch.owner(batch_id)
+    if item is None or user_id is None:
+        return
+    if not batch.start(batch_id, index, user_id):
+        logger.warning(f"Skipping QuickCode batch item {batch_id}:{index}")
+        return
+    try:
+        batch.update_item(batch_id, index, status="running", started_at=time.time())
+        result = helpers.run(
+            item["image"],
+            item["command"],
+            item.get("input"),
+            item.get("cache", False),
+            user_id,
+        )
+        batch.update_item(
+            batch_id, index, status="finished", finished_at=time.time(), result=result
+        )
+    except Exception as e:
+        logger.error(f"Error running QuickCode batch item: {e}")
+        batch.update_item(
+            batch_id, index, status="failed", finished_at=time.time(), error=str(e)
+        )
+    finally:
+        batch.finish(batch_id, index, user_id)
@@ -0,0 +1,606 @@
+"""A fake Docker Engine API, enough of it for shells and QuickCode runs.
+
+Containers only exist in memory: starting one emits the `start` and, after
+the `ready` latency, `health_status: healthy` events, exec commands succeed
+without output, except reading sshd's public host key, and attached
+QuickCode runs print their command and exit 0 after the `run` latency.
+Every other endpoint answers after the latency set for its operation, so the
+app can be benchmarked without a real daemon.
+
+Run it on its own with:
+
+    python -m benchmarks.fake_docker --port 2375 --latency start=0.5
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import queue
+import re
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Seconds each operation takes, roughly what a local daemon takes
+LATENCIES: Dict[str, float] = {
+    "create": 0.05,
+    "start": 0.1,
+    "stop": 0.05,
+    "kill": 0.01,
+    "remove": 0.02,
+    "inspect": 0.002,
+    "exec": 0.02,
+    "wait": 0.0,
+    "image": 0.002,
+    "pull": 0.5,
+    "info": 0.005,
+    # From start until the healthcheck passes
+    "ready": 0.2,
+    # From start until a QuickCode run has printed its output and exited
+    "run": 0.1,
+}
+
+API_VERSION = "1.45"
+_VERSION_PREFIX = re.compile(r"^/v[0-9.]+")
+
+
+def _digest(name: str) -> str:
+    return "sha256:" + hashlib.sha256(name.encode()).hexdigest()
+
+
+def _frame(stream: int, data: bytes) -> bytes:
+    """Frame output the way Docker multiplexes stdout and stderr."""
+    return struct.pack(">BxxxL", stream, len(data)) + data
+
+
+def _host_key(container_id: str) -> bytes:
+    """Return an ed25519 public key line unique to a container."""
+    blob = b"".join(
+        struct.pack(">L", len(part)) + part
+        for part in (b"ssh-ed25519", hashlib.sha256(container_id.encode()).digest())
+    )
+    return (
+        b"ssh-ed25519 "
+        + base64.b64encode(blob)
+        + b" root@"
+        + container_id[:12].encode()
+    )
+
+
+class FakeContainer:
+    def __init__(self, spec: dict):
+        self.id = uuid.uuid4().hex + uuid.uuid4().hex
+        self.image = spec.get("Image", "")
+        self.cmd = spec.get("Cmd") or []
+        self.labels = spec.get("Labels") or {}
+        self.open_stdin = bool(spec.get("OpenStdin"))
+        self.status = "created"
+        self.health: Optional[str] = None
+        self.exit_code = 0
+        self.created_at = time.time()
+        self.created = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.created_at))
+        self.started = threading.Event()
+        self.exited = threading.Event()
+
+    def inspect(self) -> dict:
+        running = self.status == "running"
+        state = {
+            "Status": self.status,
+            "Running": running,
+            "Paused": False,
+            "ExitCode": self.exit_code,
+        }
+        if self.health:
+            state["Health"] = {"Status": self.health}
+        address = f"172.17.{int(self.id[:2], 16)}.{int(self.id[2:4], 16)}"
+        return {
+            "Id": self.id,
+            "Name": f"/{self.id[:12]}",
+            "Created": self.created,
+            "Image": _digest(self.image),
+            "State": state,
+            "Config": {
+                "Image": self.image,
+                "Cmd": self.cmd,
+                "Labels": self.labels,
+                "Tty": False,
+                "OpenStdin": self.open_stdin,
+            },
+            "HostConfig": {},
+            "NetworkSettings": {
+                "IPAddress": address if running else "",
+                "Networks": {"bridge": {"IPAddress": address if running else ""}},
+            },
+        }
+
+    def has_labels(self, labels: List[str]) -> bool:
+        """Match "key" or "key=value" label filters."""
+        for label in labels:
+            key, _, value = label.partition("=")
+            if key not in self.labels or (value and self.labels[key] != value):
+                return False
+        return True
+
+    def summary(self) -> dict:
+        return {
+            "Id": self.id,
+            "Names": [f"/{self.id[:12]}"],
+            "Image": self.image,
+            "Created": int(self.created_at),
+            "Labels": self.labels,
+            "State": self.status,
+            "Status": self.status,
+        }
+
+
+class FakeDocker:
+    """In-memory daemon state, shared by all connections."""
+
+    def __init__(self, latencies: Optional[Dict[str, float]] = None):
+        self.latencies = {**LATENCIES, **(latencies or {})}
+        self.containers: Dict[str, FakeContainer] = {}
+        # Exec ID -> container ID and command
+        self.execs: Dict[str, Tuple[str, List[str]]] = {}
+        self.requests: Dict[str, int] = {}
+        self._subscribers: List[queue.Queue] = []
+        self._lock = threading.Lock()
+
+    def delay(self, operation: str) -> None:
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+        seconds = self.latencies.get(operation, 0)
+        if seconds:
+            time.sleep(seconds)
+
+    def container(self, prefix: str) -> Optional[FakeContainer]:
+        container = self.containers.get(prefix)
+        if container is None:
+            matches = [
+                c for cid, c in self.containers.items() if cid.startswith(prefix)
+            ]
+            container = matches[0] if len(matches) == 1 else None
+        return container
+
+    def subscribe(self) -> queue.Queue:
+        events: queue.Queue = queue.Queue()
+        with self._lock:
+            self._subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events: queue.Queue) -> None:
+        with self._lock:
+            self._subscribers.remove(events)
+
+    def emit(self, container: FakeContainer, action: str) -> None:
+        now = time.time()
+        event = {
+            "Type": "container",
+            "Action": action,
+            "status": action,
+            "id": container.id,
+            "from": container.image,
+            "Actor": {"ID": container.id, "Attributes": dict(container.labels)},
+            "time": int(now),
+            "timeNano": int(now * 1e9),
+        }
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for events in subscribers:
+            events.put(event)
+
+    def start(self, container: FakeContainer) -> None:
+        container.status = "running"
+        container.health = "starting"
+        container.started.set()
+        self.emit(container, "start")
+
+        def healthy():
+            if container.status == "running":
+                container.health = "healthy"
+                self.emit(container, "health_status: healthy")
+
+        threading.Timer(self.latencies["ready"], healthy).start()
+
+    def stop(self, container: FakeContainer, exit_code: int = 0) -> None:
+        if container.status != "running":
+            return
+        container.status = "exited"
+        container.health = None
+        container.exit_code = exit_code
+        container.exited.set()
+        self.emit(container, "die")
+
+
+Route = Tuple[str, re.Pattern, Callable]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    daemon: FakeDocker
+    routes: List[Route] = []
+
+    def log_message(self, format, *args):
+        pass
+
+    # Responses
+
+    def send_json(self, body, status: int = 200) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_empty(self, status: int = 204) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_error_json(self, status: int, message: str) -> None:
+        self.send_json({"message": message}, status)
+
+    def upgrade(self) -> None:
+        """Hijack the connection for a raw output stream, as Docker does."""
+        self.send_response(101, "UPGRADED")
+        self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Upgrade", "tcp")
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+    def send_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    # Dispatch
+
+    def handle_method(self, method: str) -> None:
+        url = urlsplit(self.path)
+        path = _VERSION_PREFIX.sub("", url.path)
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        self.body = json.loads(raw) if raw.startswith(b"{") else {}
+        for route_method, pattern, func in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                groups = [unquote(g) for g in match.groups()]
+                func(self, *groups)
+                return
+        self.send_error_json(404, f"page not found: {method} {path}")
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_HEAD(self):
+        self.handle_method("HEAD")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+
+def route(method: str, pattern: str):
+    def decorator(func):
+        Handler.routes.append((method, re.compile(f"^{pattern}$"), func))
+        return func
+
+    return decorator
+
+
+def with_container(func):
+    def wrapper(handler: Handler, container_id: str, *args):
+        container = handler.daemon.container(container_id)
+        if container is None:
+            handler.send_error_json(404, f"No such container: {container_id}")
+            return
+        func(handler, container, *args)
+
+    return wrapper
+
+
+@route("GET", "/_ping")
+@route("HEAD", "/_ping")
+def ping(handler: Handler):
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/plain")
+    handler.send_header("Content-Length", "2")
+    handler.send_header("Api-Version", API_VERSION)
+    handler.end_headers()
+    if handler.command != "HEAD":
+        handler.wfile.write(b"OK")
+
+
+@route("GET", "/version")
+def version(handler: Handler):
+    handler.send_json(
+        {"Version": "27.0.0-fake", "ApiVersion": API_VERSION, "Os": "linux"}
+    )
+
+
+@route("GET", "/info")
+def info(handler: Handler):
+    handler.daemon.delay("info")
+    containers = list(handler.daemon.containers.values())
+    handler.send_json(
+        {
+            "Containers": len(containers),
+            "ContainersRunning": sum(c.status == "running" for c in containers),
+            "NCPU": 64,
+            "MemTotal": 256 * 2**30,
+        }
+    )
+
+
+@route("GET", "/events")
+def events(handler: Handler):
+    events = handler.daemon.subscribe()
+    try:
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        handler.wfile.flush()
+        while True:
+            try:
+                event = events.get(timeout=5)
+            except queue.Empty:
+                # Find out whether the client went away
+                handler.send_chunk(b"\n")
+                continue
+            handler.send_chunk(json.dumps(event).encode() + b"\n")
+    except OSError:
+        pass
+    finally:
+        handler.daemon.unsubscribe(events)
+        handler.close_connection = True
+
+
+# Images. Every image exists locally and matches the registry, so shell
+# images are never built and QuickCode images are never pulled again.
+
+
+def _image(name: str) -> dict:
+    repository = name if ":" in name.rsplit("/", 1)[-1] else f"{name}:latest"
+    return {
+        "Id": _digest(repository),
+        "RepoTags": [repository],
+        "RepoDigests": [f"{repository.rsplit(':', 1)[0]}@{_digest(repository)}"],
+        "Size": 100 * 2**20,
+        "Created": "2024-01-01T00:00:00Z",
+        "Config": {},
+    }
+
+
+@route("GET", "/images/(.+)/json")
+def inspect_image(handler: Handler, name: str):
+    handler.daemon.delay("image")
+    handler.send_json(_image(name))
+
+
+@route("GET", "/images/json")
+def list_images(handler: Handler):
+    handler.daemon.delay("image")
+    handler.send_json([])
+
+
+@route("POST", "/images/create")
+def pull(handler: Handler):
+    handler.daemon.delay("pull")
+    handler.send_json({"status": "Downloaded newer image"})
+
+
+@route("GET", "/distribution/(.+)/json")
+def distribution(handler: Handler, name: str):
+    handler.daemon.delay("image")
+    repository = name if ":" in name.rsplit("/", 1)[-1] else f"{name}:latest"
+    handler.send_json({"Descriptor": {"digest": _digest(repository)}})
+
+
+# Containers
+
+
+@route("POST", "/containers/create")
+def create(handler: Handler):
+    handler.daemon.delay("create")
+    container = FakeContainer(handler.body)
+    handler.daemon.containers[container.id] = container
+    handler.send_json({"Id": container.id, "Warnings": []}, 201)
+
+
+@route("GET", "/containers/json")
+def list_containers(handler: Handler):
+    handler.daemon.delay("inspect")
+    show_all = handler.query.get("all") in ("1", "true", "True")
+    labels = json.loads(handler.query.get("filters") or "{}").get("label", [])
+    handler.send_json(
+        [
+            c.summary()
+            for c in list(handler.daemon.containers.values())
+            if (show_all or c.status == "running") and c.has_labels(labels)
+        ]
+    )
+
+
+@route("GET", "/containers/([^/]+)/json")
+@with_container
+def inspect(handler: Handler, container: FakeContainer):
+    handler.daemon.delay("inspect")
+    handler.send_json(container.inspect())
+
+
+@route("POST", "/containers/([^/]+)/start")
+@with_container
+def start(handler: Handler, container: FakeContainer):
+    handler.daemon.delay("start")
+    if container.status == "running":
+        handler.send_empty(304)
+        return
+    handler.daemon.start(container)
+    handler.send_empty()
+
+
+@route("POST", "/containers/([^/]+)/stop")
+@with_container
+def stop(handler: Handler, container: FakeContainer):
+    handler.daemon.delay("stop")
+    if container.status != "running":
+        handler.send_empty(304)
+        return
+    handler.daemon.stop(container)
+    handler.send_empty()
+
+
+@route("POST", "/containers/([^/]+)/kill")
+@with_container
+def kill(handler: Handler, container: FakeContainer):
+    handler.daemon.delay("kill")
+    handler.daemon.stop(container, 137)
+    handler.send_empty()
+
+
+@route("POST", "/containers/([^/]+)/wait")
+@with_container
+def wait(handler: Handler, container: FakeContainer):
+    handler.daemon.delay("wait")
+    if container.started.is_set():
+        container.exited.wait()
+    handler.send_json({"StatusCode": container.exit_code, "Error": None})
+
+
+@route("DELETE", "/containers/([^/]+)")
+@with_container
+def remove(handler: Handler, container: FakeContainer):
+    handler.daemon.delay("remove")
+    if container.status == "running" and handler.query.get("force") not in (
+        "1",
+        "true",
+        "True",
+    ):
+        handler.send_error_json(409, "You cannot remove a running container")
+        return
+    handler.daemon.stop(container, 137)
+    handler.daemon.containers.pop(container.id, None)
+    handler.daemon.emit(container, "destroy")
+    handler.send_empty()
+
+
+@route("POST", "/containers/([^/]+)/attach")
+@with_container
+def attach(handler: Handler, container: FakeContainer):
+    """Stream a QuickCode run: its command on stdout, then exit 0."""
+    handler.upgrade()
+    if handler.query.get("stdin") in ("1", "true", "True"):
+        # The stdin half is closed by the client once written; read to EOF
+        while handler.rfile.read1(65536):
+            pass
+        return
+    container.started.wait()
+    time.sleep(handler.daemon.latencies["run"])
+    try:
+        handler.wfile.write(_frame(1, " ".join(container.cmd).encode() + b"\n"))
+        handler.wfile.flush()
+    except OSError:
+        pass
+    handler.daemon.stop(container)
+
+
+@route("POST", "/containers/([^/]+)/exec")
+@with_container
+def create_exec(handler: Handler, container: FakeContainer):
+    handler.daemon.delay("inspect")
+    if container.status != "running":
+        handler.send_error_json(409, f"Container {container.id} is not running")
+        return
+    exec_id = uuid.uuid4().hex
+    handler.daemon.execs[exec_id] = (container.id, handler.body.get("Cmd") or [])
+    handler.send_json({"Id": exec_id}, 201)
+
+
+@route("POST", "/exec/([^/]+)/start")
+def start_exec(handler: Handler, exec_id: str):
+    if exec_id not in handler.daemon.execs:
+        handler.send_error_json(404, f"No such exec instance: {exec_id}")
+        return
+    container_id, cmd = handler.daemon.execs[exec_id]
+    handler.upgrade()
+    # Output is sent after the headers, as by a real command
+    handler.daemon.delay("exec")
+    if " ".join(cmd).startswith("cat /etc/ssh/ssh_host_"):
+        handler.wfile.write(_frame(1, _host_key(container_id) + b"\n"))
+
+
+@route("GET", "/exec/([^/]+)/json")
+def inspect_exec(handler: Handler, exec_id: str):
+    container_id, _ = handler.daemon.execs.pop(exec_id, (None, None))
+    if container_id is None:
+        handler.send_error_json(404, f"No such exec instance: {exec_id}")
+        return
+    handler.send_json(
+        {"ID": exec_id, "ContainerID": container_id, "Running": False, "ExitCode": 0}
+    )
+
+
+def serve(
+    host: str = "127.0.0.1", port: int = 0, latencies: Optional[Dict[str, float]] = None
+) -> ThreadingHTTPServer:
+    """Start a fake daemon in a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The server; its `server_address` has the port
+        and its `docker` attribute the daemon state.
+    """
+    docker = FakeDocker(latencies)
+    handler = type("BoundHandler", (Handler,), {"daemon": docker})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.docker = docker
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_latencies(values: List[str]) -> Dict[str, float]:
+    latencies = {}
+    for value in values:
+        operation, _, seconds = value.partition("=")
+        if operation not in LATENCIES:
+            raise argparse.ArgumentTypeError(
+                f"Unknown operation {operation}, expected one of {', '.join(LATENCIES)}"
+            )
+        latencies[operation] = float(seconds)
+    return latencies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2375)
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="OPERATION=SECONDS",
+        help=f"Override a latency: {', '.join(f'{k}={v}' for k, v in LATENCIES.items())}",
+    )
+    args = parser.parse_args()
+    server = serve(args.host, args.port, parse_latencies(args.latency))
+    print(
+        f"Fake Docker daemon listening on tcp://{args.host}:{server.server_address[1]}"
+    )
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
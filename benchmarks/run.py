@@ -0,0 +1,433 @@
+"""Load-test the app against a fake Docker daemon.
+
+Starts the fake daemon, the Flask app and RQ workers, then drives shell
+creation, stop, start and deletion, and QuickCode runs, at each concurrency
+level. Throughput and latency percentiles are printed, saved as JSON under
+benchmarks/results, and optionally compared with an earlier run:
+
+    python -m benchmarks.run --concurrency 1,4,16 --compare benchmarks/results/main.json
+
+Redis is required; the database at --redis-url is flushed.
+"""
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+import requests
+from benchmarks import fake_docker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+SCENARIOS = ("create", "stop", "start", "delete", "quickcode")
+TASK_POLL_INTERVAL = 0.05
+TASK_TIMEOUT = 120
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Return the nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+class Client:
+    """One simulated user, with their own session and token."""
+
+    def __init__(self, base_url: str, token: str):
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.session.headers["Authentication-Token"] = token
+        self.shells: List[str] = []
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = self.session.request(method, self.base_url + path, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def create(self) -> None:
+        """Create a shell and wait until it is handed out."""
+        task_id = self.request("POST", "/api/cloudshell/create", json={}).json()[
+            "task_id"
+        ]
+        deadline = time.monotonic() + TASK_TIMEOUT
+        while time.monotonic() < deadline:
+            status = self.request("GET", f"/api/cloudshell/tasks/{task_id}").json()
+            if status["status"] == "finished":
+                self.shells.append(status["result"]["container_id"])
+                return
+            if status["status"] in ("failed", "stopped", "canceled", "unknown"):
+                raise RuntimeError(f"Task {task_id} {status['status']}: {status}")
+            time.sleep(TASK_POLL_INTERVAL)
+        raise TimeoutError(f"Task {task_id} did not finish in {TASK_TIMEOUT}s")
+
+    def stop(self, container_id: str) -> None:
+        self.request("POST", f"/cloudshell/stop/{container_id}")
+
+    def start(self, container_id: str) -> None:
+        self.request("POST", f"/cloudshell/start/{container_id}")
+
+    def delete(self, container_id: str) -> None:
+        self.request("DELETE", f"/api/cloudshell/delete/{container_id}")
+        self.shells.remove(container_id)
+
+    def quickcode(self, image: str) -> None:
+        """Run a command, streaming its output until the exit event."""
+        response = self.request(
+            "POST",
+            "/api/quickcode/run",
+            params={
+                "image": image,
+                "run_command": f"echo {uuid.uuid4().hex}",
+                "stream": 1,
+            },
+            stream=True,
+        )
+        body = response.content
+        if b"event: exit" not in body:
+            raise RuntimeError(f"Run did not exit: {body[-200:]!r}")
+
+
+def measure(
+    clients: List[Client], operations: Callable[[Client], List[Callable[[], None]]]
+) -> Dict[str, float]:
+    """Run each client's operations in its own thread and summarise them."""
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def run(client: Client) -> None:
+        for operation in operations(client):
+            started = time.perf_counter()
+            try:
+                operation()
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=run, args=(c,)) for c in clients]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    for error in errors[:3]:
+        print(f"  error: {error}", file=sys.stderr)
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 2) if seconds else 0.0,
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else 0.0,
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+    }
+
+
+def operations(scenario: str, iterations: int, image: str):
+    """Return the operations one client performs in a scenario.
+
+    Shells created by the create scenario are stopped, started and deleted
+    by the scenarios after it, each of which is measured on its own.
+    """
+
+    def for_client(client: Client) -> List[Callable[[], None]]:
+        if scenario == "create":
+            return [client.create] * iterations
+        if scenario == "quickcode":
+            return [lambda: client.quickcode(image)] * iterations
+        action = getattr(client, scenario)
+        return [lambda cid=cid: action(cid) for cid in list(client.shells)]
+
+    return for_client
+
+
+class Stack:
+    """The fake daemon, the app and its RQ workers, as separate processes."""
+
+    def __init__(self, args):
+        self.args = args
+        self.processes: List[subprocess.Popen] = []
+        self.directory = tempfile.mkdtemp(prefix="ucloudshell-bench-")
+        self.daemon = None
+        self.base_url = f"http://127.0.0.1:{args.port}"
+        # Tokens are signed with these, so every process must share them
+        self.secret_key = f"benchmark-{uuid.uuid4().hex}"
+        self.password_salt = f"benchmark-{uuid.uuid4().hex}"
+
+    def env(self) -> Dict[str, str]:
+        database = self.args.database_url or (
+            f"sqlite:///{os.path.join(self.directory, 'benchmark.db')}"
+        )
+        return {
+            **os.environ,
+            "DOCKER_HOST": f"tcp://127.0.0.1:{self.daemon.server_address[1]}",
+            "FLASK_SQLALCHEMY_DATABASE_URI": database,
+            "FLASK_RQ_REDIS_URL": self.args.redis_url,
+            "FLASK_SECRET_KEY": self.secret_key,
+            "FLASK_SECURITY_PASSWORD_SALT": self.password_salt,
+            "FLASK_DEBUG": "false",
+            "FLASK_WTF_CSRF_ENABLED": "false",
+            "FLASK_METRICS_PORT": "0",
+            # Every shell is provisioned on demand, no pool or pre-pull jobs
+            "FLASK_CLOUDSHELL_POOL_SIZE": "0",
+            "FLASK_CLOUDSHELL_POOL_LOW_WATERMARK": "-1",
+            "FLASK_CLOUDSHELL_IMAGE_PREPULL_INTERVAL": "0",
+        }
+
+    def flask(self, *command: str, wait: bool = False) -> subprocess.Popen:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "flask", "--app", "app", *command],
+            cwd=ROOT,
+            env=self.env(),
+            stdout=subprocess.DEVNULL if not self.args.verbose else None,
+            stderr=subprocess.DEVNULL if not self.args.verbose else None,
+        )
+        if wait:
+            if process.wait() != 0:
+                raise RuntimeError(f"flask {' '.join(command)} failed")
+        else:
+            self.processes.append(process)
+        return process
+
+    def __enter__(self) -> "Stack":
+        self.daemon = fake_docker.serve(latencies=self.args.latencies)
+        import redis
+
+        redis.Redis.from_url(self.args.redis_url).flushdb()
+        self.flask("db", "upgrade", wait=True)
+        self.flask(
+            "run",
+            "--port",
+            str(self.args.port),
+            "--with-threads",
+            "--no-reload",
+            "--no-debugger",
+        )
+        for _ in range(self.args.workers):
+            self.flask("cloudshell", "worker")
+
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.get(f"{self.base_url}/metrics", timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+        self.check()
+        return self
+
+    def check(self) -> None:
+        """Raise if the app or a worker has exited, e.g. failing to start."""
+        for process in self.processes:
+            if process.poll() is not None:
+                raise RuntimeError(
+                    f"{' '.join(process.args[3:])} exited with {process.returncode}"
+                    ", rerun with --verbose to see why"
+                )
+
+    def __exit__(self, *exc) -> None:
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.daemon:
+            self.daemon.shutdown()
+
+    def tokens(self, count: int) -> List[str]:
+        """Create users and return their authentication tokens."""
+        os.environ.update(self.env())
+        from app import create_app
+        from app.extensions import db
+
+        app = create_app()
+        tokens = []
+        with app.app_context():
+            datastore = app.extensions["security"].datastore
+            for i in range(count):
+                user = datastore.create_user(
+                    email=f"bench{i}@example.com",
+                    username=f"bench{i}",
+                    password=uuid.uuid4().hex,
+                )
+                db.session.commit()
+                tokens.append(user.get_auth_token())
+        return tokens
+
+
+def run(args) -> dict:
+    levels = args.concurrency
+    results = []
+    with Stack(args) as stack:
+        tokens = stack.tokens(max(levels))
+        for concurrency in levels:
+            clients = [Client(stack.base_url, t) for t in tokens[:concurrency]]
+            for scenario in args.scenarios:
+                stack.check()
+                summary = measure(
+                    clients, operations(scenario, args.iterations, args.image)
+                )
+                results.append(
+                    {"scenario": scenario, "concurrency": concurrency, **summary}
+                )
+                print(format_row(results[-1]))
+        requests_by_operation = dict(stack.daemon.docker.requests)
+    return {
+        "name": args.name,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": git_commit(),
+        "settings": {
+            "iterations": args.iterations,
+            "workers": args.workers,
+            "image": args.image,
+            "latencies": {**fake_docker.LATENCIES, **args.latencies},
+        },
+        "docker_requests": requests_by_operation,
+        "results": results,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+HEADER = (
+    f"{'scenario':<10}{'conc':>5}{'reqs':>6}{'errs':>5}"
+    f"{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+)
+
+
+def format_row(row: dict) -> str:
+    return (
+        f"{row['scenario']:<10}{row['concurrency']:>5}{row['requests']:>6}"
+        f"{row['errors']:>5}{row['throughput']:>9.1f}{row['p50_ms']:>9.1f}"
+        f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}"
+    )
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """Return the regressions of a run against a baseline.
+
+    A regression is throughput lower, or p95 latency higher, by more than
+    `threshold` (a fraction) for the same scenario and concurrency.
+    """
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\nCompared with {baseline['name']} ({baseline.get('commit')}):")
+    for row in current["results"]:
+        base = previous.get((row["scenario"], row["concurrency"]))
+        if base is None:
+            continue
+        throughput = (
+            row["throughput"] / base["throughput"] - 1 if base["throughput"] else 0
+        )
+        p95 = row["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] else 0
+        flag = ""
+        if throughput < -threshold or p95 > threshold:
+            flag = "  REGRESSION"
+            regressions.append(f"{row['scenario']} x{row['concurrency']}")
+        print(
+            f"{row['scenario']:<10}{row['concurrency']:>5}"
+            f"  req/s {throughput:+7.1%}  p95 {p95:+7.1%}{flag}"
+        )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=[1, 2, 4, 8, 16],
+        help="Comma-separated numbers of concurrent users (default 1,2,4,8,16)",
+    )
+    parser.add_argument(
+        "--scenarios",
+        type=lambda s: s.split(","),
+        default=list(SCENARIOS),
+        help=f"Comma-separated scenarios, in order (default {','.join(SCENARIOS)})",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=5, help="Operations per user per scenario"
+    )
+    parser.add_argument("--workers", type=int, default=4, help="RQ worker processes")
+    parser.add_argument("--port", type=int, default=5099, help="Port for the app")
+    parser.add_argument("--image", default="python:3.12-slim", help="QuickCode image")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument(
+        "--database-url", help="Database for the app (default: a new SQLite file)"
+    )
+    parser.add_argument(
+        "--latency",
+        dest="latencies",
+        action="append",
+        default=[],
+        metavar="OPERATION=SECONDS",
+        help="Override a fake Docker latency, e.g. start=0.5",
+    )
+    parser.add_argument("--name", help="Name of the results file")
+    parser.add_argument("--compare", help="Results file to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fraction by which a result may be worse than the baseline",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show app output")
+    args = parser.parse_args()
+    args.latencies = fake_docker.parse_latencies(args.latencies)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    args.name = args.name or time.strftime("%Y%m%d-%H%M%S")
+
+    print(HEADER)
+    current = run(args)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{args.name}.json")
+    with open(path, "w") as f:
+        json.dump(current, f, indent=2)
+    print(f"\nSaved {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), current, args.threshold)
+        if regressions:
+            print(f"Regressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,11 +9,30 @@ class Config:
 
     LANGUAGES: list[str] = ["en"]
     RQ_REDIS_URL = "redis://localhost:6379/0"
+    # Seconds between batched writes of task phase changes to the database
+    TASK_PROGRESS_FLUSH_INTERVAL: float = 1.0
+    TASK_PAGE_SIZE: int = 50
+    # Port RQ workers serve /metrics on, 0 disables; the web app serves it itself
+    METRICS_PORT: int = 9100
+    # Bearer token required to scrape the web app's /metrics. Without one
+    # only requests from the same host are answered.
+    METRICS_TOKEN: str | None = None
     DOCKER_HOST: str = "localhost:2376"
+    # Docker client connection pool per process, timeouts in seconds
+    DOCKER_POOL_SIZE: int = 32
+    DOCKER_TIMEOUTS: dict[str, int] = {"default": 30, "pull": 600, "build": 1800}
+    DOCKER_RETRIES: int = 3
+    # Named Docker daemons shells are placed on, e.g.
+    # {"node1": "tcp://10.0.0.1:2375"}. Empty means the local daemon only.
+    DOCKER_ENDPOINTS: dict[str, str] = {}
+    # Pin the Engine API version to skip negotiating it for every new client
+    DOCKER_API_VERSION: str | None = None
     CLOUDSHELL_PREFIX: str = "/cloudshell"
     SECRET_KEY = secrets.token_urlsafe()
     SECURITY_PASSWORD_SALT = str(secrets.SystemRandom().getrandbits(128))
     DEFAULT_IMAGE = "ghcr.io/aoudiamoncef/ubuntu-sshd/ubuntu-sshd:latest"
+    # Seconds between checks for a new DEFAULT_IMAGE digest, 0 disables pre-pull
+    CLOUDSHELL_IMAGE_PREPULL_INTERVAL: int = 3600
     # Change for production env
     SQLALCHEMY_DATABASE_URI = "sqlite:///test.db"
     DEBUG = True
@@ -39,6 +58,124 @@ class Config:
     # QuickCode
     QUICKCODE_IMAGE_WHITELIST_ENABLE: bool = False
     QUICKCODE_IMAGE_WHITELIST: list[str] = [""]
+    # Seconds a pulled image is trusted before its digest is checked again
+    QUICKCODE_IMAGE_DIGEST_TTL: int = 3600
+    # Least recently used QuickCode images are removed above this size
+    QUICKCODE_IMAGE_DISK_BUDGET_MB: int = 10240
+    # Runs are killed after this many seconds or bytes of output
+    QUICKCODE_TIMEOUT: int = 60
+    QUICKCODE_MAX_OUTPUT_BYTES: int = 1048576
+    # Bytes of output kept for the result of a run that is not streamed
+    QUICKCODE_RETAINED_OUTPUT_BYTES: int = 65536
+    QUICKCODE_MAX_INPUT_BYTES: int = 1048576
+    # Opt-in cache of results of identical runs, in seconds and bytes
+    QUICKCODE_RESULT_CACHE_TTL: int = 86400
+    QUICKCODE_RESULT_CACHE_MAX_BYTES: int = 268435456
+    # Batch runs share QUICKCODE_MAX_CONCURRENCY containers, taking turns
+    # between users, none of whom may run more than the per-user cap at once
+    QUICKCODE_MAX_CONCURRENCY: int = 16
+    QUICKCODE_MAX_CONCURRENCY_PER_USER: int = 4
+    QUICKCODE_BATCH_MAX_ITEMS: int = 500
+    QUICKCODE_BATCH_PAGE_SIZE: int = 100
+    # Seconds a started item may wait for a worker before its slot is freed
+    # and it is queued again, and between checks for such items
+    QUICKCODE_BATCH_QUEUE_TIMEOUT: int = 300
+    QUICKCODE_BATCH_DISPATCH_INTERVAL: int = 30
+    # Seconds batch results are kept
+    QUICKCODE_BATCH_TTL: int = 86400
+
+    # CloudShell warm pool
+    CLOUDSHELL_POOL_SIZE: int = 5
+    CLOUDSHELL_POOL_LOW_WATERMARK: int = 2
+    # Seconds to wait for a new shell's sshd to accept connections
+    CLOUDSHELL_READY_TIMEOUT: int = 30
+    # Container inventory sync, in seconds
+    CLOUDSHELL_INVENTORY_FLUSH_INTERVAL: int = 5
+    CLOUDSHELL_RECONCILE_INTERVAL: int = 300
+    CLOUDSHELL_ORPHAN_GRACE: int = 600
+    # Idle shells are stopped after this many seconds, 0 disables hibernation
+    CLOUDSHELL_IDLE_TIMEOUT: int = 1800
+    CLOUDSHELL_IDLE_CHECK_INTERVAL: int = 60
+    # CPU seconds per check above which a shell counts as active
+    CLOUDSHELL_IDLE_CPU_SECONDS: float = 1.0
+    # Shell placement across DOCKER_ENDPOINTS: "least-loaded" or "bin-packing"
+    CLOUDSHELL_PLACEMENT_POLICY: str = "least-loaded"
+    CLOUDSHELL_SHELL_MEMORY_MB: int = 256
+    CLOUDSHELL_SHELLS_PER_CPU: int = 8
+    CLOUDSHELL_HOST_STATS_TTL: int = 10
+    # SSH gateway, the only way into shells. Shells join CLOUDSHELL_NETWORK
+    # (the default bridge when None), which the gateway must be attached to,
+    # as docker-compose.yml does with ucloudshell_shells.
+    CLOUDSHELL_NETWORK: str | None = None
+    CLOUDSHELL_GATEWAY_BIND: str = "0.0.0.0"
+    CLOUDSHELL_GATEWAY_PORT: int = 2222
+    # Key files, relative to the instance folder, created on first use
+    CLOUDSHELL_GATEWAY_HOST_KEY: str = "gateway_host_key"
+    CLOUDSHELL_GATEWAY_CLIENT_KEY: str = "gateway_client_key"
+    CLOUDSHELL_GATEWAY_CONNECT_TIMEOUT: int = 10
+    # Seconds an unused connection to a shell is kept open for reuse
+    CLOUDSHELL_GATEWAY_LINGER: int = 60
+    # Browser terminal proxy. The shell page connects to CLOUDSHELL_TERMINAL_URL,
+    # or to /cloudshell/terminal on the same host when it is None.
+    CLOUDSHELL_TERMINAL_URL: str | None = None
+    CLOUDSHELL_TERMINAL_BIND: str = "0.0.0.0"
+    CLOUDSHELL_TERMINAL_PORT: int = 8765
+    CLOUDSHELL_TERMINAL_FRAME_BYTES: int = 16384
+    CLOUDSHELL_TERMINAL_FLUSH_MS: int = 10
+    # Bytes buffered per client before output from the shell is paused
+    CLOUDSHELL_TERMINAL_WRITE_LIMIT: int = 65536
+    # Terminal session recording, files live in the instance folder
+    CLOUDSHELL_RECORDING_ENABLED: bool = True
+    CLOUDSHELL_RECORDING_DIR: str = "recordings"
+    # Uncompressed bytes per block, and the longest a block may span, which
+    # bounds how much playback decodes to seek to a point in a session
+    CLOUDSHELL_RECORDING_BLOCK_BYTES: int = 65536
+    CLOUDSHELL_RECORDING_KEYFRAME_SECONDS: int = 5
+    # Keystrokes can contain passwords, so only output is recorded by default
+    CLOUDSHELL_RECORDING_INPUT: bool = False
+    CLOUDSHELL_RECORDING_PAGE_SIZE: int = 10000
+    # Usage metering, run on every Docker host. Samples every
+    # METERING_INTERVAL seconds are summed into METERING_BUCKET_SECONDS
+    # buckets kept for METERING_RETENTION seconds, and debited from balances
+    # every METERING_BILLING_INTERVAL seconds.
+    METERING_CGROUP_ROOT: str = "/sys/fs/cgroup"
+    METERING_INTERVAL: int = 5
+    METERING_BUCKET_SECONDS: int = 300
+    METERING_RETENTION: int = 30 * 86400
+    METERING_BILLING_INTERVAL: int = 300
+    METERING_PRICE_CPU_SECOND: float = 0.00001
+    METERING_PRICE_GB_SECOND: float = 0.000002
+    METERING_PRICE_NETWORK_GB: float = 0.01
+    # Request profiling. Requests under PROFILING_PATHS are sampled every
+    # PROFILING_INTERVAL_MS when they send an X-Profile header equal to
+    # PROFILING_TOKEN, while `flask cloudshell profiling on` is in effect, or,
+    # with PROFILING_SLOW_MS set, all the time, keeping those slower than it.
+    # Disabling it removes the request hooks altogether.
+    PROFILING_ENABLED: bool = True
+    PROFILING_PATHS: list[str] = ["/cloudshell", "/api"]
+    PROFILING_INTERVAL_MS: int = 10
+    PROFILING_TOKEN: str | None = None
+    PROFILING_SLOW_MS: int = 0
+    PROFILING_RETENTION: int = 86400
+    PROFILING_MAX_PROFILES: int = 1000
+    # Outgoing mail is queued in Redis and sent by `flask cloudshell mailer`
+    # over one SMTP connection, up to MAIL_BATCH_SIZE messages per round, and
+    # closed after MAIL_IDLE_TIMEOUT idle seconds. Failed sends are retried
+    # after MAIL_RETRY_BACKOFF seconds, doubling each time.
+    MAIL_BATCH_SIZE: int = 50
+    MAIL_IDLE_TIMEOUT: int = 30
+    MAIL_MAX_ATTEMPTS: int = 5
+    MAIL_RETRY_BACKOFF: int = 30
+    # Token-authenticated requests find their user in a per-process LRU of
+    # AUTH_CACHE_SIZE users, then in Redis, for up to AUTH_CACHE_TTL seconds,
+    # instead of the database. Changing a user's password, roles or active
+    # flag evicts them everywhere as soon as it is committed.
+    AUTH_CACHE_ENABLED: bool = True
+    AUTH_CACHE_TTL: int = 30
+    AUTH_CACHE_SIZE: int = 10000
+    # Bulk lifecycle API
+    CLOUDSHELL_BULK_MAX_ITEMS: int = 500
+    CLOUDSHELL_BULK_CONCURRENCY: int = 8
 
 
 class TestingConfig(Config):
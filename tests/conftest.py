@@ -0,0 +1,92 @@
+"""Fixtures running the app against fakeredis and the fake Docker daemon.
+
+The app is the one `app.tasks` creates when imported, as in an RQ worker,
+so the environment it reads its config from is set up before the import.
+"""
+
+import os
+import uuid
+import fakeredis
+import pytest
+from benchmarks import fake_docker
+
+
+@pytest.fixture(scope="session")
+def docker_server():
+    # Exec output sent with the upgrade response would be lost by docker-py,
+    # which reads it from the socket, so execs keep their latency
+    latencies = {op: 0.0 for op in fake_docker.LATENCIES if op != "exec"}
+    server = fake_docker.serve(latencies={**latencies, "ready": 0.01})
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(scope="session")
+def _app(docker_server, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("instance")
+    os.environ.update(
+        {
+            "DOCKER_HOST": f"tcp://127.0.0.1:{docker_server.server_address[1]}",
+            "FLASK_SQLALCHEMY_DATABASE_URI": f"sqlite:///{directory / 'test.db'}",
+            "FLASK_DEBUG": "false",
+            "FLASK_WTF_CSRF_ENABLED": "false",
+            "FLASK_METRICS_PORT": "0",
+            "FLASK_CLOUDSHELL_IMAGE_PREPULL_INTERVAL": "0",
+            # Claims only queue refills in tests that ask for them
+            "FLASK_CLOUDSHELL_POOL_LOW_WATERMARK": "-1",
+        }
+    )
+    import app as app_package
+
+    app_package.Redis = fakeredis.FakeRedis
+    from app import tasks
+
+    tasks.app.instance_path = str(directory)
+    return tasks.app
+
+
+@pytest.fixture
+def app(_app, docker_server):
+    """The app with an empty database, Redis and Docker daemon.
+
+    `app.tasks` pushes a context for the whole session, which requests would
+    share, along with `g`, so each test pushes its own.
+    """
+    from app.extensions import db
+
+    config = dict(_app.config)
+    with _app.app_context():
+        db.drop_all()
+        db.create_all()
+        _app.redis.flushall()
+        docker_server.docker.containers.clear()
+        auth_cache = _app.extensions.get("auth_cache")
+        if auth_cache is not None:
+            auth_cache.clear()
+        yield _app
+        db.session.remove()
+    # Undo config changes made by the test
+    _app.config.clear()
+    _app.config.update(config)
+
+
+@pytest.fixture
+def daemon(docker_server):
+    """The fake daemon's state, e.g. its containers by ID."""
+    return docker_server.docker
+
+
+@pytest.fixture
+def user(app):
+    from app.extensions import db
+    from app.models import User
+
+    user = User(
+        email="user@example.com",
+        username="user",
+        active=True,
+        fs_uniquifier=uuid.uuid4().hex,
+    )
+    db.session.add(user)
+    db.session.commit()
+    return user
@@ -0,0 +1,116 @@
+import json
+from contextlib import contextmanager
+import pytest
+import sqlalchemy as sa
+from app import authcache
+from app.extensions import db
+from app.models import Role
+
+
+@contextmanager
+def queries():
+    """Collect the SQL statements run inside the block."""
+    statements = []
+
+    def collect(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.engine
+    sa.event.listen(engine, "before_cursor_execute", collect)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", collect)
+
+
+@pytest.fixture
+def uniquifier(user):
+    uniquifier = user.fs_uniquifier
+    authcache.find_user(uniquifier)
+    # As in a new request
+    db.session.remove()
+    return uniquifier
+
+
+def cached(app, uniquifier):
+    entry = app.redis.get(authcache.USER_KEY.format(uniquifier))
+    return json.loads(entry) if entry is not None else None
+
+
+def test_cached_user_is_loaded_without_queries(app, user, uniquifier):
+    assert cached(app, uniquifier)["user"]["email"] == "user@example.com"
+    with queries() as statements:
+        found = authcache.find_user(uniquifier)
+    assert found.email == "user@example.com"
+    assert statements == []
+
+
+def test_commit_evicts_changed_user(app, uniquifier):
+    user = authcache.find_user(uniquifier)
+    user.active = False
+    db.session.commit()
+
+    assert cached(app, uniquifier) is None
+    assert app.redis.get(authcache.VERSION_KEY.format(uniquifier)) == b"1"
+    db.session.remove()
+    assert authcache.find_user(uniquifier).active is False
+
+
+def test_role_change_evicts_members(app, user):
+    role = Role(name="admin")
+    user.roles.append(role)
+    db.session.commit()
+    uniquifier = user.fs_uniquifier
+    authcache.find_user(uniquifier)
+    db.session.remove()
+
+    role = db.session.scalar(sa.select(Role))
+    role.description = "Administrators"
+    db.session.commit()
+
+    assert cached(app, uniquifier) is None
+    db.session.remove()
+    roles = authcache.find_user(uniquifier).roles
+    assert [role.description for role in roles] == ["Administrators"]
+
+
+def test_unwatched_change_keeps_user_cached(app, uniquifier):
+    user = authcache.find_user(uniquifier)
+    user.balance = 10.0
+    db.session.commit()
+
+    assert cached(app, uniquifier) is not None
+
+
+def test_rollback_keeps_user_cached(app, uniquifier):
+    user = authcache.find_user(uniquifier)
+    user.active = False
+    db.session.flush()
+    db.session.rollback()
+
+    assert cached(app, uniquifier) is not None
+    assert app.redis.get(authcache.VERSION_KEY.format(uniquifier)) is None
+
+
+def test_entry_written_before_invalidation_is_ignored(app, uniquifier):
+    # A reader that raced the invalidation writes back what it read
+    stale = app.redis.get(authcache.USER_KEY.format(uniquifier))
+    authcache.invalidate([uniquifier])
+    app.redis.set(authcache.USER_KEY.format(uniquifier), stale)
+
+    with queries() as statements:
+        authcache.find_user(uniquifier)
+    assert statements
+    assert cached(app, uniquifier)["version"] == 1
+
+
+def test_role_deletion_evicts_members(app, user):
+    user.roles.append(Role(name="admin"))
+    db.session.commit()
+    uniquifier = user.fs_uniquifier
+    authcache.find_user(uniquifier)
+
+    db.session.delete(db.session.scalar(sa.select(Role)))
+    db.session.commit()
+
+    assert cached(app, uniquifier) is None
@@ -0,0 +1,82 @@
+import time
+from app.quickcode import batch
+
+IMAGE = "python:3.12-slim"
+
+
+def _jobs(count):
+    return [{"image": IMAGE, "command": f"echo {i}"} for i in range(count)]
+
+
+def _running(app, user_id):
+    return app.redis.zcard(batch.USER_RUNNING_KEY.format(user_id))
+
+
+def _queued(app):
+    return [job.args for job in app.task_queue.jobs]
+
+
+def test_slots_are_shared_between_users(app):
+    app.config["QUICKCODE_MAX_CONCURRENCY"] = 4
+    app.config["QUICKCODE_MAX_CONCURRENCY_PER_USER"] = 3
+
+    heavy = batch.submit(1, _jobs(6))
+    assert _running(app, 1) == 3
+    light = batch.submit(2, _jobs(2))
+    assert (_running(app, 1), _running(app, 2)) == (3, 1)
+
+    # The freed slot goes to the user with fewer items running
+    batch.finish(heavy, 0, 1)
+    assert (_running(app, 1), _running(app, 2)) == (2, 2)
+    assert len(_queued(app)) == 5
+    assert (light, 1) in _queued(app)
+
+
+def test_rejected_images_are_not_queued(app):
+    app.config["QUICKCODE_IMAGE_WHITELIST_ENABLE"] = True
+    app.config["QUICKCODE_IMAGE_WHITELIST"] = [IMAGE]
+
+    batch_id = batch.submit(1, [*_jobs(1), {"image": "evil", "command": "x"}])
+    status = batch.status(batch_id)
+    assert status["counts"] == {"pending": 1, "rejected": 1}
+    assert _queued(app) == [(batch_id, 0)]
+
+
+def test_expired_slots_are_reclaimed(app):
+    app.config["QUICKCODE_MAX_CONCURRENCY"] = 2
+    batch_id = batch.submit(1, _jobs(3))
+    # Item 0 is running, item 1's job never reached a worker
+    batch.update_item(batch_id, 0, status="running")
+    expired = time.time() - 1
+    for index in (0, 1):
+        app.redis.zadd(batch.RUNNING_KEY, {f"{batch_id}:{index}": expired})
+        app.redis.zadd(
+            batch.USER_RUNNING_KEY.format(1), {f"{batch_id}:{index}": expired}
+        )
+
+    assert batch.dispatch() == 2
+    assert batch.get_item(batch_id, 0)["status"] == "failed"
+    assert batch.get_item(batch_id, 1)["status"] == "pending"
+    # Item 2 and the requeued item 1 now hold the slots
+    assert app.redis.zscore(batch.RUNNING_KEY, f"{batch_id}:1") > time.time()
+    assert app.redis.zscore(batch.RUNNING_KEY, f"{batch_id}:2") > time.time()
+
+
+def test_reclaimed_items_are_not_started(app):
+    batch_id = batch.submit(1, _jobs(1))
+    assert batch.start(batch_id, 0, 1)
+
+    app.redis.zrem(batch.RUNNING_KEY, f"{batch_id}:0")
+    assert not batch.start(batch_id, 0, 1)
+
+
+def test_status_pages_items_in_order(app):
+    app.config["QUICKCODE_MAX_CONCURRENCY"] = 0
+    batch_id = batch.submit(1, _jobs(3))
+    batch.update_item(batch_id, 0, status="finished")
+
+    status = batch.status(batch_id, offset=0, limit=2)
+    assert status["status"] == "running"
+    assert [item["index"] for item in status["items"]] == [0, 1]
+    assert status["next"] == 2
+    assert status["counts"] == {"finished": 1, "pending": 2}
@@ -0,0 +1,60 @@
+import json
+import smtplib
+import pytest
+from app import email
+
+
+def _queue(subject):
+    return email.queue(subject, "app@example.com", ["user@example.com"], "", "")
+
+
+def _subjects(redis, key):
+    return [json.loads(raw)["subject"] for raw in redis.lrange(key, 0, -1)]
+
+
+def test_messages_being_sent_are_requeued_when_the_mailer_restarts(app):
+    _queue("first")
+    _queue("second")
+    # The mailer dies after taking the batch, before sending it
+    assert len(email.Mailer().next_batch()) == 2
+    assert app.redis.llen(email.OUTBOX_KEY) == 0
+    _queue("third")
+
+    assert email.Mailer().recover() == 2
+    assert app.redis.llen(email.PROCESSING_KEY) == 0
+    assert _subjects(app.redis, email.OUTBOX_KEY) == ["first", "second", "third"]
+
+
+def test_messages_leave_processing_once_sent_retried_or_failed(app, monkeypatch):
+    sent = []
+
+    def send(self, msg):
+        if msg.subject == "retried":
+            raise smtplib.SMTPResponseException(451, b"Try again later")
+        if msg.subject == "failed":
+            raise smtplib.SMTPResponseException(550, b"No such user")
+        sent.append(msg.subject)
+
+    monkeypatch.setattr(email.Mailer, "send", send)
+    for subject in ("sent", "retried", "failed"):
+        _queue(subject)
+    mailer = email.Mailer()
+
+    mailer.deliver(mailer.next_batch())
+    assert sent == ["sent"]
+    assert app.redis.llen(email.PROCESSING_KEY) == 0
+    assert app.redis.zcard(email.RETRY_KEY) == 1
+    assert _subjects(app.redis, email.FAILED_KEY) == ["failed"]
+
+
+def test_message_stays_in_processing_if_the_mailer_dies_sending_it(app, monkeypatch):
+    def send(self, msg):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(email.Mailer, "send", send)
+    _queue("interrupted")
+    mailer = email.Mailer()
+
+    with pytest.raises(KeyboardInterrupt):
+        mailer.deliver(mailer.next_batch())
+    assert _subjects(app.redis, email.PROCESSING_KEY) == ["interrupted"]
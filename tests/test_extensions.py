@@ -0,0 +1,14 @@
+from app.extensions import client
+
+
+def test_db_commands_load_flask_migrate_when_run(app):
+    result = app.test_cli_runner().invoke(args=["db", "--help"])
+
+    assert result.exit_code == 0, result.output
+    assert "upgrade" in result.output
+    assert app.extensions["migrate"].db is not None
+
+
+def test_docker_client_is_created_on_first_use(app):
+    assert client.ping()
+    assert client.stats()["clients"] >= 1
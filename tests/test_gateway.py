@@ -0,0 +1,118 @@
+import io
+import socket
+import threading
+from unittest import mock
+import paramiko
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from app.cloudshell.gateway import Upstreams, parse_host_key
+
+
+class _Shell(paramiko.ServerInterface):
+    """An sshd letting in one key, without shells."""
+
+    def __init__(self, client_key):
+        self.client_key = client_key
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if key == self.client_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+def _ed25519() -> paramiko.Ed25519Key:
+    pem = ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption(),
+    )
+    return paramiko.Ed25519Key.from_private_key(io.StringIO(pem.decode()))
+
+
+@pytest.fixture(scope="module")
+def keys():
+    """A shell's host key and the gateway's client key."""
+    return _ed25519(), _ed25519()
+
+
+@pytest.fixture
+def shell(keys):
+    """A listening shell with the first key as its host key."""
+    host_key, client_key = keys
+    listener = socket.create_server(("127.0.0.1", 0))
+    transports = []
+
+    def serve():
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.start_server(server=_Shell(client_key))
+            transports.append(transport)
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield listener.getsockname()
+    listener.close()
+    for transport in transports:
+        transport.close()
+
+
+def _public(key):
+    return parse_host_key(f"{key.get_name()} {key.get_base64()}")
+
+
+def test_parse_host_key_reads_recorded_keys(keys):
+    host_key, _ = keys
+    line = f"{host_key.get_name()} {host_key.get_base64()} root@shell"
+    assert parse_host_key(line) == host_key
+
+
+def test_open_requires_the_recorded_host_key(keys, shell):
+    host_key, client_key = keys
+    upstreams = Upstreams(connect_timeout=5, linger=60)
+
+    channel, transport, reused = upstreams.open(
+        "shell", shell, client_key, _public(host_key)
+    )
+    assert not reused
+    assert transport.is_authenticated()
+    channel.close()
+
+    with pytest.raises(paramiko.SSHException):
+        upstreams.open("other", shell, client_key, _public(client_key))
+
+
+def test_open_reuses_connections(keys, shell):
+    host_key, client_key = keys
+    upstreams = Upstreams(connect_timeout=5, linger=60)
+
+    first, transport, _ = upstreams.open("shell", shell, client_key, _public(host_key))
+    second, again, reused = upstreams.open(
+        "shell", shell, client_key, _public(host_key)
+    )
+    assert reused
+    assert again is transport
+    first.close()
+    second.close()
+    transport.close()
+
+
+def test_failed_connections_are_closed(monkeypatch):
+    transport = mock.Mock()
+    transport.open_session.side_effect = paramiko.SSHException("MaxSessions")
+    upstreams = Upstreams(connect_timeout=5, linger=60)
+    monkeypatch.setattr(upstreams, "_connect", lambda *args: transport)
+
+    with pytest.raises(paramiko.SSHException):
+        upstreams.open("shell", ("127.0.0.1", 22), None, None)
+    transport.close.assert_called_once()
@@ -0,0 +1,112 @@
+import pytest
+import sqlalchemy as sa
+from app.extensions import client, db, DEFAULT_HOST
+from app.models import Container
+from app.cloudshell import inventory, pool
+from app.cloudshell.helpers import SSH_PORT, provision_container
+
+
+def _own(container_id, user):
+    db.session.add(
+        Container(
+            container_id=container_id,
+            user_id=user.id,
+            port=SSH_PORT,
+            host=DEFAULT_HOST,
+            status="running",
+        )
+    )
+    db.session.commit()
+
+
+def _status(container_id):
+    db.session.expire_all()
+    return db.session.scalar(
+        sa.select(Container.status).where(Container.container_id == container_id)
+    )
+
+
+def test_reconcile_removes_orphans(app, daemon, user):
+    app.config["CLOUDSHELL_ORPHAN_GRACE"] = -1
+    owned = provision_container()
+    _own(owned.id, user)
+    pooled = provision_container()
+    app.redis.rpush(pool.READY_KEY, pooled.id)
+    orphan = provision_container()
+    _own("gone", user)
+
+    assert inventory.reconcile() == {"synced": 1, "missing": 1, "orphans": 1}
+    assert orphan.id not in daemon.containers
+    assert {owned.id, pooled.id} <= daemon.containers.keys()
+    assert _status(owned.id) == "running"
+    assert _status("gone") == "removed"
+
+
+def test_reconcile_keeps_young_orphans(app, daemon):
+    orphan = provision_container()
+
+    assert inventory.reconcile()["orphans"] == 0
+    assert orphan.id in daemon.containers
+
+
+def test_reconcile_ignores_unlabelled_containers(app, daemon):
+    app.config["CLOUDSHELL_ORPHAN_GRACE"] = -1
+    container = client.containers.create("busybox", detach=True)
+
+    assert inventory.reconcile()["orphans"] == 0
+    assert container.id in daemon.containers
+
+
+def test_reconcile_marks_stopped_shells(app, daemon, user):
+    shell = provision_container()
+    _own(shell.id, user)
+    shell.stop()
+
+    assert inventory.reconcile()["synced"] == 1
+    assert _status(shell.id) == "exited"
+
+
+def test_flush_writes_cached_changes(app, user):
+    _own("shell", user)
+    inventory.update("shell", status="exited")
+    assert _status("shell") == "running"
+
+    assert inventory.flush() == 1
+    assert _status("shell") == "exited"
+    assert inventory.flush() == 0
+
+
+def test_reconcile_keeps_unflushed_hibernation(app, daemon, user):
+    shell = provision_container()
+    _own(shell.id, user)
+    # Hibernated but not flushed yet when reconcile sees it stopped
+    inventory.update(shell.id, status="hibernated")
+    shell.stop()
+
+    inventory.reconcile()
+    assert _status(shell.id) == "hibernated"
+    assert inventory.get(shell.id)["status"] == "hibernated"
+
+
+class _Stop(Exception):
+    pass
+
+
+def test_sync_continues_after_a_failing_step(app, monkeypatch):
+    app.config["CLOUDSHELL_RECONCILE_INTERVAL"] = 0
+    calls = []
+
+    def reconcile():
+        calls.append("reconcile")
+        raise ConnectionError("Docker is down")
+
+    def sleep(seconds):
+        if len(calls) >= 2:
+            raise _Stop
+        calls.append("sleep")
+
+    monkeypatch.setattr(inventory, "reconcile", reconcile)
+    monkeypatch.setattr(inventory.time, "sleep", sleep)
+    with pytest.raises(_Stop):
+        inventory.sync()
+    assert calls == ["reconcile", "sleep", "reconcile"]
@@ -0,0 +1,71 @@
+import pytest
+from app import metering
+from app.extensions import db
+from app.models import User
+
+CONTAINER_ID = "a" * 64
+USAGE = {"cpu_seconds": 100.0, "memory_gb_seconds": 0.0, "network_bytes": 0}
+
+
+def _cgroup(root, cpu_usec, memory=2**30):
+    path = root / "system.slice" / f"docker-{CONTAINER_ID}.scope"
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "cpu.stat").write_text(f"usage_usec {cpu_usec}\nuser_usec 0\n")
+    (path / "memory.current").write_text(str(memory))
+    (path / "cgroup.procs").write_text("")
+
+
+def _balance(user_id):
+    db.session.expire_all()
+    return db.session.get(User, user_id).balance or 0.0
+
+
+def test_collector_reports_usage_from_the_second_sample(tmp_path):
+    collector = metering.Collector(str(tmp_path))
+    _cgroup(tmp_path, 1_000_000)
+    assert collector.sample() == {}
+
+    _cgroup(tmp_path, 3_500_000)
+    usage = collector.sample()[CONTAINER_ID]
+    assert usage["cpu_seconds"] == 2.5
+    assert usage["memory_gb_seconds"] > 0
+    assert usage["network_bytes"] == 0
+
+
+def test_recorded_usage_is_debited_once(app, user):
+    app.config["METERING_PRICE_CPU_SECOND"] = 0.01
+    user_id = user.id
+    metering.register(CONTAINER_ID, user_id)
+
+    assert metering.record({CONTAINER_ID: USAGE}, at=1000) == 1
+    assert metering.bill() == 1
+    assert _balance(user_id) == pytest.approx(-1.0)
+    assert metering.bill() == 0
+    assert _balance(user_id) == pytest.approx(-1.0)
+
+    [entry] = metering.history(user_id, 0)
+    assert entry["cpu_seconds"] == 100.0
+    assert entry["cost"] == pytest.approx(1.0)
+
+
+def test_unowned_containers_are_not_charged(app):
+    assert metering.record({CONTAINER_ID: USAGE}) == 0
+    assert not app.redis.exists(metering.UNBILLED_KEY)
+
+
+def test_failed_billing_keeps_the_costs(app, user, monkeypatch):
+    user_id = user.id
+    metering.register(CONTAINER_ID, user_id)
+    metering.record({CONTAINER_ID: USAGE})
+
+    def execute(*args, **kwargs):
+        raise RuntimeError("database is down")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(db.session, "execute", execute)
+        with pytest.raises(RuntimeError):
+            metering.bill()
+    assert not app.redis.exists(metering.BILLING_KEY)
+
+    assert metering.bill() == 1
+    assert _balance(user_id) < 0
@@ -0,0 +1,35 @@
+from app import metrics
+
+
+def test_metrics_are_only_served_to_this_host_without_a_token(app):
+    client = app.test_client()
+
+    assert client.get("/metrics").status_code == 200
+    remote = client.get("/metrics", environ_base={"REMOTE_ADDR": "10.0.0.5"})
+    assert remote.status_code == 403
+
+
+def test_metrics_require_the_token_when_set(app):
+    app.config["METRICS_TOKEN"] = "secret"
+    client = app.test_client()
+
+    assert client.get("/metrics").status_code == 403
+    wrong = client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+    assert wrong.status_code == 403
+    response = client.get(
+        "/metrics",
+        headers={"Authorization": "Bearer secret"},
+        environ_base={"REMOTE_ADDR": "10.0.0.5"},
+    )
+    assert response.status_code == 200
+    assert b"ucloudshell_containers" in response.data
+
+
+def test_mark_dead_removes_live_gauges_of_exited_processes(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "MULTIPROCESS", True)
+    (tmp_path / "gauge_livesum_123.db").touch()
+    (tmp_path / "counter_123.db").touch()
+
+    metrics.mark_dead(123)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["counter_123.db"]
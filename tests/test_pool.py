@@ -0,0 +1,91 @@
+import time
+from app.cloudshell import inventory, pool
+
+
+def test_refill_fills_pool_to_size(app, daemon):
+    app.config["CLOUDSHELL_POOL_SIZE"] = 2
+
+    assert pool.refill() == 2
+    assert pool.size() == 2
+    ready = [cid.decode() for cid in app.redis.lrange(pool.READY_KEY, 0, -1)]
+    assert all(daemon.containers[cid].status == "running" for cid in ready)
+    assert pool.refill() == 0
+
+
+def test_refill_skips_while_another_runs(app, daemon):
+    app.config["CLOUDSHELL_POOL_SIZE"] = 2
+    lock = app.redis.lock(pool.REFILL_LOCK_KEY)
+    assert lock.acquire(blocking=False)
+
+    assert pool.refill() == 0
+    assert pool.size() == 0
+    assert not daemon.containers
+
+
+def test_claim_hands_out_each_container_once(app):
+    app.config["CLOUDSHELL_POOL_SIZE"] = 2
+    pool.refill()
+
+    first, second = pool.claim(), pool.claim()
+    assert first is not None and second is not None
+    assert first.id != second.id
+    assert pool.claim() is None
+    stats = pool.stats()
+    assert (stats["size"], stats["hits"], stats["misses"]) == (0, 2, 1)
+
+
+def test_claim_skips_removed_containers(app, daemon):
+    app.config["CLOUDSHELL_POOL_SIZE"] = 1
+    pool.refill()
+    app.redis.lpush(pool.READY_KEY, "removed")
+
+    container = pool.claim()
+    assert container is not None
+    assert container.id in daemon.containers
+
+
+def test_claim_requests_one_refill_at_low_watermark(app):
+    app.config["CLOUDSHELL_POOL_LOW_WATERMARK"] = 0
+
+    assert pool.claim() is None
+    assert pool.claim() is None
+    jobs = [job.func_name for job in app.task_queue.jobs]
+    assert jobs == ["app.tasks.refill_shell_pool"]
+
+
+def test_reconcile_keeps_claimed_container_until_it_is_owned(app, daemon):
+    app.config["CLOUDSHELL_POOL_SIZE"] = 1
+    app.config["CLOUDSHELL_ORPHAN_GRACE"] = -1
+    pool.refill()
+
+    # Claimed, but its Container row is not committed yet
+    container = pool.claim()
+    assert inventory.reconcile()["orphans"] == 0
+    assert container.id in daemon.containers
+
+    # Neither owned nor claimed any more
+    pool.release(container.id)
+    assert inventory.reconcile()["orphans"] == 1
+    assert container.id not in daemon.containers
+
+
+def test_old_claims_are_forgotten(app):
+    app.config["CLOUDSHELL_POOL_SIZE"] = 1
+    pool.refill()
+    container = pool.claim()
+    assert pool.claimed() == {container.id}
+
+    app.redis.hset(pool.CLAIMED_AT_KEY, container.id, time.time() - pool.CLAIM_TTL - 1)
+    assert pool.claimed() == set()
+    assert app.redis.llen(pool.CLAIMED_KEY) == 0
+
+
+def test_create_shell_releases_its_claim(app, user):
+    from app import tasks
+
+    app.config["CLOUDSHELL_POOL_SIZE"] = 1
+    pool.refill()
+
+    info = tasks.create_shell(user.id)
+    assert info["container_id"] not in pool.claimed()
+    assert app.redis.llen(pool.CLAIMED_KEY) == 0
@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import Counter
+from app import profiling
+
+
+def _busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_sampler_records_the_stacks_of_registered_threads():
+    sampler = profiling.Sampler(0.005)
+    samples = {}
+
+    def work():
+        sampler.start(threading.get_ident())
+        _busy(0.2)
+        samples.update(sampler.stop(threading.get_ident()))
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+
+    innermost: Counter = Counter()
+    for stack, count in samples.items():
+        innermost[stack[-1]] += count
+    assert innermost.most_common(1)[0][0] == f"{__name__}:_busy"
+    assert sum(samples.values()) > 5
+
+
+def test_time_is_split_by_the_innermost_library():
+    assert profiling._category(("app.api:get", "sqlalchemy.orm:execute")) == (
+        "sqlalchemy"
+    )
+    assert profiling._category(("docker.api:get", "redis.client:execute")) == "redis"
+    assert profiling._category(("app.api:get",)) == "python"
+
+
+def test_saved_profiles_are_listed_newest_first(app):
+    app.config["PROFILING_MAX_PROFILES"] = 2
+    samples = Counter(
+        {("app.api:get", "docker.api:get"): 3, ("app.api:get", "app.api:render"): 1}
+    )
+    ids = [
+        profiling.save({"path": f"/api/{i}", "duration_ms": 100.0}, samples)
+        for i in range(3)
+    ]
+
+    recent = profiling.recent()
+    assert [profile["id"] for profile in recent] == ids[:0:-1]
+    assert recent[0]["breakdown_ms"] == {"docker": 75, "python": 25}
+    assert "stacks" not in recent[0]
+    stacks = profiling.get(ids[-1])["stacks"].splitlines()
+    assert stacks[0] == "app.api:get;docker.api:get 3"
@@ -0,0 +1,68 @@
+import threading
+import time
+import uuid
+from app import progress
+from app.extensions import db
+from app.models import Task
+
+
+def _task(user):
+    task = Task(id=str(uuid.uuid4()), name="tasks.create_shell", user=user)
+    db.session.add(task)
+    db.session.commit()
+    return task.id
+
+
+def _row(task_id):
+    db.session.expire_all()
+    return db.session.get(Task, task_id)
+
+
+def test_flush_writes_only_transitions_once(app, user):
+    task_id = _task(user)
+    progress.publish(task_id, user.id, 10, "create", transition=True)
+    progress.publish(task_id, user.id, 40, "start", transition=True)
+    progress.publish(task_id, user.id, 50, "start")
+
+    assert progress.flush() == 1
+    row = _row(task_id)
+    assert (row.progress, row.phase, row.complete) == (50, "start", False)
+    assert progress.flush() == 0
+
+
+def test_flush_marks_finished_tasks_complete(app, user):
+    task_id = _task(user)
+    progress.publish(task_id, user.id, 100, "ready", transition=True)
+
+    progress.flush()
+    assert _row(task_id).complete
+
+
+def test_get_many_skips_unknown_tasks(app, user):
+    task_id = _task(user)
+    progress.publish(task_id, user.id, 40, "start")
+
+    assert progress.get_many([task_id, "unknown"]) == {
+        task_id: {"task_id": task_id, "progress": 40, "phase": "start"}
+    }
+
+
+def test_listen_ends_when_the_tasks_are_done(app, user):
+    task_id = _task(user)
+    progress.publish(task_id, user.id, 10, "create")
+    user_id = user.id
+
+    def finish():
+        time.sleep(0.1)
+        with app.app_context():
+            progress.publish("other", user_id, 50, "start")
+            progress.publish(task_id, user_id, 100, "ready", transition=True)
+
+    threading.Thread(target=finish).start()
+    states = progress.listen(user_id, [task_id], heartbeat=5)
+
+    # None is a heartbeat
+    assert [(s["progress"], s["phase"]) for s in states if s is not None] == [
+        (10, "create"),
+        (100, "ready"),
+    ]
@@ -0,0 +1,60 @@
+from app.quickcode import helpers
+
+IMAGE = "python:3.12-slim"
+
+
+def test_output_buffer_keeps_the_end_of_the_output():
+    buffer = helpers.OutputBuffer(8)
+    buffer.append("stdout", b"hello ")
+    buffer.append("stderr", b"oops")
+    buffer.append("stdout", b"world")
+
+    assert buffer.truncated
+    assert buffer.size == 8
+    assert (buffer.text("stdout"), buffer.text("stderr")) == ("world", "ops")
+
+
+def test_output_buffer_keeps_the_end_of_a_large_chunk():
+    buffer = helpers.OutputBuffer(4)
+    buffer.append("stdout", b"0123456789")
+
+    assert buffer.text("stdout") == "6789"
+    assert buffer.truncated
+
+
+def test_stream_yields_output_then_exit(app, daemon):
+    events = list(helpers.stream(IMAGE, "echo hello"))
+
+    assert events[0] == ("stdout", b"echo hello\n")
+    event, status = events[-1]
+    assert event == "exit"
+    assert (status["exit_code"], status["reason"]) == (0, "exited")
+    assert not daemon.containers
+
+
+def test_stream_stops_at_the_output_limit(app, daemon):
+    app.config["QUICKCODE_MAX_OUTPUT_BYTES"] = 4
+
+    events = list(helpers.stream(IMAGE, "echo hello"))
+
+    assert events[0] == ("stdout", b"echo")
+    assert events[-1][1]["reason"] == "output_limit"
+    assert not daemon.containers
+
+
+def test_stream_removes_the_container_when_the_consumer_stops(app, daemon):
+    events = helpers.stream(IMAGE, "echo hello")
+    assert next(events)[0] == "stdout"
+    assert daemon.containers
+
+    events.close()
+    assert not daemon.containers
+
+
+def test_run_keeps_only_the_retained_output(app):
+    app.config["QUICKCODE_RETAINED_OUTPUT_BYTES"] = 6
+
+    result = helpers.run(IMAGE, "echo hello")
+    assert result["stdout"] == "hello\n"
+    assert result["truncated"]
+    assert result["exit_code"] == 0
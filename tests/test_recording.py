@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+import types
+import zlib
+from app.cloudshell import recording
+from app.cloudshell.recording import (
+    FILE_HEADER,
+    INPUT,
+    OUTPUT,
+    Player,
+    Recorder,
+    _paths,
+)
+
+
+def _events(recording_id, *args):
+    player = Player(recording_id)
+    try:
+        return [(kind, data) for _, kind, data in player.events(*args)]
+    finally:
+        player.close()
+
+
+def test_new_recording_is_playable(app, user):
+    recorder = Recorder("container", user.id, "web")
+
+    # The header is on disk before the first block is written
+    data_path, _ = _paths(recorder.recording_id)
+    assert os.path.getsize(data_path) == FILE_HEADER.size
+    player = Player(recorder.recording_id)
+    assert player.started_at is not None
+    assert list(player.events()) == []
+    player.close()
+    recorder.close()
+
+
+def test_player_reads_blocks_in_order(app, user):
+    recorder = Recorder("container", user.id, "web")
+    recorder.record(OUTPUT, b"hello")
+    recorder.resize(24, 80)
+    recorder.write(recorder.take())
+    recorder.record(OUTPUT, b"world")
+    recorder.close()
+
+    assert _events(recorder.recording_id) == [
+        ("o", b"hello"),
+        ("r", b"80x24"),
+        ("o", b"world"),
+    ]
+
+
+def test_player_reads_only_the_requested_range(app, user):
+    recorder = Recorder("container", user.id, "web")
+    recorder.record(OUTPUT, b"first")
+    recorder.write(recorder.take())
+    # Ten seconds later
+    recorder.started -= 10
+    recorder.record(OUTPUT, b"second")
+    recorder.close()
+
+    assert _events(recorder.recording_id, 5000) == [("o", b"second")]
+    assert _events(recorder.recording_id, 0, 5000) == [("o", b"first")]
+
+
+def test_flushes_from_several_threads_keep_blocks_in_order(app, user, monkeypatch):
+    def compress(payload):
+        # The first block is still being compressed when the next is flushed
+        if b"first" in payload:
+            time.sleep(0.2)
+        return zlib.compress(payload)
+
+    monkeypatch.setattr(
+        recording,
+        "zlib",
+        types.SimpleNamespace(compress=compress, decompress=zlib.decompress),
+    )
+    recorder = Recorder("container", user.id, "web")
+    recorder.record(OUTPUT, b"first")
+    flushing = threading.Thread(target=recorder.flush)
+    flushing.start()
+    time.sleep(0.05)
+    recorder.started -= 1
+    recorder.resize(24, 80)
+    recorder.flush()
+    flushing.join()
+    recorder.close()
+
+    player = Player(recorder.recording_id)
+    assert player._times == sorted(player._times)
+    player.close()
+    assert _events(recorder.recording_id) == [("o", b"first"), ("r", b"80x24")]
+
+
+def test_input_is_only_recorded_when_enabled(app, user):
+    app.config["CLOUDSHELL_RECORDING_INPUT"] = False
+    recorder = Recorder("container", user.id, "web")
+    recorder.record(INPUT, b"secret")
+    recorder.record(OUTPUT, b"shown")
+    recorder.close()
+
+    assert _events(recorder.recording_id) == [("o", b"shown")]
+
+
+def test_player_reads_blocks_missing_from_the_index(app, user):
+    recorder = Recorder("container", user.id, "web")
+    recorder.record(OUTPUT, b"indexed")
+    recorder.write(recorder.take())
+    recorder.record(OUTPUT, b"unindexed")
+    recorder.close()
+    # As if the recorder died between writing a block and its index entry
+    _, index_path = _paths(recorder.recording_id)
+    with open(index_path, "r+b") as f:
+        f.truncate(os.path.getsize(index_path) // 2)
+
+    assert _events(recorder.recording_id) == [
+        ("o", b"indexed"),
+        ("o", b"unindexed"),
+    ]
+
+
+def test_empty_recording_file_has_no_events(app, user):
+    recorder = Recorder("container", user.id, "web")
+    recorder.close()
+    data_path, _ = _paths(recorder.recording_id)
+    open(data_path, "wb").close()
+
+    assert _events(recorder.recording_id) == []
+
+
+def test_api_serves_recording_before_its_first_block(app, user):
+    recorder = Recorder("container", user.id, "web")
+
+    response = app.test_client().get(
+        f"/api/cloudshell/recordings/{recorder.recording_id}",
+        headers={"Authentication-Token": user.get_auth_token()},
+    )
+    recorder.close()
+    assert response.status_code == 200
+    assert response.json["events"] == []
+    assert response.json["next"] is None
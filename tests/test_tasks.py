@@ -0,0 +1,138 @@
+import pytest
+import sqlalchemy as sa
+from rq import Queue
+from rq.job import Job
+from app.extensions import db
+from app.models import Container
+from app.cloudshell import inventory
+
+
+def test_create_shell_commits_container(app, daemon, user, monkeypatch):
+    user_id = user.id
+    # Run the job in this process, with progress published as by a worker
+    monkeypatch.setattr(
+        app, "task_queue", Queue("tests", connection=app.redis, is_async=False)
+    )
+    task = user.launch_task("tasks.create_shell", "Create shell")
+
+    job = Job.fetch(task.id, connection=app.redis)
+    assert job.meta["phase"] == "ready"
+    info = job.return_value()
+    assert info["container_id"] in daemon.containers
+
+    # The row survives whatever the session does after the task returns
+    db.session.rollback()
+    row = db.session.scalar(
+        sa.select(Container).where(Container.container_id == info["container_id"])
+    )
+    assert row is not None
+    assert row.user_id == user_id
+    assert row.status == "running"
+    assert row.host_key == info["host_key"]
+    assert row.host_key.startswith("ssh-ed25519 ")
+    assert inventory.get(info["container_id"])["user_id"] == str(user_id)
+
+
+def test_create_shells_commits_containers(app, user):
+    from app import tasks
+
+    user_id = user.id
+    results = tasks.create_shells(user_id, 2)
+
+    db.session.rollback()
+    ids = set(
+        db.session.scalars(
+            sa.select(Container.container_id).where(Container.user_id == user_id)
+        )
+    )
+    assert ids == {result["container_id"] for result in results}
+    assert len(ids) == 2
+
+
+def _run(app, user, monkeypatch, *args):
+    monkeypatch.setattr(
+        app, "task_queue", Queue("tests", connection=app.redis, is_async=False)
+    )
+    task = user.launch_task(*args)
+    return Job.fetch(task.id, connection=app.redis)
+
+
+def test_create_shells_reports_partial_failure(app, daemon, user, monkeypatch):
+    from app import tasks
+
+    create_container = tasks.create_container
+    calls = []
+
+    def flaky():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("No space left on device")
+        return create_container()
+
+    monkeypatch.setattr(tasks, "create_container", flaky)
+    app.config["CLOUDSHELL_BULK_CONCURRENCY"] = 1
+    job = _run(app, user, monkeypatch, "tasks.create_shells", "Create shells", 2)
+
+    assert job.meta["phase"] == "partial"
+    assert job.meta["error"] == "1 of 2 shells failed: No space left on device"
+    results = job.return_value()
+    assert sorted(result["status"] for result in results) == ["error", "success"]
+
+
+def test_create_shells_fails_when_every_shell_fails(app, user, monkeypatch):
+    from app import tasks
+
+    def broken():
+        raise RuntimeError("Docker is down")
+
+    monkeypatch.setattr(tasks, "create_container", broken)
+    job = _run(app, user, monkeypatch, "tasks.create_shells", "Create shells", 2)
+
+    assert job.is_failed
+    assert job.meta["phase"] == "failed"
+    assert job.meta["error"] == "2 of 2 shells failed: Docker is down"
+
+
+def test_shell_failing_configuration_is_removed(app, daemon, user, monkeypatch):
+    from app import tasks
+    from app.cloudshell import helpers, pool
+
+    def broken(container):
+        raise RuntimeError("Could not read the host key")
+
+    app.config["CLOUDSHELL_POOL_SIZE"] = 1
+    pool.refill()
+    monkeypatch.setattr(helpers, "assign_container", broken)
+
+    with pytest.raises(RuntimeError):
+        tasks.create_shell(user.id)
+    assert not daemon.containers
+    assert pool.claimed() == set()
+
+
+def test_shell_that_cannot_be_recorded_is_removed(app, daemon, user, monkeypatch):
+    from app import tasks
+
+    def commit():
+        raise sa.exc.OperationalError("INSERT", {}, Exception("database is locked"))
+
+    user_id = user.id
+    monkeypatch.setattr(db.session, "commit", commit)
+
+    with pytest.raises(sa.exc.OperationalError):
+        tasks.create_shell(user_id)
+    assert not daemon.containers
+
+
+def test_shell_that_never_becomes_ready_is_removed(app, daemon, monkeypatch):
+    from app.cloudshell import helpers
+
+    class Waiter:
+        def wait(self, timeout):
+            raise TimeoutError("sshd did not start")
+
+    monkeypatch.setattr(helpers.readiness, "expect", lambda *args: Waiter())
+
+    with pytest.raises(TimeoutError):
+        helpers.provision_container()
+    assert not daemon.containers
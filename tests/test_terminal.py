@@ -0,0 +1,86 @@
+import asyncio
+import json
+import socket
+import pytest
+from websockets.asyncio.client import connect
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+from app.models import Recording
+from app.cloudshell import terminal
+from app.cloudshell.recording import Player
+from app.extensions import db
+
+
+@pytest.fixture
+def shell(monkeypatch):
+    """The shell end of a terminal, and the resizes sent to it."""
+    shell_end, proxy_end = socket.socketpair()
+    resizes = []
+    monkeypatch.setattr(
+        terminal.TerminalProxy, "_exec", staticmethod(lambda cid: ("exec", proxy_end))
+    )
+    monkeypatch.setattr(
+        terminal.TerminalProxy,
+        "_resize",
+        staticmethod(lambda cid, exec_id, rows, cols: resizes.append((rows, cols))),
+    )
+    yield shell_end, resizes
+    shell_end.close()
+
+
+def _run(app, ticket, session):
+    """Run a terminal session against a proxy for the app."""
+
+    async def main():
+        proxy = terminal.TerminalProxy(app)
+        async with serve(proxy.handle, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with connect(f"ws://127.0.0.1:{port}/?ticket={ticket}") as ws:
+                return await session(ws)
+
+    return asyncio.run(main())
+
+
+def test_tickets_are_single_use(app):
+    ticket = terminal.issue_ticket(1, "container")
+
+    assert terminal.redeem_ticket(ticket) == (1, "container")
+    assert terminal.redeem_ticket(ticket) is None
+
+
+def test_invalid_ticket_is_refused(app, shell):
+    async def session(ws):
+        with pytest.raises(ConnectionClosed) as closed:
+            await ws.recv()
+        return closed.value.rcvd.code
+
+    assert _run(app, "forged", session) == 1008
+
+
+def test_terminal_session_is_proxied_and_recorded(app, user, shell):
+    shell_end, resizes = shell
+    app.config["CLOUDSHELL_TERMINAL_FLUSH_MS"] = 50
+    ticket = terminal.issue_ticket(user.id, "container")
+
+    async def session(ws):
+        loop = asyncio.get_running_loop()
+        # Writes within the flush interval reach the browser as one frame
+        shell_end.sendall(b"$ ")
+        await asyncio.sleep(0.005)
+        shell_end.sendall(b"ls\r\n")
+        frame = await ws.recv()
+        await ws.send(json.dumps({"type": "resize", "rows": 24, "cols": 80}))
+        await ws.send(b"exit\n")
+        typed = await loop.run_in_executor(None, shell_end.recv, 1024)
+        return frame, typed
+
+    assert _run(app, ticket, session) == (b"$ ls\r\n", b"exit\n")
+    assert resizes == [(24, 80)]
+
+    recording = db.session.scalar(db.select(Recording))
+    player = Player(recording.id)
+    try:
+        events = [(kind, data) for _, kind, data in player.events()]
+    finally:
+        player.close()
+    assert events == [("o", b"$ ls\r\n"), ("r", b"80x24")]